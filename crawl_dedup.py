@@ -0,0 +1,184 @@
+"""
+Boilerplate stripping and near-duplicate detection for the MAE site crawl.
+
+BoilerplateFilter hashes every window of `shingle_size` consecutive (normalized)
+lines of a page. A window that shows up on many pages (min_pages, or min_fraction
+of the crawl) is a shared sidebar / footer / banner block, and its lines are
+dropped from every page before the page is truncated and stored.
+
+simhash() + NearDuplicateIndex skip pages whose remaining text is near-identical
+to a page already kept (Hamming distance <= max_distance over 64-bit SimHash).
+The index buckets fingerprints by 16-bit bands, so a lookup only compares
+against pages that share a band.
+
+    boilerplate = BoilerplateFilter()
+    for url, lines in pages:
+        boilerplate.add_page(url, line_shingles(lines))
+    kept = NearDuplicateIndex()
+    for url, lines in pages:
+        text = "\n".join(boilerplate.strip(lines))
+        if kept.find(simhash(text)) is None:
+            kept.add(url, simhash(text))
+"""
+import hashlib
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set
+
+DEFAULT_SHINGLE_SIZE = 2
+DEFAULT_MIN_PAGES = 3
+DEFAULT_MIN_FRACTION = 0.2
+DEFAULT_MAX_DISTANCE = 3
+SIMHASH_BITS = 64
+# 4 个 16 位分段：汉明距离 <= 3 时至少有一段完全相同
+_BANDS = 4
+_BAND_BITS = SIMHASH_BITS // _BANDS
+
+_WHITESPACE = re.compile(r"\s+")
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def normalize_line(line: str) -> str:
+    return _WHITESPACE.sub(" ", line).strip().lower()
+
+
+def _hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def line_shingles(lines: List[str], size: int = DEFAULT_SHINGLE_SIZE) -> List[int]:
+    """Hashes of every window of `size` consecutive lines (one window for shorter pages)."""
+    normalized = [normalize_line(line) for line in lines if line.strip()]
+    if not normalized:
+        return []
+    if len(normalized) < size:
+        return [_hash64("\n".join(normalized))]
+    return [_hash64("\n".join(normalized[i:i + size])) for i in range(len(normalized) - size + 1)]
+
+
+class BoilerplateFilter:
+    """Counts line shingles across pages; strips the ones repeated on many pages."""
+
+    def __init__(
+        self,
+        shingle_size: int = DEFAULT_SHINGLE_SIZE,
+        min_pages: int = DEFAULT_MIN_PAGES,
+        min_fraction: float = DEFAULT_MIN_FRACTION,
+    ):
+        self.shingle_size = shingle_size
+        self.min_pages = min_pages
+        self.min_fraction = min_fraction
+        self._page_counts: Counter = Counter()
+        self._pages: Set[str] = set()
+
+    def add_page(self, url: str, shingles: Iterable[int]):
+        """Count a page's shingles once (re-adding the same URL is ignored)."""
+        if url in self._pages:
+            return
+        self._pages.add(url)
+        self._page_counts.update(set(shingles))
+
+    @property
+    def threshold(self) -> int:
+        return max(self.min_pages, math.ceil(self.min_fraction * len(self._pages)))
+
+    def is_boilerplate(self, shingle: int) -> bool:
+        return self._page_counts.get(shingle, 0) >= self.threshold
+
+    def strip(self, lines: List[str]) -> List[str]:
+        """Lines of `lines` not covered by any boilerplate shingle, in order."""
+        lines = [line for line in lines if line.strip()]
+        shingles = line_shingles(lines, self.shingle_size)
+        if len(lines) < self.shingle_size:
+            return [] if shingles and self.is_boilerplate(shingles[0]) else lines
+        drop = [False] * len(lines)
+        for i, shingle in enumerate(shingles):
+            if self.is_boilerplate(shingle):
+                for j in range(i, i + self.shingle_size):
+                    drop[j] = True
+        return [line for line, dropped in zip(lines, drop) if not dropped]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pages": len(self._pages),
+            "threshold": self.threshold,
+            "boilerplate_shingles": sum(1 for c in self._page_counts.values() if c >= self.threshold),
+        }
+
+
+def simhash(text: str, ngram: int = 3) -> int:
+    """64-bit SimHash over word n-grams of `text`."""
+    words = _WORD.findall(text.lower())
+    if len(words) < ngram:
+        features = Counter([" ".join(words)]) if words else Counter()
+    else:
+        features = Counter(" ".join(words[i:i + ngram]) for i in range(len(words) - ngram + 1))
+    weights = [0] * SIMHASH_BITS
+    for feature, count in features.items():
+        h = _hash64(feature)
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += count if (h >> bit) & 1 else -count
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class NearDuplicateIndex:
+    """SimHash fingerprints of kept pages, bucketed by band for fast near-duplicate lookups."""
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._fingerprints: Dict[str, int] = {}
+        self._buckets: Dict[tuple, List[str]] = {}
+
+    @staticmethod
+    def _bands(fingerprint: int):
+        mask = (1 << _BAND_BITS) - 1
+        for band in range(_BANDS):
+            yield band, (fingerprint >> (band * _BAND_BITS)) & mask
+
+    def add(self, key: str, fingerprint: int):
+        self._fingerprints[key] = fingerprint
+        for band in self._bands(fingerprint):
+            self._buckets.setdefault(band, []).append(key)
+
+    def find(self, fingerprint: int, exclude: Optional[str] = None) -> Optional[str]:
+        """Key of a stored page within max_distance of `fingerprint`, or None."""
+        for band in self._bands(fingerprint):
+            for key in self._buckets.get(band, ()):
+                if key != exclude and hamming_distance(self._fingerprints[key], fingerprint) <= self.max_distance:
+                    return key
+        return None
+
+
+def test_crawl_dedup():
+    """样板去除 / 近重复 自测"""
+    footer = ["Herbert Wertheim College of Engineering, PO Box 116250",
+              "Copyright University of Florida, Gainesville FL 32611"]
+    pages = {
+        f"/p{i}": [f"Unique content for page number {i} about topic {i * 7}"] + footer for i in range(5)
+    }
+    pages["/short"] = footer[:1]
+    boilerplate = BoilerplateFilter()
+    for url, lines in pages.items():
+        boilerplate.add_page(url, line_shingles(lines))
+    assert boilerplate.strip(pages["/p1"]) == pages["/p1"][:1], boilerplate.strip(pages["/p1"])
+    assert boilerplate.strip(["A genuinely new line of text here"]) == ["A genuinely new line of text here"]
+
+    text = "The Department of Mechanical and Aerospace Engineering offers BS, MS and PhD degrees " * 3
+    near = text.replace("PhD degrees", "Ph.D. degrees", 1)
+    other = "Graduate students must submit the plan of study before the end of the second semester " * 3
+    assert hamming_distance(simhash(text), simhash(near)) <= DEFAULT_MAX_DISTANCE
+    index = NearDuplicateIndex()
+    index.add("a", simhash(text))
+    assert index.find(simhash(near)) == "a"
+    assert index.find(simhash(other)) is None
+    assert index.find(simhash(text), exclude="a") is None
+    print("✅ Crawl dedup test passed", boilerplate.stats())
+
+
+if __name__ == "__main__":
+    test_crawl_dedup()
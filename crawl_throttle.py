@@ -0,0 +1,271 @@
+"""
+Politeness controls for the MAE site crawler.
+
+HostRateLimiter is a per-host token bucket. Workers call acquire(host) before
+each request, so one host never sees more than `rate` requests per second,
+however many workers are running. The rate adapts to the server:
+  - slow responses: the interval follows the smoothed latency (latency_factor x EWMA)
+  - 429 / 5xx / network errors: the interval doubles (up to max_delay_sec) and a
+    Retry-After pause is honoured
+  - successes: the penalty decays back towards the base interval
+
+RobotsCache fetches and parses robots.txt once per host (can_fetch + Crawl-delay).
+Given the crawl's limiter, the robots.txt request itself waits for a token, and
+each host's Crawl-delay is applied to that host's bucket as soon as it is parsed.
+
+    limiter = HostRateLimiter(delay_sec=0.6)
+    limiter.acquire("mae.ufl.edu")      # blocks until a token is available
+    limiter.observe("mae.ufl.edu", latency, ok=True)
+"""
+import threading
+import time
+from typing import Callable, Dict, Optional
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+DEFAULT_MAX_DELAY_SEC = 30.0
+# 平滑延迟的权重，以及“延迟 × 系数”作为请求间隔下限
+LATENCY_EWMA_ALPHA = 0.3
+DEFAULT_LATENCY_FACTOR = 0.5
+PENALTY_DECAY = 0.75
+
+
+class _HostBucket:
+    def __init__(self, delay_sec: float):
+        self.base_delay = delay_sec
+        self.tokens = 1.0
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.penalty = 1.0
+        self.latency_ewma: Optional[float] = None
+
+
+class HostRateLimiter:
+    """Thread-safe per-host token bucket with latency- and error-aware backoff."""
+
+    def __init__(
+        self,
+        delay_sec: float = 0.6,
+        burst: int = 1,
+        max_delay_sec: float = DEFAULT_MAX_DELAY_SEC,
+        latency_factor: float = DEFAULT_LATENCY_FACTOR,
+    ):
+        """
+        Args:
+            delay_sec: base seconds between requests to one host (rate = 1 / delay_sec)
+            burst: bucket capacity (requests that may go out back-to-back)
+            max_delay_sec: upper bound for the backed-off interval
+            latency_factor: interval >= latency_factor x smoothed response time
+        """
+        self.delay_sec = delay_sec
+        self.burst = max(1, burst)
+        self.max_delay_sec = max_delay_sec
+        self.latency_factor = latency_factor
+        self._hosts: Dict[str, _HostBucket] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, host: str) -> _HostBucket:
+        bucket = self._hosts.get(host)
+        if bucket is None:
+            bucket = self._hosts[host] = _HostBucket(self.delay_sec)
+        return bucket
+
+    def _interval(self, bucket: _HostBucket) -> float:
+        interval = bucket.base_delay * bucket.penalty
+        if bucket.latency_ewma is not None:
+            interval = max(interval, bucket.latency_ewma * self.latency_factor)
+        return min(self.max_delay_sec, interval)
+
+    def set_min_delay(self, host: str, delay_sec: float):
+        """Raise a host's base interval (e.g. to its robots.txt Crawl-delay)."""
+        with self._lock:
+            bucket = self._get(host)
+            bucket.base_delay = max(bucket.base_delay, delay_sec)
+
+    def acquire(self, host: str, sleep: Callable[[float], None] = time.sleep):
+        """Block until a request to `host` is allowed, then consume one token."""
+        while True:
+            with self._lock:
+                bucket = self._get(host)
+                now = time.monotonic()
+                interval = self._interval(bucket)
+                if interval > 0:
+                    bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) / interval)
+                else:
+                    bucket.tokens = self.burst
+                bucket.updated_at = now
+                if now >= bucket.blocked_until and bucket.tokens >= 1.0:
+                    bucket.tokens -= 1.0
+                    return
+                wait = max(bucket.blocked_until - now, (1.0 - bucket.tokens) * interval)
+            sleep(max(wait, 0.001))
+
+    def observe(self, host: str, latency: float, ok: bool = True, retry_after: Optional[float] = None):
+        """Report a finished request; slows the host down on errors or rising latency."""
+        with self._lock:
+            bucket = self._get(host)
+            if bucket.latency_ewma is None:
+                bucket.latency_ewma = latency
+            else:
+                bucket.latency_ewma = LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * bucket.latency_ewma
+            if ok:
+                bucket.penalty = max(1.0, bucket.penalty * PENALTY_DECAY)
+                return
+            max_penalty = self.max_delay_sec / bucket.base_delay if bucket.base_delay > 0 else 1.0
+            bucket.penalty = min(max(max_penalty, 1.0), bucket.penalty * 2)
+            if retry_after:
+                bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + min(retry_after, self.max_delay_sec))
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                host: {
+                    "interval": round(self._interval(bucket), 3),
+                    "penalty": round(bucket.penalty, 3),
+                    "latency_ewma": round(bucket.latency_ewma, 3) if bucket.latency_ewma is not None else None,
+                }
+                for host, bucket in self._hosts.items()
+            }
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After in seconds (HTTP-date values are ignored)."""
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+
+class RobotsCache:
+    """robots.txt per scheme://host, fetched lazily with the caller's session."""
+
+    def __init__(self, session, user_agent: str = "*", timeout: float = 10.0,
+                 limiter: Optional[HostRateLimiter] = None):
+        """
+        Args:
+            limiter: when given, robots.txt fetches are rate limited like page requests,
+                and each host's Crawl-delay raises that host's base interval
+        """
+        self.session = session
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.limiter = limiter
+        self._parsers: Dict[str, Optional[RobotFileParser]] = {}
+        self._lock = threading.Lock()
+
+    def _parser_for(self, url: str) -> Optional[RobotFileParser]:
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        with self._lock:
+            if origin in self._parsers:
+                return self._parsers[origin]
+        host = parsed.netloc.lower()
+        parser: Optional[RobotFileParser] = RobotFileParser(origin + "/robots.txt")
+        if self.limiter is not None:
+            self.limiter.acquire(host)
+        started = time.monotonic()
+        try:
+            resp = self.session.get(origin + "/robots.txt", timeout=self.timeout)
+            if self.limiter is not None:
+                self.limiter.observe(host, time.monotonic() - started,
+                                     ok=resp.status_code != 429 and resp.status_code < 500,
+                                     retry_after=parse_retry_after(resp.headers.get("Retry-After")))
+            if resp.status_code in (401, 403):
+                parser.disallow_all = True
+            elif resp.status_code >= 400:
+                parser.allow_all = True
+            else:
+                parser.parse(resp.text.splitlines())
+        except Exception as e:
+            # robots.txt 取不到时按允许处理（与 urllib.robotparser 一致）
+            print(f"⚠️ robots.txt unavailable for {origin}: {e}")
+            if self.limiter is not None:
+                self.limiter.observe(host, time.monotonic() - started, ok=False)
+            parser = None
+        with self._lock:
+            first = origin not in self._parsers
+            self._parsers.setdefault(origin, parser)
+            parser = self._parsers[origin]
+        if first and self.limiter is not None:
+            delay = self._crawl_delay_of(parser)
+            if delay:
+                self.limiter.set_min_delay(host, delay)
+        return parser
+
+    def can_fetch(self, url: str) -> bool:
+        parser = self._parser_for(url)
+        return parser is None or parser.can_fetch(self.user_agent, url)
+
+    def crawl_delay(self, url: str) -> Optional[float]:
+        return self._crawl_delay_of(self._parser_for(url))
+
+    def _crawl_delay_of(self, parser: Optional[RobotFileParser]) -> Optional[float]:
+        if parser is None:
+            return None
+        try:
+            delay = parser.crawl_delay(self.user_agent)
+        except AttributeError:
+            return None
+        return float(delay) if delay is not None else None
+
+
+def test_host_rate_limiter():
+    """令牌桶 / 退避 自测"""
+    limiter = HostRateLimiter(delay_sec=0.05)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire("a")
+    limiter.acquire("b")  # 不同 host 互不影响
+    elapsed = time.monotonic() - start
+    assert 0.18 <= elapsed < 0.5, elapsed
+
+    limiter.observe("a", 0.01, ok=False)
+    limiter.observe("a", 0.01, ok=False)
+    assert limiter.snapshot()["a"]["interval"] == 0.2
+    limiter.observe("a", 1.0, ok=True)
+    assert limiter.snapshot()["a"]["interval"] >= 0.15  # 延迟升高后仍保持较慢
+    limiter.observe("c", 0.01, ok=False, retry_after=0.1)
+    start = time.monotonic()
+    limiter.acquire("c")
+    assert time.monotonic() - start >= 0.09
+    print("✅ Host rate limiter test passed", limiter.snapshot())
+
+
+def test_robots_cache():
+    """robots.txt 请求走限速器，每个 host 的 Crawl-delay 作用到自己的令牌桶"""
+    class _Resp:
+        def __init__(self, text):
+            self.status_code, self.text, self.headers = 200, text, {}
+
+    robots_txt = {
+        "mae.ufl.edu": "User-agent: *\nCrawl-delay: 2\nDisallow: /private\n",
+        "news.mae.ufl.edu": "User-agent: *\nCrawl-delay: 5\n",
+        "other.ufl.edu": "User-agent: *\nDisallow:\n",
+    }
+
+    class _Session:
+        def get(self, url, timeout=None):
+            return _Resp(robots_txt[urlparse(url).netloc])
+
+    acquired = []
+
+    class _Limiter(HostRateLimiter):
+        def acquire(self, host, sleep=time.sleep):
+            acquired.append(host)
+            super().acquire(host, sleep)
+
+    limiter = _Limiter(delay_sec=0.01)
+    robots = RobotsCache(_Session(), limiter=limiter)
+    assert not robots.can_fetch("https://mae.ufl.edu/private/x")
+    assert robots.can_fetch("https://news.mae.ufl.edu/story")
+    assert robots.can_fetch("https://other.ufl.edu/")
+    assert robots.can_fetch("https://mae.ufl.edu/about")  # 已缓存，不再请求
+    assert acquired == ["mae.ufl.edu", "news.mae.ufl.edu", "other.ufl.edu"], acquired
+    intervals = {host: state["interval"] for host, state in limiter.snapshot().items()}
+    assert intervals == {"mae.ufl.edu": 2.0, "news.mae.ufl.edu": 5.0, "other.ufl.edu": 0.01}, intervals
+    print("✅ Robots cache test passed", intervals)
+
+
+if __name__ == "__main__":
+    test_host_rate_limiter()
+    test_robots_cache()
@@ -3,12 +3,17 @@ Few-Shot Learning Examples for Student Reply Generation
 从6000条真实对话数据中加载和使用Few-Shot示例
 """
 
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from functools import lru_cache
 import json
+import threading
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import os
 
+from few_shot_index import PartitionedFewShotIndex
+
 # 导入策略矩阵
 try:
     from strategy_matrix import get_strategy_for_intent, map_intent_to_strategy_key
@@ -53,6 +58,68 @@ _LOADED_CONVERSATIONS = None
 _LOADED_EXAMPLES = None
 _PDF_DIALOGUES = None  # PDF中提取的对话
 _REAL_TRANSCRIPT_DIALOGUES = None  # 真实转录对话（real dialogue/ALL）
+_EXAMPLE_POOL = None  # 合并 + 去重后的示例池（tuple，只读，每个进程只构建一次）
+_EXAMPLE_INDEX = None  # 示例池按 (persona, intent) 分桶的相似度索引（与示例池一起构建）
+_EXAMPLE_POOL_LOCK = threading.Lock()
+
+# 列式缓存：把解析后的对话记录打包成 numpy 字节表（.npz），冷启动时替代 read_excel + iterrows
+CONVERSATION_CACHE_VERSION = 1
+_CACHE_COLUMNS = ("advisor", "student", "intent", "persona", "source")
+
+
+def _conversation_cache_path(file_path: Path) -> Path:
+    """data/peer_dataset_26.xlsm -> data/peer_dataset_26.cache.npz"""
+    return file_path.with_suffix(".cache.npz")
+
+
+def _cache_fingerprint() -> str:
+    """缓存内容依赖的配置（版本 + 列名映射），变化后缓存失效"""
+    return json.dumps({"version": CONVERSATION_CACHE_VERSION, "columns": COLUMN_MAPPING}, sort_keys=True)
+
+
+def write_conversation_cache(conversations: List[Dict], cache_path: Path) -> Path:
+    """
+    把归一化后的对话记录写成列式缓存：每列一段 UTF-8 字节 + 偏移数组 + 空值掩码。
+    """
+    arrays = {"fingerprint": np.array(_cache_fingerprint())}
+    for column in _CACHE_COLUMNS:
+        values = [conv.get(column) for conv in conversations]
+        encoded = [(v or "").encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        arrays[f"{column}_data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        arrays[f"{column}_offsets"] = offsets
+        arrays[f"{column}_null"] = np.array([v is None for v in values], dtype=bool)
+
+    tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def _load_conversation_cache(cache_path: Path) -> Optional[List[Dict]]:
+    """读取列式缓存；配置不匹配时返回 None"""
+    with np.load(cache_path, allow_pickle=False) as cache:
+        if str(cache["fingerprint"]) != _cache_fingerprint():
+            return None
+        columns = {}
+        for column in _CACHE_COLUMNS:
+            data = cache[f"{column}_data"].tobytes()
+            offsets = cache[f"{column}_offsets"].tolist()
+            nulls = cache[f"{column}_null"].tolist()
+            columns[column] = [
+                None if is_null else data[offsets[i]:offsets[i + 1]].decode("utf-8")
+                for i, is_null in enumerate(nulls)
+            ]
+
+    conversations = []
+    for advisor, student, intent, persona, source in zip(*(columns[c] for c in _CACHE_COLUMNS)):
+        conv = {"advisor": advisor, "student": student, "intent": intent, "persona": persona}
+        if source is not None:
+            conv["source"] = source
+        conversations.append(conv)
+    return conversations
+
 
 def load_conversations_from_file(file_path: Optional[str] = None) -> List[Dict]:
     """
@@ -78,6 +145,18 @@ def load_conversations_from_file(file_path: Optional[str] = None) -> List[Dict]:
         print(f"   请修改 few_shot_examples.py 中的 DATA_FILE_PATH")
         return []
     
+    # 优先使用比数据文件更新的列式缓存，只有缓存缺失/过期时才解析 Excel
+    cache_path = _conversation_cache_path(file_path)
+    if cache_path.exists() and cache_path.stat().st_mtime >= file_path.stat().st_mtime:
+        try:
+            conversations = _load_conversation_cache(cache_path)
+            if conversations is not None:
+                print(f"✅ 从缓存加载 {len(conversations)} 条对话: {cache_path}")
+                _LOADED_CONVERSATIONS = conversations
+                return conversations
+        except Exception as e:
+            print(f"⚠️ 对话缓存读取失败，改为解析数据文件: {e}")
+    
     try:
         # 根据文件扩展名选择读取方式
         if file_path.suffix.lower() == '.csv':
@@ -170,6 +249,13 @@ def load_conversations_from_file(file_path: Optional[str] = None) -> List[Dict]:
         
         print(f"✅ 成功解析 {len(conversations)} 条对话")
         
+        # 写入列式缓存，下次冷启动直接读取
+        try:
+            write_conversation_cache(conversations, cache_path)
+            print(f"   已写入对话缓存: {cache_path}")
+        except OSError as e:
+            print(f"⚠️ 无法写入对话缓存: {e}")
+        
         # 缓存结果
         _LOADED_CONVERSATIONS = conversations
         return conversations
@@ -313,6 +399,47 @@ def _deduplicate_examples(examples: List[Dict]) -> List[Dict]:
     return result
 
 
+def get_example_pool() -> Tuple[Dict, ...]:
+    """
+    合并 Excel / PDF / 真实转录对话并去重，得到只读示例池。
+    每个进程只构建一次，之后所有调用复用同一个 tuple；不会修改各加载函数的缓存列表。
+    """
+    global _EXAMPLE_POOL
+    if _EXAMPLE_POOL is not None:
+        return _EXAMPLE_POOL
+
+    with _EXAMPLE_POOL_LOCK:
+        if _EXAMPLE_POOL is None:
+            merged = list(load_conversations_from_file())
+            # 添加PDF中提取的对话（如果可用）
+            merged.extend(load_pdf_dialogues())
+            # 添加真实转录对话（real dialogue/ALL）
+            merged.extend(load_real_transcript_dialogues())
+            # 去重：Excel/PDF/真实转录可能来自同一批对话，按 (advisor, student) 去重，优先保留有 intent/persona 的
+            _EXAMPLE_POOL = tuple(_deduplicate_examples(merged))
+    return _EXAMPLE_POOL
+
+
+def _intent_key(intent: str) -> Optional[str]:
+    """intent 归一化为策略键（goal_setting 等），与策略矩阵共用同一映射"""
+    if STRATEGY_MATRIX_AVAILABLE:
+        return map_intent_to_strategy_key(intent)
+    return None
+
+
+def get_example_index() -> PartitionedFewShotIndex:
+    """示例池对应的分桶索引（每个进程只构建一次）"""
+    global _EXAMPLE_INDEX
+    if _EXAMPLE_INDEX is not None:
+        return _EXAMPLE_INDEX
+
+    pool = get_example_pool()
+    with _EXAMPLE_POOL_LOCK:
+        if _EXAMPLE_INDEX is None:
+            _EXAMPLE_INDEX = PartitionedFewShotIndex(pool, _intent_key)
+    return _EXAMPLE_INDEX
+
+
 def get_few_shot_examples(persona: str, 
                          advisor_message: str,
                          intent: Optional[str] = None,
@@ -331,244 +458,42 @@ def get_few_shot_examples(persona: str,
     Returns:
         选中的Few-Shot示例列表
     """
-    # 如果没有提供示例源，从文件加载
+    # 如果没有提供示例源，使用合并去重后的共享示例池及其分桶索引
     if examples_source is None:
-        examples_source = load_conversations_from_file()
-        
-        # 添加PDF中提取的对话（如果可用）
-        pdf_dialogues = load_pdf_dialogues()
-        if pdf_dialogues:
-            examples_source.extend(pdf_dialogues)
-        # 添加真实转录对话（real dialogue/ALL）
-        real_transcripts = load_real_transcript_dialogues()
-        if real_transcripts:
-            examples_source.extend(real_transcripts)
-        # 去重：Excel/PDF/真实转录可能来自同一批对话，按 (advisor, student) 去重，优先保留有 intent/persona 的
-        examples_source = _deduplicate_examples(examples_source)
+        examples_source = get_example_pool()
+        index = get_example_index() if examples_source else None
+    else:
+        index = PartitionedFewShotIndex(examples_source, _intent_key) if examples_source else None
     
     if not examples_source:
         # 如果加载失败，返回空列表（系统会fallback到原始方法）
         return []
     
-    # 过滤：只选择匹配persona的示例（包括PDF对话）
-    persona_lower = persona.lower()
-    persona_examples = [
-        ex for ex in examples_source 
-        if (ex.get("persona") and ex.get("persona").lower() == persona_lower) or
-           ex.get("source") == "pdf_training_package" or
-           ex.get("source") == "real_transcript"  # 包含PDF对话和真实转录（可能匹配任何persona）
-    ]
+    # 候选示例 = (persona, intent) 桶：匹配persona的示例 + PDF对话 + 真实转录；
+    # 有匹配intent的示例时只取这些。没有该persona的示例时退回共享来源/全部示例。
+    bucket_key = index.bucket_key(persona, intent)
+    bucket = index.bucket_index(bucket_key)
     
-    # 如果没有匹配的persona，使用所有示例
-    if not persona_examples:
-        persona_examples = examples_source
-        print(f"⚠️ 未找到 {persona} persona的示例，使用所有示例")
-    
-    # 如果指定了intent，进一步过滤
-    if intent:
-        matching_examples = [
-            ex for ex in persona_examples 
-            if ex.get("intent") and intent.lower() in ex.get("intent", "").lower()
-        ]
-        if matching_examples:
-            persona_examples = matching_examples
-    
-    # 改进的相似度匹配：使用序列相似度 + 关键词 + Intent匹配
-    from difflib import SequenceMatcher
-    
-    advisor_lower = advisor_message.lower()
-    scored_examples = []
-    
-    for example in persona_examples:
-        score = 0
-        advisor_example = example.get("advisor", "").lower()
-        
-        # 方法1：序列相似度（比关键词匹配更准确）
-        similarity = SequenceMatcher(None, advisor_lower, advisor_example).ratio()
-        score += similarity * 10  # 权重10（最重要）
-        
-        # 方法2：关键词匹配（作为补充）
-        advisor_words = set(advisor_lower.split())
-        example_words = set(advisor_example.split())
-        
-        # 移除停用词
-        stop_words = {'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'been', 
-                     'to', 'of', 'and', 'or', 'but', 'in', 'on', 'at', 'for', 
-                     'with', 'by', 'from', 'as', 'this', 'that', 'these', 'those',
-                     'so', 'do', 'does', 'did', 'can', 'could', 'will', 'would',
-                     'have', 'has', 'had', 'what', 'which', 'when', 'where', 'why', 'how'}
-        advisor_words = advisor_words - stop_words
-        example_words = example_words - stop_words
-        
-        common_words = advisor_words & example_words
-        score += len(common_words) * 0.5  # 权重0.5（补充）
-        
-        # 方法3：Intent匹配（重要加分）
-        if intent and example.get("intent"):
-            if intent.lower() in example.get("intent", "").lower():
-                score += 5  # 重要加分
-        # 方法4：真实转录偏好（分数接近时优先选真实对话，小幅加分不覆盖明显更相关的示例）
-        if example.get("source") == "real_transcript":
-            score += 0.3
-        scored_examples.append((score, example))
-    
-    # 按分数排序
-    scored_examples.sort(key=lambda x: x[0], reverse=True)
-    
-    # 改进：多样性选择（避免选择太相似的示例）
-    selected = []
-    for score, ex in scored_examples:
-        if len(selected) >= num_examples:
-            break
-        
-        # 检查与已选示例的相似度
-        is_diverse = True
-        for selected_ex in selected:
-            selected_text = selected_ex.get("advisor", "").lower()
-            current_text = ex.get("advisor", "").lower()
-            similarity = SequenceMatcher(None, selected_text, current_text).ratio()
-            if similarity > 0.75:  # 如果太相似（>75%），跳过以保持多样性
-                is_diverse = False
-                break
-        
-        if is_diverse:
-            selected.append(ex)
+    # 相似度打分：一次稀疏矩阵乘法得到 文本相似度*10 + 共同关键词*0.5 + Intent加分 + 真实转录加分
+    scores = bucket.score(advisor_message, intent)
     
-    # 如果还不够，补充其他示例（优先选择高分但不同的）
-    if len(selected) < num_examples:
-        remaining = [(score, ex) for score, ex in scored_examples if ex not in selected]
-        # 按分数排序，选择不同的
-        remaining.sort(key=lambda x: x[0], reverse=True)
-        for score, ex in remaining:
-            if len(selected) >= num_examples:
-                break
-            # 再次检查多样性
-            is_diverse = True
-            for selected_ex in selected:
-                selected_text = selected_ex.get("advisor", "").lower()
-                current_text = ex.get("advisor", "").lower()
-                similarity = SequenceMatcher(None, selected_text, current_text).ratio()
-                if similarity > 0.75:
-                    is_diverse = False
-                    break
-            if is_diverse:
-                selected.append(ex)
+    # 多样性选择（MMR，基于预计算的示例向量，跳过与已选示例过于相似（>75%）的候选）
+    selected_ids = bucket.select_diverse(scores, num_examples)
+    selected = [bucket.examples[j] for j in selected_ids]
     
     # 如果还是不够，随机补充（最后手段）
     if len(selected) < num_examples:
-        remaining = [ex for score, ex in scored_examples if ex not in selected]
+        chosen = set(selected_ids)
+        remaining = [ex for j, ex in enumerate(bucket.examples) if j not in chosen]
         import random
         if remaining:
             selected.extend(random.sample(remaining, min(num_examples - len(selected), len(remaining))))
     
     return selected
 
-def format_few_shot_prompt(examples: List[Dict], 
-                          advisor_message: str,
-                          persona: str,
-                          persona_info: Dict,
-                          conversation_context: str = None,
-                          advisor_intent: Optional[str] = None) -> str:
-    """
-    格式化Few-Shot Prompt
-    
-    Args:
-        examples: Few-Shot示例列表
-        advisor_message: 当前顾问消息
-        persona: 学生persona类型
-        persona_info: Persona详细信息
-    
-    Returns:
-        格式化后的prompt
-    """
-    # 如果没有示例，返回基本prompt
-    if not examples:
-        return f"""You are a {persona.upper()} type MAE student having a conversation with a peer advisor.
-
-Persona Characteristics:
-- Description: {persona_info.get('description', '')}
-- Traits: {', '.join(persona_info.get('traits', []))}
-- Help Seeking: {persona_info.get('help_seeking_behavior', '')}
-
-Peer Advisor said: "{advisor_message}"
-
-If this continues a longer conversation, do not repeat the same worry as your last replies if the advisor already addressed it; acknowledge their latest point and move forward (still in {persona.upper()} character).
-
-Generate a natural and authentic response as this {persona.upper()} student (1-3 sentences).
-Student response:"""
-    
-    # 构建示例部分
-    examples_text = "Here are some examples of similar conversations:\n\n"
-    
-    for i, example in enumerate(examples, 1):
-        examples_text += f"Example {i}:\n"
-        examples_text += f"Advisor: {example.get('advisor', '')}\n"
-        examples_text += f"Student ({persona.upper()}): {example.get('student', '')}\n"
-        if example.get('intent'):
-            examples_text += f"Intent: {example.get('intent')}\n"
-        examples_text += "\n"
-    
-    # 提取最后一条advisor消息（如果包含对话历史）
-    if "Now the advisor says:" in advisor_message:
-        last_advisor_msg = advisor_message.split("Now the advisor says:")[-1].strip()
-    else:
-        last_advisor_msg = advisor_message
-    
-    # 构建完整prompt
-    context_section = ""
-    recent_student_lines = []  # 最近最多3条学生回复
-    if conversation_context or ("Previous conversation:" in advisor_message):
-        if "Previous conversation:" in advisor_message:
-            raw_context = advisor_message.split("Now the advisor says:")[0].strip()
-            context_section = raw_context + "\n\n"
-            for line in reversed(raw_context.splitlines()):
-                if line.startswith("Student:"):
-                    recent_student_lines.append(line[len("Student:"):].strip())
-                    if len(recent_student_lines) >= 3:
-                        break
-        elif conversation_context:
-            context_section = f"Previous conversation:\n{conversation_context}\n\n"
-            for line in reversed(conversation_context.splitlines()):
-                if line.startswith("Student:"):
-                    recent_student_lines.append(line[len("Student:"):].strip())
-                    if len(recent_student_lines) >= 3:
-                        break
-    last_student_line = recent_student_lines[0] if recent_student_lines else ""
-
-    la = last_advisor_msg.lower().strip()
-
-    # ── 信号1：真正的对话收尾（顾问明确结束会面）
-    hard_closing_keywords = [
-        "hope you", "good luck", "best of luck", "hope it goes well", "sounds good",
-        "anything else", "any other question", "other questions", "does that cover",
-        "we're good", "wrap up", "that's all for today", "take care", "see you",
-        "feel free to reach out", "let me know if you need",
-    ]
-    advisor_is_closing = any(kw in la for kw in hard_closing_keywords)
-
-    # ── 信号2：行动令（顾问已给出具体步骤，让学生去做）
-    # 触发"短回复"而不是"对话结束"——学生应该说 thanks+会去做，不要再展开同一担忧
-    action_prompt_keywords = [
-        "just do it", "go ahead", "give it a try", "take it slow",
-        "you'll get used", "just try", "just go", "just send", "just reach out",
-        "just email", "start with", "take a step", "take the first step",
-    ]
-    advisor_gave_action = any(kw in la for kw in action_prompt_keywords)
-    # "ok" / "okay" 单独出现或作为短句开头也视为行动令
-    if not advisor_gave_action:
-        advisor_gave_action = (
-            la == "ok"
-            or la == "okay"
-            or la.startswith("ok,")
-            or la.startswith("ok ")
-            or la.startswith("okay,")
-            or la.startswith("okay ")
-        )
-    
-    # 根据Persona类型添加特定的语言风格指导
-    persona_style_guide = ""
-    if persona.lower() == "beta":
-        persona_style_guide = """
+# 每个 persona 的说话风格指导（与对话内容无关，可直接复用）
+PERSONA_STYLE_GUIDES = {
+    "beta": """
 BETA PERSONA COMMUNICATION STYLE:
 Core character: very low self-confidence, strong fear of being judged by peers, tends to apologize or minimize themselves before asking anything.
 
@@ -589,9 +514,8 @@ Tone guidance (NOT a phrase list to copy verbatim):
 **Anti-loop (critical):**
 - If the advisor has already reassured you about the *same* fear 2+ times AND given a concrete action step, your next response must NOT expand that fear into a full paragraph again.
 - When the advisor says "OK" / "just do it" / "go ahead": 1-2 sentences — thanks + tentative try + optional one short hedge — then stop.
-"""
-    elif persona.lower() == "alpha":
-        persona_style_guide = """
+""",
+    "alpha": """
 ALPHA PERSONA COMMUNICATION STYLE:
 Core character: moderately below average confidence, genuinely curious, but **needs to be nudged before committing**. They accept advice **more slowly** than ECHO or DELTA — not stubborn, just unsure they are ready.
 
@@ -611,9 +535,8 @@ Tone guidance (NOT a phrase list to copy verbatim):
 - After advisor doubles down with encouragement: can move toward "okay, I'll try that" while staying mildly uncertain.
 
 - NEVER open two consecutive turns with the same sentence structure
-"""
-    elif persona.lower() == "delta":
-        persona_style_guide = """
+""",
+    "delta": """
 DELTA PERSONA COMMUNICATION STYLE:
 Core character: moderately above average confidence in academics, but strategically cautious — cares how peers and faculty perceive them; wants the "right" career moves.
 
@@ -631,9 +554,8 @@ Express this through natural, varied language — do NOT repeat the same opening
 - Sounds like someone updating their strategy, not someone who had no idea what to do.
 
 - NEVER open two consecutive turns with the same sentence structure
-"""
-    elif persona.lower() == "echo":
-        persona_style_guide = """
+""",
+    "echo": """
 ECHO PERSONA COMMUNICATION STYLE:
 Core character: very high confidence, proactive. They came in **already thinking** — often with **options or a draft plan**. The advisor is there to **validate, refine, or extend** what they started, not to supply the first idea from scratch.
 
@@ -649,9 +571,38 @@ Express this through natural, varied language — do NOT repeat the same opening
 - May already have a timeline or second option in mind.
 
 - NEVER open two consecutive turns with the same sentence structure
-"""
-    
-    # 获取策略指导（如果可用）
+""",
+}
+
+# 意图分类器输出的五个意图类别（用于预取策略指导）
+STRATEGY_INTENT_LABELS = (
+    "Goal Setting and Planning",
+    "Problem Solving and Critical Thinking",
+    "Understanding and Clarification",
+    "Feedback and Support",
+    "Exploration and Reflection",
+)
+
+
+def get_persona_style_guide(persona: str) -> str:
+    """Persona 的语言风格指导（未知 persona 返回空字符串）"""
+    return PERSONA_STYLE_GUIDES.get((persona or "").lower(), "")
+
+
+def extract_recent_student_lines(context_text: Optional[str], limit: int = 3) -> List[str]:
+    """对话历史文本中最近的学生回复（最新的在前，最多 limit 条）"""
+    lines = []
+    for line in reversed((context_text or "").splitlines()):
+        if line.startswith("Student:"):
+            lines.append(line[len("Student:"):].strip())
+            if len(lines) >= limit:
+                break
+    return lines
+
+
+@lru_cache(maxsize=256)
+def build_strategy_guide(persona: str, advisor_intent: Optional[str]) -> str:
+    """策略矩阵中 (persona, 顾问意图) 对应的策略指导段落；不可用时返回空字符串"""
     strategy_guide = ""
     if STRATEGY_MATRIX_AVAILABLE and advisor_intent:
         strategy = get_strategy_for_intent(persona, advisor_intent)
@@ -677,6 +628,117 @@ Key things the advisor is trying to AVOID:
 As a {persona.upper()} student, respond authentically to this advisor approach. Your response should feel natural given this strategy context.
 """
     
+    return strategy_guide
+
+
+def precompute_prompt_context(persona: str, conversation_context: Optional[str]) -> Dict:
+    """
+    Prompt pieces that depend only on the conversation so far (not on the next advisor
+    message): recent student lines, persona style guide and the strategy guide for every
+    intent category. Computed after a turn completes and passed to format_few_shot_prompt
+    as prompt_context.
+    """
+    return {
+        "recent_student_lines": extract_recent_student_lines(conversation_context),
+        "persona_style_guide": get_persona_style_guide(persona),
+        "strategy_guides": {intent: build_strategy_guide(persona, intent) for intent in STRATEGY_INTENT_LABELS},
+    }
+
+
+def format_few_shot_prompt(examples: List[Dict], 
+                          advisor_message: str,
+                          persona: str,
+                          persona_info: Dict,
+                          conversation_context: str = None,
+                          advisor_intent: Optional[str] = None,
+                          prompt_context: Optional[Dict] = None) -> str:
+    """
+    格式化Few-Shot Prompt
+    
+    Args:
+        examples: Few-Shot示例列表
+        advisor_message: 当前顾问消息
+        persona: 学生persona类型
+        persona_info: Persona详细信息
+        prompt_context: precompute_prompt_context() 的结果（上一轮结束后预先算好的历史相关部分），可选
+    
+    Returns:
+        格式化后的prompt
+    """
+    # 构建示例部分（没有示例时只省略这一块，人设 / 策略 / 防重复规则照常保留）
+    examples_text = "Here are some examples of similar conversations:\n\n" if examples else ""
+    
+    for i, example in enumerate(examples or [], 1):
+        examples_text += f"Example {i}:\n"
+        examples_text += f"Advisor: {example.get('advisor', '')}\n"
+        examples_text += f"Student ({persona.upper()}): {example.get('student', '')}\n"
+        if example.get('intent'):
+            examples_text += f"Intent: {example.get('intent')}\n"
+        examples_text += "\n"
+    
+    # 提取最后一条advisor消息（如果包含对话历史）
+    if "Now the advisor says:" in advisor_message:
+        last_advisor_msg = advisor_message.split("Now the advisor says:")[-1].strip()
+    else:
+        last_advisor_msg = advisor_message
+    
+    # 构建完整prompt
+    context_section = ""
+    recent_student_lines = []  # 最近最多3条学生回复
+    if conversation_context or ("Previous conversation:" in advisor_message):
+        if "Previous conversation:" in advisor_message:
+            raw_context = advisor_message.split("Now the advisor says:")[0].strip()
+            context_section = raw_context + "\n\n"
+        else:
+            raw_context = conversation_context
+            context_section = f"Previous conversation:\n{conversation_context}\n\n"
+        if prompt_context and "recent_student_lines" in prompt_context:
+            recent_student_lines = list(prompt_context["recent_student_lines"])
+        else:
+            recent_student_lines = extract_recent_student_lines(raw_context)
+    last_student_line = recent_student_lines[0] if recent_student_lines else ""
+
+    la = last_advisor_msg.lower().strip()
+
+    # ── 信号1：真正的对话收尾（顾问明确结束会面）
+    hard_closing_keywords = [
+        "hope you", "good luck", "best of luck", "hope it goes well", "sounds good",
+        "anything else", "any other question", "other questions", "does that cover",
+        "we're good", "wrap up", "that's all for today", "take care", "see you",
+        "feel free to reach out", "let me know if you need",
+    ]
+    advisor_is_closing = any(kw in la for kw in hard_closing_keywords)
+
+    # ── 信号2：行动令（顾问已给出具体步骤，让学生去做）
+    # 触发"短回复"而不是"对话结束"——学生应该说 thanks+会去做，不要再展开同一担忧
+    action_prompt_keywords = [
+        "just do it", "go ahead", "give it a try", "take it slow",
+        "you'll get used", "just try", "just go", "just send", "just reach out",
+        "just email", "start with", "take a step", "take the first step",
+    ]
+    advisor_gave_action = any(kw in la for kw in action_prompt_keywords)
+    # "ok" / "okay" 单独出现或作为短句开头也视为行动令
+    if not advisor_gave_action:
+        advisor_gave_action = (
+            la == "ok"
+            or la == "okay"
+            or la.startswith("ok,")
+            or la.startswith("ok ")
+            or la.startswith("okay,")
+            or la.startswith("okay ")
+        )
+    
+    # 根据Persona类型添加特定的语言风格指导 / 策略指导（可由 prompt_context 预先算好）
+    persona_style_guide = prompt_context.get("persona_style_guide") if prompt_context else None
+    if persona_style_guide is None:
+        persona_style_guide = get_persona_style_guide(persona)
+
+    strategy_guide = None
+    if prompt_context and advisor_intent:
+        strategy_guide = prompt_context.get("strategy_guides", {}).get(advisor_intent)
+    if strategy_guide is None:
+        strategy_guide = build_strategy_guide(persona, advisor_intent)
+    
     prompt = f"""You are a {persona.upper()} type MAE student having a conversation with a peer advisor.
 
 Persona Characteristics:
@@ -932,8 +994,46 @@ def test_example_selection():
     else:
         print("\n⚠️ 未找到相关示例")
 
+def test_example_pool_stability(num_calls: int = 1000):
+    """回归测试：多次调用 get_few_shot_examples 后示例池大小保持不变（不再无限增长）"""
+    print("=" * 60)
+    print("🧪 测试示例池稳定性")
+    print("=" * 60)
+
+    pool = get_example_pool()
+    pool_size = len(pool)
+    excel_size = len(_LOADED_CONVERSATIONS or [])
+
+    for i in range(num_calls):
+        get_few_shot_examples(
+            persona=["alpha", "beta", "delta", "echo"][i % 4],
+            advisor_message="What courses are you taking next semester?",
+            intent="Goal Setting and Planning",
+            num_examples=2,
+        )
+        assert get_example_pool() is pool, "示例池被重新构建"
+        assert len(get_example_pool()) == pool_size, "示例池大小发生变化"
+    assert len(_LOADED_CONVERSATIONS or []) == excel_size, "Excel 对话缓存被修改"
+
+    print(f"\n✅ {num_calls} 次调用后示例池大小不变: {pool_size} 条")
+
 if __name__ == "__main__":
+    import sys
+
+    # 预先生成列式缓存：python few_shot_examples.py build-cache [数据文件路径]
+    if len(sys.argv) > 1 and sys.argv[1] == "build-cache":
+        data_path = Path(sys.argv[2] if len(sys.argv) > 2 else DATA_FILE_PATH)
+        cache_file = _conversation_cache_path(data_path)
+        if cache_file.exists():
+            cache_file.unlink()
+        conversations = load_conversations_from_file(str(data_path))
+        if conversations and cache_file.exists():
+            print(f"✅ 已生成缓存 {cache_file}（{len(conversations)} 条对话）")
+        sys.exit(0)
+
     # 运行测试
     test_data_loading()
     print("\n")
     test_example_selection()
+    print("\n")
+    test_example_pool_stability()
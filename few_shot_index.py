@@ -0,0 +1,341 @@
+"""
+Few-Shot 示例相似度索引
+预先把示例池的 advisor 文本向量化（字符 3-gram TF-IDF + 关键词集合），
+一次稀疏矩阵乘法即可给所有候选示例打分，替代逐条 difflib.SequenceMatcher。
+"""
+
+import threading
+from collections import Counter
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+NGRAM_SIZE = 3
+
+# 与 get_few_shot_examples 原有关键词匹配相同的停用词
+STOP_WORDS = frozenset({
+    'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'been',
+    'to', 'of', 'and', 'or', 'but', 'in', 'on', 'at', 'for',
+    'with', 'by', 'from', 'as', 'this', 'that', 'these', 'those',
+    'so', 'do', 'does', 'did', 'can', 'could', 'will', 'would',
+    'have', 'has', 'had', 'what', 'which', 'when', 'where', 'why', 'how',
+})
+
+# 打分权重（与原 SequenceMatcher 版本保持一致的组合方式）
+SIMILARITY_WEIGHT = 10.0   # 文本相似度（最重要）
+KEYWORD_WEIGHT = 0.5       # 每个共同关键词
+INTENT_BONUS = 5.0         # intent 匹配
+REAL_TRANSCRIPT_BONUS = 0.3  # 真实转录小幅加分
+
+# 多样性选择（MMR）：相关度权重，以及与已选示例的相似度上限（超过视为重复）
+MMR_RELEVANCE_WEIGHT = 0.7
+DIVERSITY_MAX_SIMILARITY = 0.75
+_KERNEL_CACHE_SIZE = 512  # 每个索引缓存的相似度行数
+
+# 可匹配任何 persona 的示例来源（PDF 对话、真实转录）
+SHARED_SOURCES = ("pdf_training_package", "real_transcript")
+
+
+def _char_ngrams(text: str) -> Counter:
+    """字符 n-gram 计数（先合并空白，首尾补空格以保留词边界）"""
+    padded = f" {' '.join(text.split())} "
+    return Counter(padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1))
+
+
+def _keywords(text: str) -> set:
+    return set(text.split()) - STOP_WORDS
+
+
+class _Postings:
+    """列压缩（CSC）稀疏矩阵：term -> (doc ids, weights)，支持一次性 sparse mat-vec"""
+
+    def __init__(self, doc_ids: np.ndarray, term_ids: np.ndarray, vals: np.ndarray, n_terms: int, n_docs: int):
+        # 保留 COO 三元组 (doc, term, value)，用于切出子集索引
+        self.coo = (doc_ids, term_ids, vals)
+        self.n_terms = n_terms
+        # 文档总数（末尾的文档可能没有任何 term，不能从 doc_ids 推断）
+        self.n_docs = n_docs
+        # 按 term 排序得到 CSC
+        order = np.argsort(term_ids, kind="stable")
+        self.rows = doc_ids[order]
+        self.vals = vals[order]
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(term_ids, minlength=n_terms))))
+        # 行压缩（CSR）视图：doc -> (term ids, weights)，用于取单个示例的向量
+        doc_order = np.argsort(doc_ids, kind="stable")
+        self.row_terms = term_ids[doc_order]
+        self.row_vals = vals[doc_order]
+        self.row_indptr = np.concatenate(([0], np.cumsum(np.bincount(doc_ids, minlength=n_docs))))
+
+    def row(self, doc_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """第 doc_id 行的非零 (term ids, weights)"""
+        if doc_id + 1 >= len(self.row_indptr):
+            return self.row_terms[:0], self.row_vals[:0]
+        start, end = self.row_indptr[doc_id], self.row_indptr[doc_id + 1]
+        return self.row_terms[start:end], self.row_vals[start:end]
+
+    def matvec(self, term_ids: np.ndarray, weights: np.ndarray, n_docs: int) -> np.ndarray:
+        """返回 X @ q，其中 q 只在 term_ids 上非零"""
+        if len(term_ids) == 0:
+            return np.zeros(n_docs)
+        starts = self.indptr[term_ids]
+        lengths = self.indptr[term_ids + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(n_docs)
+        # 展开所有 query term 的 postings 位置
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        positions = np.arange(total) + offsets
+        contrib = self.vals[positions] * np.repeat(weights, lengths)
+        return np.bincount(self.rows[positions], weights=contrib, minlength=n_docs)
+
+    def subset(self, doc_ids: np.ndarray) -> "_Postings":
+        """只保留 doc_ids 中的行（按 doc_ids 的顺序重新编号）"""
+        coo_docs, coo_terms, coo_vals = self.coo
+        new_ids = np.full(self.n_docs, -1, dtype=np.int64)
+        new_ids[doc_ids] = np.arange(len(doc_ids))
+        keep = new_ids[coo_docs] >= 0
+        return _Postings(new_ids[coo_docs[keep]], coo_terms[keep], coo_vals[keep], self.n_terms, len(doc_ids))
+
+
+class FewShotIndex:
+    """
+    示例池的向量化索引（构建一次，之后只读）。
+    score() 的结果 = 相似度*10 + 共同关键词*0.5 + intent 加分 + 真实转录加分。
+    """
+
+    def __init__(self, examples: Sequence[Dict]):
+        self.examples = examples
+        self.n_docs = len(examples)
+        advisor_texts = [(ex.get("advisor") or "").lower() for ex in examples]
+
+        # 1) 字符 n-gram TF-IDF（行向量 L2 归一化）
+        self.ngram_vocab: Dict[str, int] = {}
+        doc_ids, term_ids, tfs = [], [], []
+        for doc_id, text in enumerate(advisor_texts):
+            for gram, tf in _char_ngrams(text).items():
+                doc_ids.append(doc_id)
+                term_ids.append(self.ngram_vocab.setdefault(gram, len(self.ngram_vocab)))
+                tfs.append(tf)
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_freq = np.bincount(term_ids, minlength=len(self.ngram_vocab))
+        self.idf = np.log((1 + self.n_docs) / (1 + doc_freq)) + 1.0
+        weights = np.asarray(tfs, dtype=np.float64) * self.idf[term_ids]
+        norms = np.sqrt(np.bincount(doc_ids, weights=weights * weights, minlength=self.n_docs))
+        norms[norms == 0] = 1.0
+        self.ngram_postings = _Postings(doc_ids, term_ids, weights / norms[doc_ids], len(self.ngram_vocab),
+                                        self.n_docs)
+
+        # 2) 关键词（去停用词）二值矩阵，用于统计共同关键词个数
+        self.word_vocab: Dict[str, int] = {}
+        doc_ids, term_ids = [], []
+        for doc_id, text in enumerate(advisor_texts):
+            for word in _keywords(text):
+                doc_ids.append(doc_id)
+                term_ids.append(self.word_vocab.setdefault(word, len(self.word_vocab)))
+        self.word_postings = _Postings(
+            np.asarray(doc_ids, dtype=np.int64),
+            np.asarray(term_ids, dtype=np.int64),
+            np.ones(len(doc_ids)),
+            len(self.word_vocab),
+            self.n_docs,
+        )
+
+        # 3) 元数据
+        self.intents_lower = [(ex.get("intent") or "").lower() for ex in examples]
+        self.source_bonus = np.array(
+            [REAL_TRANSCRIPT_BONUS if ex.get("source") == "real_transcript" else 0.0 for ex in examples]
+        )
+        self._intent_bonus_cache: Dict[str, np.ndarray] = {}
+        self._kernel_cache: Dict[int, np.ndarray] = {}
+
+    def subset(self, example_ids: Sequence[int]) -> "FewShotIndex":
+        """
+        只包含 example_ids 的子索引（共享词表和 IDF，打分与全量索引一致）。
+        打分时只触及这部分示例。
+        """
+        ids = np.asarray(example_ids, dtype=np.int64)
+        sub = FewShotIndex.__new__(FewShotIndex)
+        sub.examples = [self.examples[i] for i in ids]
+        sub.n_docs = len(ids)
+        sub.ngram_vocab = self.ngram_vocab
+        sub.idf = self.idf
+        sub.ngram_postings = self.ngram_postings.subset(ids)
+        sub.word_vocab = self.word_vocab
+        sub.word_postings = self.word_postings.subset(ids)
+        sub.intents_lower = [self.intents_lower[i] for i in ids]
+        sub.source_bonus = self.source_bonus[ids]
+        sub._intent_bonus_cache = {}
+        sub._kernel_cache = {}
+        return sub
+
+    def _query_ngram_vector(self, text: str):
+        counts = _char_ngrams(text)
+        term_ids, weights = [], []
+        for gram, tf in counts.items():
+            term_id = self.ngram_vocab.get(gram)
+            if term_id is not None:
+                term_ids.append(term_id)
+                weights.append(tf * self.idf[term_id])
+        weights = np.asarray(weights, dtype=np.float64)
+        norm = np.linalg.norm(weights) or 1.0
+        return np.asarray(term_ids, dtype=np.int64), weights / norm
+
+    def _intent_bonus(self, intent: str) -> np.ndarray:
+        key = intent.lower()
+        bonus = self._intent_bonus_cache.get(key)
+        if bonus is None:
+            bonus = np.array([INTENT_BONUS if ex_intent and key in ex_intent else 0.0
+                              for ex_intent in self.intents_lower])
+            self._intent_bonus_cache[key] = bonus
+        return bonus
+
+    def similarity(self, text: str) -> np.ndarray:
+        """query 与每个示例 advisor 文本的余弦相似度 (0..1)"""
+        term_ids, weights = self._query_ngram_vector(text.lower())
+        return self.ngram_postings.matvec(term_ids, weights, self.n_docs)
+
+    def score(self, advisor_message: str, intent: Optional[str] = None) -> np.ndarray:
+        """对池中所有示例打分（一次稀疏乘法 + 向量化加分）"""
+        advisor_lower = advisor_message.lower()
+        scores = self.similarity(advisor_lower) * SIMILARITY_WEIGHT
+
+        word_ids = np.asarray(
+            [self.word_vocab[w] for w in _keywords(advisor_lower) if w in self.word_vocab], dtype=np.int64
+        )
+        scores += self.word_postings.matvec(word_ids, np.ones(len(word_ids)), self.n_docs) * KEYWORD_WEIGHT
+
+        if intent:
+            scores += self._intent_bonus(intent)
+        scores += self.source_bonus
+        return scores
+
+    def kernel_row(self, doc_id: int) -> np.ndarray:
+        """示例 doc_id 与索引内所有示例的余弦相似度（缓存的相似度核的一行）"""
+        row = self._kernel_cache.get(doc_id)
+        if row is None:
+            term_ids, weights = self.ngram_postings.row(doc_id)
+            row = self.ngram_postings.matvec(term_ids, weights, self.n_docs)
+            if len(self._kernel_cache) >= _KERNEL_CACHE_SIZE:
+                self._kernel_cache.clear()
+            self._kernel_cache[doc_id] = row
+        return row
+
+    def select_diverse(self, scores: np.ndarray, k: int,
+                       relevance_weight: float = MMR_RELEVANCE_WEIGHT,
+                       max_similarity: float = DIVERSITY_MAX_SIMILARITY) -> List[int]:
+        """
+        最大边际相关（MMR）选择 k 个示例：
+        每步选 relevance_weight*相关度 - (1-relevance_weight)*与已选示例的最大相似度 最大者，
+        与已选示例相似度超过 max_similarity 的候选直接跳过。
+        每选一个只需一次稀疏相似度计算，总代价 O(k·n)。
+
+        Returns:
+            选中示例在本索引中的位置（可能少于 k 个）
+        """
+        if self.n_docs == 0 or k <= 0:
+            return []
+        top = scores.max()
+        relevance = scores / top if top > 0 else np.zeros_like(scores)
+        max_sim = np.zeros(self.n_docs)
+        available = np.ones(self.n_docs, dtype=bool)
+        selected: List[int] = []
+
+        while len(selected) < k:
+            mmr = relevance_weight * relevance - (1 - relevance_weight) * max_sim
+            mmr[~available] = -np.inf
+            best = int(np.argmax(mmr))  # 平局时取索引靠前者（保持示例池顺序）
+            if mmr[best] == -np.inf:
+                break
+            selected.append(best)
+            max_sim = np.maximum(max_sim, self.kernel_row(best))
+            available[best] = False
+            available &= max_sim <= max_similarity
+        return selected
+
+
+class PartitionedFewShotIndex:
+    """
+    按 (persona, intent_key) 预先分桶的示例索引。
+    桶在构建时一次算好；每个桶的子索引首次使用时切出并缓存，
+    之后查询只触及相关切片，不再过滤整个示例池。
+    """
+
+    def __init__(self, examples: Sequence[Dict], intent_key_fn: Callable[[str], Optional[Hashable]]):
+        """
+        Args:
+            examples: 示例池
+            intent_key_fn: intent 归一化函数（如 map_intent_to_strategy_key）
+        """
+        self.examples = examples
+        self.intent_key_fn = intent_key_fn
+        self.index = FewShotIndex(examples)
+        self.buckets: Dict[Tuple[Optional[str], Optional[Hashable]], Tuple[int, ...]] = {}
+        self._bucket_indexes: Dict[Tuple, FewShotIndex] = {}
+        self._lock = threading.Lock()
+
+        shared = [i for i, ex in enumerate(examples) if ex.get("source") in SHARED_SOURCES]
+        by_persona: Dict[Optional[str], set] = {None: set()}
+        for i, ex in enumerate(examples):
+            if ex.get("persona"):
+                by_persona.setdefault(ex["persona"].lower(), set()).add(i)
+
+        # persona=None 的桶用于没有专属示例的 persona：只有共享来源（都没有则用全部示例）
+        for persona, own_ids in by_persona.items():
+            ids = sorted(own_ids.union(shared)) or list(range(len(examples)))
+            self.buckets[(persona, None)] = tuple(ids)
+            by_intent: Dict[Hashable, list] = {}
+            for i in ids:
+                key = self._intent_key(examples[i].get("intent"))
+                if key is not None:
+                    by_intent.setdefault(key, []).append(i)
+            for key, intent_ids in by_intent.items():
+                self.buckets[(persona, key)] = tuple(intent_ids)
+
+    def _intent_key(self, intent: Optional[str]) -> Optional[Hashable]:
+        if not intent:
+            return None
+        return self.intent_key_fn(intent) or intent.strip().lower()
+
+    def bucket_key(self, persona: str, intent: Optional[str] = None) -> Tuple:
+        """(persona, intent) -> 桶键；找不到匹配 intent 的桶时退回 persona 桶"""
+        persona_key = persona.lower() if persona else None
+        if (persona_key, None) not in self.buckets:
+            persona_key = None
+        intent_key = self._intent_key(intent)
+        if intent_key is not None and (persona_key, intent_key) in self.buckets:
+            return (persona_key, intent_key)
+        return (persona_key, None)
+
+    def bucket_index(self, key: Tuple) -> FewShotIndex:
+        """桶对应的子索引（首次使用时构建并缓存）"""
+        index = self._bucket_indexes.get(key)
+        if index is None:
+            with self._lock:
+                index = self._bucket_indexes.get(key)
+                if index is None:
+                    index = self.index.subset(self.buckets[key])
+                    self._bucket_indexes[key] = index
+        return index
+
+
+def test_partitioned_index():
+    """分桶子索引自测：桶里最后一个示例没有任何可索引词（空文本 / 全是停用词）"""
+    examples = [
+        {"advisor": "Which robotics courses should I take?", "student": "a", "persona": "beta", "intent": "courses"},
+        {"advisor": "Have you met your faculty mentor?", "student": "b", "persona": "alpha", "intent": "mentor"},
+        {"advisor": "what is the", "student": "c", "persona": "beta", "intent": "courses"},
+        {"advisor": "", "student": "d", "persona": "beta", "intent": "courses"},
+    ]
+    index = PartitionedFewShotIndex(examples, lambda intent: intent)
+    bucket = index.bucket_index(index.bucket_key("beta", "courses"))
+    assert [ex["student"] for ex in bucket.examples] == ["a", "c", "d"]
+    scores = bucket.score("robotics courses", intent="courses")
+    assert scores.shape == (3,) and int(np.argmax(scores)) == 0, scores
+    assert bucket.kernel_row(2).shape == (3,)
+    assert bucket.select_diverse(scores, 2)[0] == 0
+    print("✅ Partitioned few-shot index test passed")
+
+
+if __name__ == "__main__":
+    test_partitioned_index()
@@ -0,0 +1,277 @@
+"""
+On-disk HTTP cache for the UF MAE scraper.
+
+CachingSession is a drop-in requests.Session whose GETs go through a disk cache:
+  - fresh (age < ttl)                  -> served from disk, no network
+  - stale but within stale_while_revalidate
+                                       -> served from disk immediately, revalidated in the background
+  - older / missing                    -> conditional GET (If-None-Match / If-Modified-Since);
+                                          304 refreshes the entry, 200 replaces it
+  - network error with a cached copy   -> stale copy served (stale-if-error)
+
+Each entry is two files in cache_dir: <sha1(url)>.json (url, ETag, Last-Modified,
+fetched_at, headers) and <sha1(url)>.body (raw bytes). Responses carry an
+X-Cache header: HIT, STALE, REVALIDATED, MISS or STALE-IF-ERROR.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_CACHE_DIR = Path(__file__).parent / "data" / ".http_cache"
+DEFAULT_TTL_SEC = 6 * 3600.0
+DEFAULT_STALE_WHILE_REVALIDATE_SEC = 7 * 24 * 3600.0
+# 只缓存这些响应头（其余如 Set-Cookie 不落盘）。存的是已解压的 body，
+# 所以 Content-Encoding / Content-Length 不保存，旧缓存条目里的也在读出时去掉
+_STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+_BODY_HEADERS = ("Content-Encoding", "Content-Length")
+
+
+def _atomic_write(path: Path, data: bytes):
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class CachingSession(requests.Session):
+    """requests.Session with a disk-backed, revalidating cache for GET requests."""
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        ttl_sec: Optional[float] = None,
+        stale_while_revalidate_sec: float = DEFAULT_STALE_WHILE_REVALIDATE_SEC,
+    ):
+        super().__init__()
+        self.cache_dir = Path(cache_dir or os.getenv("UF_SCRAPER_CACHE_DIR") or DEFAULT_CACHE_DIR)
+        if ttl_sec is None:
+            try:
+                ttl_sec = float(os.getenv("UF_SCRAPER_CACHE_TTL", DEFAULT_TTL_SEC))
+            except ValueError:
+                print(f"⚠️ Invalid UF_SCRAPER_CACHE_TTL, using {DEFAULT_TTL_SEC}")
+                ttl_sec = DEFAULT_TTL_SEC
+        self.ttl_sec = float(ttl_sec)
+        self.stale_while_revalidate_sec = stale_while_revalidate_sec
+        self._lock = threading.Lock()
+        self._revalidating = set()
+        self.stats = {"hits": 0, "stale": 0, "revalidated": 0, "misses": 0, "stale_if_error": 0}
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            print(f"⚠️ Warning: HTTP cache dir not writable ({self.cache_dir}): {e}")
+
+    # ---- storage ----
+    def _paths(self, url: str):
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{digest}.json", self.cache_dir / f"{digest}.body"
+
+    def _load_entry(self, url: str) -> Optional[Dict]:
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            meta["body"] = body_path.read_bytes()
+            return meta
+        except (OSError, ValueError):
+            return None
+
+    def _store_entry(self, url: str, response: requests.Response) -> Dict:
+        meta = {
+            "url": url,
+            "fetched_at": time.time(),
+            "headers": {k: response.headers[k] for k in _STORED_HEADERS if k in response.headers},
+            "encoding": response.encoding,
+        }
+        meta_path, body_path = self._paths(url)
+        try:
+            _atomic_write(body_path, response.content)
+            _atomic_write(meta_path, json.dumps(meta).encode("utf-8"))
+        except OSError as e:
+            print(f"⚠️ Warning: Could not write HTTP cache entry for {url}: {e}")
+        meta["body"] = response.content
+        return meta
+
+    def _touch_entry(self, url: str, entry: Dict, response: requests.Response) -> Dict:
+        """304 Not Modified: keep the body, refresh fetched_at and validators."""
+        entry = dict(entry)
+        entry["fetched_at"] = time.time()
+        headers = dict(entry.get("headers", {}))
+        for k in ("ETag", "Last-Modified"):
+            if k in response.headers:
+                headers[k] = response.headers[k]
+        entry["headers"] = headers
+        meta_path, _ = self._paths(url)
+        try:
+            _atomic_write(meta_path, json.dumps({k: v for k, v in entry.items() if k != "body"}).encode("utf-8"))
+        except OSError as e:
+            print(f"⚠️ Warning: Could not update HTTP cache entry for {url}: {e}")
+        return entry
+
+    # ---- response helpers ----
+    @staticmethod
+    def _to_response(url: str, entry: Dict, cache_status: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = entry["body"]
+        response.headers = CaseInsensitiveDict(
+            {k: v for k, v in entry.get("headers", {}).items() if k not in _BODY_HEADERS})
+        response.headers["X-Cache"] = cache_status
+        response.encoding = entry.get("encoding")
+        response.reason = "OK"
+        return response
+
+    @staticmethod
+    def _conditional_headers(entry: Optional[Dict]) -> Dict[str, str]:
+        if not entry:
+            return {}
+        headers = {}
+        stored = entry.get("headers", {})
+        if stored.get("ETag"):
+            headers["If-None-Match"] = stored["ETag"]
+        if stored.get("Last-Modified"):
+            headers["If-Modified-Since"] = stored["Last-Modified"]
+        return headers
+
+    def _fetch(self, url: str, entry: Optional[Dict], session: requests.Session, **kwargs) -> requests.Response:
+        """Conditional GET; updates the cache and returns a response for the caller."""
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers.update(self._conditional_headers(entry))
+        response = session.request("GET", url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry:
+            entry = self._touch_entry(url, entry, response)
+            self.stats["revalidated"] += 1
+            return self._to_response(url, entry, "REVALIDATED")
+        if response.status_code == 200:
+            self._store_entry(url, response)
+            response.headers["X-Cache"] = "MISS"
+        self.stats["misses"] += 1
+        return response
+
+    def _revalidate_in_background(self, url: str, entry: Dict, kwargs: Dict):
+        with self._lock:
+            if url in self._revalidating:
+                return
+            self._revalidating.add(url)
+
+        def worker():
+            # 后台线程用独立的 Session，避免和前台请求共享连接状态
+            session = requests.Session()
+            session.headers.update(self.headers)
+            try:
+                self._fetch(url, entry, session, **kwargs)
+            except Exception as e:
+                print(f"⚠️ Background revalidation failed for {url}: {e}")
+            finally:
+                session.close()
+                with self._lock:
+                    self._revalidating.discard(url)
+
+        threading.Thread(target=worker, name="http-cache-revalidate", daemon=True).start()
+
+    # ---- requests.Session API ----
+    def request(self, method, url, *args, **kwargs):
+        if str(method).upper() != "GET" or args or kwargs.get("stream") or kwargs.get("params"):
+            return super().request(method, url, *args, **kwargs)
+
+        entry = self._load_entry(url)
+        age = time.time() - entry["fetched_at"] if entry else None
+
+        if entry and age < self.ttl_sec:
+            self.stats["hits"] += 1
+            return self._to_response(url, entry, "HIT")
+
+        if entry and age < self.ttl_sec + self.stale_while_revalidate_sec:
+            self.stats["stale"] += 1
+            self._revalidate_in_background(url, entry, dict(kwargs))
+            return self._to_response(url, entry, "STALE")
+
+        try:
+            return self._fetch(url, entry, super(), **kwargs)
+        except requests.RequestException as e:
+            if entry:
+                print(f"⚠️ {url} unreachable, serving cached copy: {e}")
+                self.stats["stale_if_error"] += 1
+                return self._to_response(url, entry, "STALE-IF-ERROR")
+            raise
+
+
+def test_caching_session():
+    """HIT / STALE + 后台刷新 / 304 条件请求 / 响应头 自测（本地 fixture 服务器）"""
+    import gzip
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    body = b"<html>MAE course schedule</html>"
+    seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            not_modified = self.headers.get("If-None-Match") == '"v1"'
+            seen.append(304 if not_modified else 200)
+            self.send_response(304 if not_modified else 200)
+            self.send_header("ETag", '"v1"')
+            if not not_modified:
+                payload = gzip.compress(body)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if not not_modified:
+                self.wfile.write(payload)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/schedule"
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            session = CachingSession(tmp, ttl_sec=60, stale_while_revalidate_sec=60)
+            first = session.get(url, timeout=5)
+            assert first.headers["X-Cache"] == "MISS" and first.content == body
+            hit = session.get(url, timeout=5)
+            assert hit.headers["X-Cache"] == "HIT" and hit.content == body and seen == [200]
+            assert "Content-Encoding" not in hit.headers and "Content-Length" not in hit.headers
+
+            session.ttl_sec = 0  # 过期但仍在 stale-while-revalidate 窗口内
+            stale = session.get(url, timeout=5)
+            assert stale.headers["X-Cache"] == "STALE" and stale.content == body
+            for _ in range(100):
+                if not session._revalidating and len(seen) == 2:
+                    break
+                time.sleep(0.01)
+            assert seen == [200, 304], seen  # 后台条件请求
+
+            session.stale_while_revalidate_sec = 0
+            revalidated = session.get(url, timeout=5)
+            assert revalidated.headers["X-Cache"] == "REVALIDATED" and revalidated.content == body
+            assert seen == [200, 304, 304], seen
+            assert session.stats["hits"] == 1 and session.stats["stale"] == 1 and session.stats["revalidated"] == 2
+            session.close()
+
+            os.environ["UF_SCRAPER_CACHE_TTL"] = "6h"  # 写错的配置不能让 get_shared_scraper() 崩掉
+            try:
+                assert CachingSession(tmp).ttl_sec == DEFAULT_TTL_SEC
+            finally:
+                del os.environ["UF_SCRAPER_CACHE_TTL"]
+        print("✅ Caching session test passed", session.stats)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    test_caching_session()
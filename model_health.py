@@ -0,0 +1,306 @@
+"""
+Process-wide health scoreboard for UF LiteLLM models.
+
+Every generate_chat call reports its outcome here. The registry keeps a rolling
+window of results per model (error rate, p50/p95 latency) and a circuit breaker:
+after `failure_threshold` consecutive retryable failures ("meta tensor", "model
+not found", ...) the model is skipped for `cooldown_sec`. Then one half-open probe
+request is let through. If the probe succeeds the breaker closes again; if it fails
+the breaker re-opens.
+
+Routing keeps the configured (quality-first) order of UF_MODEL_FALLBACKS. A model
+is only moved back when it is clearly worse: its breaker is open, most of its
+recent calls failed, or its recent p50 latency is more than `slow_factor` times
+(and `slow_margin_sec` seconds above) the fastest healthy model.
+
+    registry = get_model_health_registry()
+    for model in registry.ordered_models(UF_MODEL_FALLBACKS):
+        if not registry.allow_request(model):
+            continue
+        ...
+"""
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_WINDOW = 50
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_COOLDOWN_SEC = 60.0
+# 错误率超过这个值的模型排到健康模型后面
+UNHEALTHY_ERROR_RATE = 0.5
+# 排序只看最近这段时间的调用，过期后模型重新按配置顺序参与
+DEFAULT_RECENT_SEC = 300.0
+# 比最快的健康模型慢 4 倍以上且多出 5 秒以上才降级（质量优先，不追求最快）
+DEFAULT_SLOW_FACTOR = 4.0
+DEFAULT_SLOW_MARGIN_SEC = 5.0
+
+
+def _percentile(sorted_values: Sequence[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+
+class _ModelHealth:
+    """Rolling outcome window + breaker state for one model."""
+
+    def __init__(self, window: int):
+        self.outcomes: Deque[Tuple[bool, float, float]] = deque(maxlen=window)  # (ok, latency, at)
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at: Optional[float] = None
+
+    def _window(self, since: Optional[float]) -> List[Tuple[bool, float, float]]:
+        if since is None:
+            return list(self.outcomes)
+        return [outcome for outcome in self.outcomes if outcome[2] >= since]
+
+    def error_rate(self, since: Optional[float] = None) -> float:
+        outcomes = self._window(since)
+        if not outcomes:
+            return 0.0
+        return sum(1 for ok, _, _ in outcomes if not ok) / len(outcomes)
+
+    def latencies(self, since: Optional[float] = None) -> List[float]:
+        return sorted(latency for ok, latency, _ in self._window(since) if ok)
+
+
+class ModelHealthRegistry:
+    """Thread-safe health scoreboard and circuit breaker, keyed by model name."""
+
+    def __init__(
+        self,
+        window: int = DEFAULT_WINDOW,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        cooldown_sec: float = DEFAULT_COOLDOWN_SEC,
+        recent_sec: float = DEFAULT_RECENT_SEC,
+        slow_factor: float = DEFAULT_SLOW_FACTOR,
+        slow_margin_sec: float = DEFAULT_SLOW_MARGIN_SEC,
+    ):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.cooldown_sec = cooldown_sec
+        self.recent_sec = recent_sec
+        self.slow_factor = slow_factor
+        self.slow_margin_sec = slow_margin_sec
+        self._models: Dict[str, _ModelHealth] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model: str) -> _ModelHealth:
+        health = self._models.get(model)
+        if health is None:
+            health = self._models[model] = _ModelHealth(self.window)
+        return health
+
+    def _refresh_state(self, health: _ModelHealth, now: float):
+        """OPEN -> HALF_OPEN once the cooldown has elapsed; expire a probe that never reported back."""
+        if health.state == OPEN and now - health.opened_at >= self.cooldown_sec:
+            health.state = HALF_OPEN
+            health.probe_started_at = None
+        elif (health.state == HALF_OPEN and health.probe_started_at is not None
+              and now - health.probe_started_at >= self.cooldown_sec):
+            health.probe_started_at = None
+
+    # ---- reporting ----
+    def record_success(self, model: str, latency: float):
+        with self._lock:
+            health = self._get(model)
+            health.outcomes.append((True, latency, time.monotonic()))
+            health.consecutive_failures = 0
+            health.state = CLOSED
+            health.probe_started_at = None
+
+    def record_failure(self, model: str, latency: float, retryable: bool = True):
+        """
+        Record a failed call. Only retryable (model-side) failures count towards
+        tripping the breaker; empty replies and auth/network errors only affect the
+        error rate.
+        """
+        with self._lock:
+            health = self._get(model)
+            health.outcomes.append((False, latency, time.monotonic()))
+            if not retryable:
+                if health.state == HALF_OPEN:
+                    health.probe_started_at = None
+                return
+            health.consecutive_failures += 1
+            if health.state == HALF_OPEN or health.consecutive_failures >= self.failure_threshold:
+                if health.state != OPEN:
+                    print(f"⚠️ Model {model} circuit opened after {health.consecutive_failures} failures")
+                health.state = OPEN
+                health.opened_at = time.monotonic()
+                health.probe_started_at = None
+
+    # ---- routing ----
+    def allow_request(self, model: str) -> bool:
+        """
+        True if a request may be sent to `model` now. A half-open model admits a
+        single probe at a time.
+        """
+        with self._lock:
+            health = self._get(model)
+            now = time.monotonic()
+            self._refresh_state(health, now)
+            if health.state == CLOSED:
+                return True
+            if health.state == HALF_OPEN and health.probe_started_at is None:
+                health.probe_started_at = now
+                return True
+            return False
+
+    def ordered_models(self, models: Sequence[str], preferred: Optional[str] = None) -> List[str]:
+        """
+        Fallback order for this request:
+        1. preferred model (unless its breaker is open)
+        2. half-open models due for a recovery probe
+        3. healthy models, in the configured order (models without recent data count as healthy)
+        4. healthy models that are much slower than the fastest one (see slow_factor / slow_margin_sec)
+        5. closed models whose recent error rate is high
+        Open models are left out, unless every model is open (then the original order is returned).
+        """
+        candidates = [preferred] if preferred else []
+        candidates.extend(m for m in models if m != preferred)
+
+        with self._lock:
+            now = time.monotonic()
+            since = now - self.recent_sec
+            probes, healthy, degraded = [], [], []
+            for model in candidates:
+                health = self._get(model)
+                self._refresh_state(health, now)
+                if health.state == OPEN:
+                    continue
+                if model == preferred:
+                    continue
+                if health.state == HALF_OPEN:
+                    probes.append(model)
+                    continue
+                if health.error_rate(since) > UNHEALTHY_ERROR_RATE:
+                    degraded.append(model)
+                else:
+                    healthy.append((model, _percentile(health.latencies(since), 0.5)))
+            preferred_ok = bool(preferred) and self._get(preferred).state != OPEN
+
+        measured = [p50 for _, p50 in healthy if p50 is not None]
+        fastest = min(measured) if measured else None
+
+        def is_slow(p50: Optional[float]) -> bool:
+            return (p50 is not None and fastest is not None
+                    and p50 > fastest * self.slow_factor and p50 - fastest > self.slow_margin_sec)
+
+        ordered = ([preferred] if preferred_ok else []) + probes
+        ordered.extend(model for model, p50 in healthy if not is_slow(p50))
+        ordered.extend(model for model, p50 in healthy if is_slow(p50))
+        ordered.extend(degraded)
+        return ordered or candidates
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        """Scoreboard: state, calls, error rate and p50/p95 latency per model."""
+        with self._lock:
+            now = time.monotonic()
+            board = {}
+            for model, health in self._models.items():
+                self._refresh_state(health, now)
+                latencies = health.latencies()
+                board[model] = {
+                    "state": health.state,
+                    "calls": len(health.outcomes),
+                    "error_rate": round(health.error_rate(), 3),
+                    "p50_latency": _percentile(latencies, 0.5),
+                    "p95_latency": _percentile(latencies, 0.95),
+                    "consecutive_failures": health.consecutive_failures,
+                }
+            return board
+
+    def reset(self):
+        with self._lock:
+            self._models.clear()
+
+
+_REGISTRY: Optional[ModelHealthRegistry] = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def _env_number(name: str, default):
+    """Env setting parsed like ``default`` (int / float); a malformed value falls back to it."""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return type(default)(value)
+    except ValueError:
+        print(f"⚠️ Invalid {name}={value!r}, using {default}")
+        return default
+
+
+def get_model_health_registry() -> ModelHealthRegistry:
+    """Process-wide registry shared by every UFNavigatorAPI client and Streamlit session."""
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            _REGISTRY = ModelHealthRegistry(
+                failure_threshold=_env_number("UF_MODEL_BREAKER_THRESHOLD", DEFAULT_FAILURE_THRESHOLD),
+                cooldown_sec=_env_number("UF_MODEL_BREAKER_COOLDOWN", DEFAULT_COOLDOWN_SEC),
+            )
+        return _REGISTRY
+
+
+def test_circuit_breaker():
+    """熔断 / 半开探测 / 排序 自测"""
+    registry = ModelHealthRegistry(failure_threshold=2, cooldown_sec=0.05)
+    models = ["big", "medium", "small"]
+
+    registry.record_success("medium", 0.9)
+    registry.record_success("small", 0.2)
+    assert registry.ordered_models(models) == models  # 都健康时保持配置顺序
+    for model in models:
+        registry.record_success(model, {"big": 2.0, "medium": 1.0, "small": 0.3}[model])
+    assert registry.ordered_models(models) == models
+
+    slow = ModelHealthRegistry(slow_factor=2.0, slow_margin_sec=1.0)
+    slow.record_success("big", 9.0)
+    slow.record_success("small", 0.5)
+    assert slow.ordered_models(models) == ["medium", "small", "big"]  # 明显过慢才降级
+    slow.record_failure("medium", 0.1, retryable=False)
+    assert slow.ordered_models(models) == ["small", "big", "medium"]
+
+    registry.record_failure("big", 0.1)
+    assert registry.allow_request("big")
+    registry.record_failure("big", 0.1)
+    assert not registry.allow_request("big")
+    assert registry.ordered_models(models) == ["medium", "small"]
+    assert registry.ordered_models(models, preferred="big") == ["medium", "small"]
+
+    time.sleep(0.06)
+    assert registry.ordered_models(models)[0] == "big"  # due for a probe
+    assert registry.allow_request("big")
+    assert not registry.allow_request("big")  # only one probe at a time
+    registry.record_failure("big", 0.1)
+    assert registry.snapshot()["big"]["state"] == OPEN
+
+    time.sleep(0.06)
+    assert registry.allow_request("big")
+    registry.record_success("big", 0.5)
+    assert registry.snapshot()["big"]["state"] == CLOSED
+
+    # 配置写错不能让第一次调用崩掉
+    os.environ["UF_MODEL_BREAKER_THRESHOLD"], os.environ["UF_MODEL_BREAKER_COOLDOWN"] = "three", "2.5"
+    try:
+        assert _env_number("UF_MODEL_BREAKER_THRESHOLD", DEFAULT_FAILURE_THRESHOLD) == DEFAULT_FAILURE_THRESHOLD
+        assert _env_number("UF_MODEL_BREAKER_COOLDOWN", DEFAULT_COOLDOWN_SEC) == 2.5
+    finally:
+        del os.environ["UF_MODEL_BREAKER_THRESHOLD"], os.environ["UF_MODEL_BREAKER_COOLDOWN"]
+    print("✅ Circuit breaker test passed")
+    print(registry.snapshot())
+
+
+if __name__ == "__main__":
+    test_circuit_breaker()
@@ -0,0 +1,199 @@
+"""
+Background warm pool of student opening messages.
+
+Generating an opening (KB search + live website search + LLM fallback loop)
+takes seconds. A daemon worker keeps `target_size` ready-made openings per
+persona, so "Start Conversation" can pop one instantly. The pool is shared by
+every Streamlit session in the process; a popped opening is never handed out twice.
+
+    pool = get_opening_pool(generate_fn, personas=["alpha", "beta", "delta", "echo"])
+    opening = pool.pop("beta")   # None when the pool for that persona is empty
+"""
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, Optional
+
+DEFAULT_POOL_SIZE = 3
+# 生成失败（API 不可用等）后的退避时间，避免后台线程一直打失败的 API
+MIN_BACKOFF_SEC = 15.0
+MAX_BACKOFF_SEC = 300.0
+
+
+class OpeningWarmPool:
+    """Per-persona queues of openings, refilled by one daemon worker thread."""
+
+    def __init__(
+        self,
+        generate_fn: Callable[[str], Optional[str]],
+        personas: Iterable[str],
+        target_size: int = DEFAULT_POOL_SIZE,
+    ):
+        """
+        Args:
+            generate_fn: persona -> opening text (None/empty on failure); called on the worker thread
+            personas: persona keys to keep warm
+            target_size: openings kept ready per persona
+        """
+        self.generate_fn = generate_fn
+        self.target_size = target_size
+        self._pools: Dict[str, Deque[str]] = {p: deque() for p in personas}
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._stopped = False
+        self._backoff = 0.0
+        self.stats = {"generated": 0, "duplicates": 0, "failed": 0, "served": 0, "empty": 0}
+
+    def start(self) -> "OpeningWarmPool":
+        with self._cond:
+            if self._worker is None or not self._worker.is_alive():
+                self._stopped = False
+                self._worker = threading.Thread(target=self._run, name="opening-warm-pool", daemon=True)
+                self._worker.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def pop(self, persona: str) -> Optional[str]:
+        """Take a ready opening for `persona` without blocking; wakes the worker to refill."""
+        with self._cond:
+            pool = self._pools.get(persona)
+            if pool:
+                self.stats["served"] += 1
+                opening = pool.popleft()
+            else:
+                self.stats["empty"] += 1
+                opening = None
+            self._cond.notify_all()
+            return opening
+
+    def sizes(self) -> Dict[str, int]:
+        with self._cond:
+            return {persona: len(pool) for persona, pool in self._pools.items()}
+
+    def _next_persona(self) -> Optional[str]:
+        """Persona with the fewest ready openings below target (caller holds the lock)."""
+        hungry = [(len(pool), persona) for persona, pool in self._pools.items() if len(pool) < self.target_size]
+        return min(hungry)[1] if hungry else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and self._next_persona() is None:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                persona = self._next_persona()
+
+            try:
+                opening = self.generate_fn(persona)
+            except Exception as e:
+                print(f"⚠️ Opening pool generation failed for {persona}: {e}")
+                opening = None
+
+            with self._cond:
+                pool = self._pools[persona]
+                opening = (opening or "").strip()
+                if opening:
+                    # 与池中已有的重复：正常结果，直接丢弃，不退避
+                    if opening in pool:
+                        self.stats["duplicates"] += 1
+                    else:
+                        pool.append(opening)
+                        self.stats["generated"] += 1
+                    self._backoff = 0.0
+                    continue
+                self.stats["failed"] += 1
+                self._backoff = min(MAX_BACKOFF_SEC, max(MIN_BACKOFF_SEC, self._backoff * 2))
+                backoff = self._backoff
+                # pop() 会 notify，但失败后仍按退避时间等待再重试
+                deadline = time.monotonic() + backoff
+                while not self._stopped and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+                if self._stopped:
+                    return
+
+
+_OPENING_POOL: Optional[OpeningWarmPool] = None
+_OPENING_POOL_LOCK = threading.Lock()
+
+
+def get_opening_pool(
+    generate_fn: Callable[[str], Optional[str]],
+    personas: Iterable[str],
+    target_size: Optional[int] = None,
+) -> OpeningWarmPool:
+    """
+    Process-wide pool, created and started on first call (later calls ignore the
+    arguments). Pool size: target_size or env UF_OPENING_POOL_SIZE (default 3).
+    """
+    global _OPENING_POOL
+    with _OPENING_POOL_LOCK:
+        if _OPENING_POOL is None:
+            if target_size is None:
+                try:
+                    target_size = int(os.getenv("UF_OPENING_POOL_SIZE", DEFAULT_POOL_SIZE))
+                except ValueError:
+                    print(f"⚠️ Invalid UF_OPENING_POOL_SIZE, using {DEFAULT_POOL_SIZE}")
+                    target_size = DEFAULT_POOL_SIZE
+            _OPENING_POOL = OpeningWarmPool(generate_fn, personas, target_size).start()
+        return _OPENING_POOL
+
+
+def test_opening_pool():
+    """后台补货 / pop 自测"""
+    counter = {"n": 0}
+
+    def fake_generate(persona):
+        counter["n"] += 1
+        time.sleep(0.01)
+        return f"{persona} opening #{counter['n']}"
+
+    pool = OpeningWarmPool(fake_generate, ["alpha", "beta"], target_size=2).start()
+    deadline = time.monotonic() + 2
+    while pool.sizes() != {"alpha": 2, "beta": 2} and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool.sizes() == {"alpha": 2, "beta": 2}, pool.sizes()
+
+    first = pool.pop("alpha")
+    assert first and first.startswith("alpha")
+    time.sleep(0.1)
+    assert pool.sizes()["alpha"] == 2  # refilled in the background
+    assert pool.pop("gamma") is None   # unknown persona -> empty, caller falls back
+    pool.stop()
+
+    # 重复的开场白直接丢弃，不触发失败退避
+    calls = {"n": 0}
+
+    def repetitive_generate(persona):
+        calls["n"] += 1
+        return "same opening" if calls["n"] <= 3 else f"opening #{calls['n']}"
+
+    dup_pool = OpeningWarmPool(repetitive_generate, ["alpha"], target_size=2).start()
+    deadline = time.monotonic() + 2
+    while dup_pool.sizes() != {"alpha": 2} and time.monotonic() < deadline:
+        time.sleep(0.01)
+    dup_pool.stop()
+    assert dup_pool.sizes() == {"alpha": 2}, dup_pool.stats
+    assert dup_pool.stats["duplicates"] == 2 and dup_pool.stats["failed"] == 0, dup_pool.stats
+
+    # 环境变量写错：回退默认大小，不让第一次取开场白时抛异常
+    global _OPENING_POOL
+    saved, _OPENING_POOL = _OPENING_POOL, None
+    os.environ["UF_OPENING_POOL_SIZE"] = "three"
+    try:
+        env_pool = get_opening_pool(fake_generate, ["alpha"])
+        assert env_pool.target_size == DEFAULT_POOL_SIZE
+        env_pool.stop()
+    finally:
+        del os.environ["UF_OPENING_POOL_SIZE"]
+        _OPENING_POOL = saved
+    print("✅ Opening pool test passed", pool.stats, dup_pool.stats)
+
+
+if __name__ == "__main__":
+    test_opening_pool()
@@ -0,0 +1,108 @@
+"""
+Passage chunking for crawled pages and knowledge items.
+
+A page is split into overlapping windows of whole lines (about max_tokens each;
+the last ~overlap_tokens of a window are repeated at the start of the next one),
+so a retrieval hit carries only the relevant part of the page instead of the
+whole 2,000-char blob. Lines longer than a window are split on sentence and
+then word boundaries.
+
+    passages = chunk_lines(page_lines)            # List[str]
+    estimate_tokens("How do I apply?")            # 5
+"""
+import re
+from typing import List
+
+DEFAULT_PASSAGE_TOKENS = 120
+DEFAULT_OVERLAP_TOKENS = 30
+
+# 近似 BPE 分词：单词 / 数字 / 单个标点各算一个 token
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate LLM token count (words and punctuation marks)."""
+    return len(_TOKEN_RE.findall(text or ""))
+
+
+def _split_long_line(line: str, max_tokens: int) -> List[str]:
+    """Break one over-long line into pieces of at most max_tokens (sentences first, then words)."""
+    pieces, current, current_tokens = [], [], 0
+    for sentence in _SENTENCE_RE.split(line):
+        units = [sentence] if estimate_tokens(sentence) <= max_tokens else sentence.split()
+        for unit in units:
+            tokens = estimate_tokens(unit)
+            if current and current_tokens + tokens > max_tokens:
+                pieces.append(" ".join(current))
+                current, current_tokens = [], 0
+            current.append(unit)
+            current_tokens += tokens
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def chunk_lines(
+    lines: List[str],
+    max_tokens: int = DEFAULT_PASSAGE_TOKENS,
+    overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+) -> List[str]:
+    """Overlapping passages of consecutive lines, each about max_tokens long."""
+    units = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if estimate_tokens(line) > max_tokens:
+            units.extend(_split_long_line(line, max_tokens))
+        else:
+            units.append(line)
+    if not units:
+        return []
+
+    counts = [estimate_tokens(unit) for unit in units]
+    passages = []
+    start = 0
+    while start < len(units):
+        end, total = start, 0
+        while end < len(units) and (end == start or total + counts[end] <= max_tokens):
+            total += counts[end]
+            end += 1
+        passages.append("\n".join(units[start:end]))
+        if end >= len(units):
+            break
+        # 下一个窗口从末尾若干行开始（不超过 overlap_tokens），且至少前进一行
+        next_start, overlap = end, 0
+        while next_start - 1 > start and overlap + counts[next_start - 1] <= overlap_tokens:
+            next_start -= 1
+            overlap += counts[next_start]
+        start = next_start
+    return passages
+
+
+def chunk_text(
+    text: str,
+    max_tokens: int = DEFAULT_PASSAGE_TOKENS,
+    overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+) -> List[str]:
+    return chunk_lines((text or "").splitlines(), max_tokens, overlap_tokens)
+
+
+def test_chunk_lines():
+    """分块 / 重叠 自测"""
+    lines = [f"Line {i}: the MAE department offers advising for course planning." for i in range(20)]
+    passages = chunk_lines(lines, max_tokens=40, overlap_tokens=12)
+    assert all(estimate_tokens(p) <= 40 for p in passages), [estimate_tokens(p) for p in passages]
+    for first, second in zip(passages, passages[1:]):
+        assert first.splitlines()[-1] == second.splitlines()[0]  # 相邻窗口有重叠
+    assert passages[-1].splitlines()[-1] == lines[-1]
+
+    long_line = "Word " * 100
+    assert all(estimate_tokens(p) <= 40 for p in chunk_lines([long_line], max_tokens=40))
+    assert chunk_text("") == []
+    print(f"✅ Passage chunker test passed ({len(passages)} passages)")
+
+
+if __name__ == "__main__":
+    test_chunk_lines()
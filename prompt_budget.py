@@ -0,0 +1,264 @@
+"""
+Token-budgeted prompt assembly for student replies.
+
+Each trimmable part of the prompt is a PromptSection of items (history lines,
+KB passages, few-shot examples) with a per-item token cost. PromptAssembler
+renders the messages, measures them, and while the total is over budget it drops
+items by section priority:
+  1. oldest conversation history lines (the latest exchange is kept)
+  2. lowest-ranked knowledge passages (items are best-first)
+  3. extra few-shot examples (the best one is kept)
+Then it re-renders and reports a per-section token breakdown.
+
+Tokens are counted with tiktoken (cl100k_base) when it is installed and its
+encoding file is already in tiktoken's local cache, else with a word/punctuation
+approximation. The file is never downloaded on the reply path; cache it at deploy
+time with `python prompt_budget.py cache-encoding`.
+
+    assembler = PromptAssembler(render, [history, knowledge, examples], budget=2500)
+    messages, breakdown = assembler.assemble()
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from passage_chunker import estimate_tokens
+
+DEFAULT_PROMPT_TOKEN_BUDGET = 2500
+# 每条 chat message 的固定开销（role / 分隔符）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 最多按“测量 → 裁剪 → 重新渲染”循环几次（估算与实际渲染有偏差时收敛用）
+MAX_ASSEMBLE_ROUNDS = 4
+
+TIKTOKEN_ENCODING = "cl100k_base"
+_TIKTOKEN_BLOB_URL = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+
+_ENCODING = None
+_ENCODING_LOADED = False
+_ENCODING_LOCK = threading.Lock()
+
+
+def _tiktoken_cache_path() -> Optional[str]:
+    """Where tiktoken caches the encoding file (same lookup as tiktoken.load); None if caching is off."""
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["TIKTOKEN_CACHE_DIR"]
+    elif "DATA_GYM_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["DATA_GYM_CACHE_DIR"]
+    else:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, hashlib.sha1(_TIKTOKEN_BLOB_URL.encode()).hexdigest())
+
+
+def _get_encoding():
+    global _ENCODING, _ENCODING_LOADED
+    with _ENCODING_LOCK:
+        if not _ENCODING_LOADED:
+            _ENCODING_LOADED = True
+            _ENCODING = None
+            try:
+                import tiktoken
+            except ImportError:
+                return None
+            # 编码文件不在本地缓存时 tiktoken 会在这里联网下载（无超时，且持有锁）→ 不用它，走近似计数
+            cache_path = _tiktoken_cache_path()
+            if cache_path is None or not os.path.exists(cache_path):
+                print(f"⚠️ tiktoken encoding {TIKTOKEN_ENCODING} is not cached locally, using approximate "
+                      f"token counts (run: python prompt_budget.py cache-encoding)")
+                return None
+            try:
+                _ENCODING = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+            except Exception as e:
+                print(f"⚠️ Failed to load tiktoken encoding {TIKTOKEN_ENCODING}: {e}")
+                _ENCODING = None
+        return _ENCODING
+
+
+def cache_encoding() -> bool:
+    """Download the tiktoken encoding into its local cache (deploy time, not on the reply path)."""
+    global _ENCODING_LOADED
+    try:
+        import tiktoken
+        tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception as e:
+        print(f"⚠️ Could not cache tiktoken encoding {TIKTOKEN_ENCODING}: {e}")
+        return False
+    with _ENCODING_LOCK:
+        _ENCODING_LOADED = False
+    return True
+
+
+def tokenizer_name() -> str:
+    return f"tiktoken:{TIKTOKEN_ENCODING}" if _get_encoding() is not None else "approx"
+
+
+def count_tokens(text: str) -> int:
+    """Token count of `text` (tiktoken if available, else approximate)."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def count_message_tokens(messages: Sequence[Dict[str, str]]) -> int:
+    return sum(count_tokens(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+class PromptSection:
+    """An ordered list of droppable prompt items."""
+
+    def __init__(self, name: str, items: Sequence[str], drop_from: str = "end", min_keep: int = 0,
+                 costs: Optional[Sequence[int]] = None):
+        """
+        Args:
+            name: section name used in the breakdown
+            items: item texts in prompt order
+            drop_from: "start" drops the first items first (oldest history), "end" the last (lowest ranked)
+            min_keep: items that are never dropped
+            costs: token cost per item (default: count_tokens of each item + 1 separator)
+        """
+        self.name = name
+        self.items = list(items)
+        self.drop_from = drop_from
+        self.min_keep = min_keep
+        self.costs = list(costs) if costs is not None else [count_tokens(item) + 1 for item in self.items]
+        self.start, self.end = 0, len(self.items)
+
+    def kept(self) -> List[str]:
+        return self.items[self.start:self.end]
+
+    def kept_tokens(self) -> int:
+        return sum(self.costs[self.start:self.end])
+
+    @property
+    def dropped(self) -> int:
+        return len(self.items) - (self.end - self.start)
+
+    def drop_one(self) -> int:
+        """Drop one item; returns the tokens freed (0 when nothing more may be dropped)."""
+        if self.end - self.start <= self.min_keep:
+            return 0
+        if self.drop_from == "start":
+            self.start += 1
+            return self.costs[self.start - 1]
+        self.end -= 1
+        return self.costs[self.end]
+
+
+class PromptAssembler:
+    """Renders messages from the kept section items and trims them to the token budget."""
+
+    def __init__(
+        self,
+        render: Callable[[Dict[str, List[str]]], List[Dict[str, str]]],
+        sections: Sequence[PromptSection],
+        budget: int = DEFAULT_PROMPT_TOKEN_BUDGET,
+    ):
+        """
+        Args:
+            render: kept items per section name -> chat messages
+            sections: sections in trim priority order (first is trimmed first)
+            budget: max total prompt tokens (<= 0 disables trimming)
+        """
+        self.render = render
+        self.sections = list(sections)
+        self.budget = budget
+
+    def _kept(self) -> Dict[str, List[str]]:
+        return {section.name: section.kept() for section in self.sections}
+
+    def assemble(self) -> Tuple[List[Dict[str, str]], Dict[str, object]]:
+        messages = self.render(self._kept())
+        total = count_message_tokens(messages)
+        original_total = total
+        for _ in range(MAX_ASSEMBLE_ROUNDS):
+            if self.budget <= 0 or total <= self.budget:
+                break
+            excess, freed = total - self.budget, 0
+            for section in self.sections:
+                while freed < excess:
+                    tokens = section.drop_one()
+                    if not tokens:
+                        break
+                    freed += tokens
+                if freed >= excess:
+                    break
+            if not freed:
+                break
+            messages = self.render(self._kept())
+            total = count_message_tokens(messages)
+
+        section_tokens = {section.name: section.kept_tokens() for section in self.sections}
+        breakdown: Dict[str, object] = {
+            "total": total,
+            "budget": self.budget,
+            "untrimmed_total": original_total,
+            "sections": section_tokens,
+            "fixed": max(0, total - sum(section_tokens.values())),
+            "dropped": {section.name: section.dropped for section in self.sections},
+            "over_budget": self.budget > 0 and total > self.budget,
+            "tokenizer": tokenizer_name(),
+        }
+        return messages, breakdown
+
+
+def test_prompt_assembler():
+    """按优先级裁剪 / 明细 自测"""
+    history = PromptSection("history", [f"Student: old message number {i} " * 3 for i in range(10)],
+                            drop_from="start", min_keep=2)
+    knowledge = PromptSection("knowledge", [f"Passage {i}: " + "robotics lab details " * 10 for i in range(4)])
+    examples = PromptSection("examples", ["Example A: advisor and student " * 5, "Example B: " * 20], min_keep=1)
+
+    def render(kept):
+        body = "\n".join(kept["knowledge"] + kept["examples"] + kept["history"])
+        return [{"role": "system", "content": "You are a student."}, {"role": "user", "content": body}]
+
+    full_total = count_message_tokens(render({"history": history.items, "knowledge": knowledge.items,
+                                              "examples": examples.items}))
+    budget = full_total - 60
+    messages, breakdown = PromptAssembler(render, [history, knowledge, examples], budget=budget).assemble()
+    assert breakdown["total"] <= budget, breakdown
+    assert breakdown["dropped"] == {"history": breakdown["dropped"]["history"], "knowledge": 0, "examples": 0}
+    assert history.kept()[-1] == history.items[-1]  # 先删最早的历史
+
+    _, tight = PromptAssembler(render, [history, knowledge, examples], budget=20).assemble()
+    assert tight["over_budget"] and tight["dropped"] == {"history": 8, "knowledge": 4, "examples": 1}, tight
+    print("✅ Prompt assembler test passed", breakdown)
+
+
+def test_uncached_encoding():
+    """编码文件没缓存时不下载，直接用近似计数"""
+    global _ENCODING, _ENCODING_LOADED
+    saved_env = os.environ.get("TIKTOKEN_CACHE_DIR")
+    saved = (_ENCODING, _ENCODING_LOADED)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["TIKTOKEN_CACHE_DIR"] = tmp
+        try:
+            _ENCODING, _ENCODING_LOADED = None, False
+            assert _tiktoken_cache_path().startswith(tmp)
+            assert tokenizer_name() == "approx" and count_tokens("advising office hours") == estimate_tokens(
+                "advising office hours")
+        finally:
+            if saved_env is None:
+                os.environ.pop("TIKTOKEN_CACHE_DIR", None)
+            else:
+                os.environ["TIKTOKEN_CACHE_DIR"] = saved_env
+            _ENCODING, _ENCODING_LOADED = saved
+    print("✅ Uncached encoding test passed")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "cache-encoding":
+        ok = cache_encoding()
+        print(f"✅ Cached tiktoken encoding {TIKTOKEN_ENCODING}" if ok else "⚠️ Token counts stay approximate")
+        sys.exit(0 if ok else 1)
+
+    test_prompt_assembler()
+    test_uncached_encoding()
@@ -0,0 +1,2 @@
+# rag_system package
+from .vector_store import VectorStore
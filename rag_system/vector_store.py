@@ -0,0 +1,352 @@
+# rag_system/vector_store.py
+"""
+Dense-embedding vector index over the knowledge_base JSON files.
+Embeddings are computed offline with sentence-transformers, stored as an
+on-disk float16 matrix and memory-mapped at runtime; a query is one
+matrix-vector product plus argpartition top-k.
+
+Build: python -m rag_system.vector_store build
+Self-test (stub encoder, no model download): python -m rag_system.vector_store selftest
+"""
+import json
+import threading
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+
+from simple_knowledge_base import (
+    get_shared_knowledge_base,
+    _knowledge_files_signature,
+    _resolve_knowledge_base_dir,
+)
+
+DEFAULT_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+INDEX_DIRNAME = ".vector_index"
+EMBEDDINGS_FILENAME = "embeddings.f16.npy"
+METADATA_FILENAME = "metadata.json"
+
+# Loaded SentenceTransformer models, shared by every VectorStore in the process
+_MODELS: Dict[str, object] = {}
+_MODELS_LOCK = threading.Lock()
+
+
+def _get_model(model_name: str):
+    """Load (once per process) a CPU SentenceTransformer model."""
+    with _MODELS_LOCK:
+        if model_name not in _MODELS:
+            from sentence_transformers import SentenceTransformer
+            _MODELS[model_name] = SentenceTransformer(model_name, device="cpu")
+        return _MODELS[model_name]
+
+
+class VectorStore:
+    """
+    Semantic retrieval over all knowledge_base entries.
+    The index is rebuilt automatically when the knowledge JSON files or the
+    embedding model change.
+    """
+
+    def __init__(
+        self,
+        knowledge_base_dir: Optional[str] = None,
+        index_dir: Optional[str] = None,
+        model_name: str = DEFAULT_MODEL_NAME,
+        top_k: int = 3,
+        rebuild: bool = False,
+    ):
+        """
+        Args:
+            knowledge_base_dir: Directory containing knowledge JSON files (default: knowledge_base/)
+            index_dir: Where the embedding matrix is stored (default: knowledge_base/.vector_index)
+            model_name: sentence-transformers model used for documents and queries
+            top_k: Default number of passages returned by get_relevant_context
+            rebuild: Re-embed everything even if the stored index is current
+        """
+        self.knowledge_base_dir = _resolve_knowledge_base_dir(knowledge_base_dir)
+        self.index_dir = Path(index_dir) if index_dir else self.knowledge_base_dir / INDEX_DIRNAME
+        self.model_name = model_name
+        self.top_k = top_k
+
+        self.embeddings: Optional[np.ndarray] = None  # (n_docs, dim) float16, memory-mapped
+        self.texts: List[str] = []
+        self.sources: List[str] = []
+        self.personas: List[Optional[str]] = []
+
+        if rebuild or not self._load_index():
+            self.build_index()
+
+    @property
+    def embeddings_path(self) -> Path:
+        return self.index_dir / EMBEDDINGS_FILENAME
+
+    @property
+    def metadata_path(self) -> Path:
+        return self.index_dir / METADATA_FILENAME
+
+    def _previous_embeddings(self) -> Dict[str, np.ndarray]:
+        """text -> stored embedding row from the existing index (same model only), for reuse."""
+        if not (self.embeddings_path.exists() and self.metadata_path.exists()):
+            return {}
+        try:
+            with open(self.metadata_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            if metadata.get("model_name") != self.model_name:
+                return {}
+            embeddings = np.load(self.embeddings_path, mmap_mode="r")
+            if embeddings.shape[0] != len(metadata["texts"]):
+                return {}
+            return {text: np.array(embeddings[row]) for row, text in enumerate(metadata["texts"])}
+        except Exception as e:
+            print(f"⚠️ Warning: Not reusing previous vector index: {e}")
+            return {}
+
+    def build_index(self, batch_size: int = 64, reuse: bool = True) -> Path:
+        """
+        Embed every knowledge_base entry and write the float16 matrix + metadata,
+        then memory-map the written matrix. If the index directory is not
+        writable the freshly built matrix is kept in memory instead.
+
+        With reuse=True, entries whose text is already in the stored index keep
+        their embedding. Only new or changed texts are encoded, so an incremental
+        re-crawl costs as much as it changed.
+        """
+        kb = get_shared_knowledge_base(self.knowledge_base_dir)
+        texts, sources, personas = [], [], []
+        for source, text, _, persona in kb.iter_documents():
+            texts.append(text)
+            sources.append(source)
+            personas.append(persona)
+
+        previous = self._previous_embeddings() if reuse else {}
+        missing = list(dict.fromkeys(text for text in texts if text not in previous))
+        if missing:
+            encoded = _get_model(self.model_name).encode(
+                missing,
+                batch_size=batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            ).astype(np.float16)
+            previous.update(zip(missing, encoded))
+        if texts:
+            embeddings = np.stack([previous[text] for text in texts]).astype(np.float16)
+        else:
+            embeddings = np.zeros((0, 0), dtype=np.float16)
+        if previous and len(missing) < len(texts):
+            print(f"🔁 Vector index: reused {len(texts) - len(missing)} embeddings, encoded {len(missing)}")
+
+        metadata = {
+            "model_name": self.model_name,
+            "signature": [list(entry) for entry in _knowledge_files_signature(self.knowledge_base_dir)],
+            "texts": texts,
+            "sources": sources,
+            "personas": personas,
+        }
+        self.embeddings, self.texts, self.sources, self.personas = embeddings, texts, sources, personas
+
+        try:
+            self.index_dir.mkdir(parents=True, exist_ok=True)
+            np.save(self.embeddings_path, embeddings)
+            with open(self.metadata_path, "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False)
+        except OSError as e:
+            print(f"⚠️ Warning: Could not write vector index, keeping it in memory: {e}")
+            return self.embeddings_path
+        self._load_index()
+        return self.embeddings_path
+
+    def _load_index(self) -> bool:
+        """Memory-map the stored matrix; False if missing, stale or built with another model."""
+        if not (self.embeddings_path.exists() and self.metadata_path.exists()):
+            return False
+        try:
+            with open(self.metadata_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            signature = [list(entry) for entry in _knowledge_files_signature(self.knowledge_base_dir)]
+            if metadata.get("model_name") != self.model_name or metadata.get("signature") != signature:
+                return False
+            embeddings = np.load(self.embeddings_path, mmap_mode="r")
+        except Exception as e:
+            print(f"⚠️ Warning: Ignoring unreadable vector index: {e}")
+            return False
+
+        if embeddings.shape[0] != len(metadata["texts"]):
+            return False
+        self.embeddings = embeddings
+        self.texts = metadata["texts"]
+        self.sources = metadata["sources"]
+        self.personas = metadata["personas"]
+        return True
+
+    def search(self, query: str, top_k: Optional[int] = None,
+               persona: Optional[str] = None) -> List[Tuple[float, str]]:
+        """
+        Return up to top_k (cosine score, text) pairs, best first.
+        Scenario entries written for a different persona are excluded.
+        """
+        top_k = top_k or self.top_k
+        if not query or self.embeddings is None or not len(self.texts):
+            return []
+
+        query_vec = _get_model(self.model_name).encode(
+            [query], normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
+        )[0].astype(np.float32)
+        scores = self.embeddings @ query_vec
+
+        if persona:
+            persona_lower = persona.lower()
+            mask = np.fromiter(
+                (p is not None and p != persona_lower for p in self.personas),
+                dtype=bool, count=len(self.personas),
+            )
+            scores[mask] = -np.inf
+
+        # Over-fetch a little so duplicate texts do not shrink the result
+        k = min(len(scores), top_k * 2)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        results, seen = [], set()
+        for row in candidates:
+            score = float(scores[row])
+            text = self.texts[row]
+            if score == -np.inf or text in seen:
+                continue
+            seen.add(text)
+            results.append((score, text))
+            if len(results) >= top_k:
+                break
+        return results
+
+    def get_relevant_context(self, query: str, intent: Optional[str] = None,
+                             persona: Optional[str] = None) -> str:
+        """
+        Relevant knowledge for a user message, joined into one context string.
+        intent is accepted for ChatbotPipeline compatibility; ranking is purely semantic.
+        """
+        return "\n".join(text for _, text in self.search(query, persona=persona))
+
+
+class _StubEncoder:
+    """Deterministic bag-of-words hashing encoder with the SentenceTransformer.encode signature (tests only)."""
+
+    def __init__(self, dim: int = 64):
+        self.dim = dim
+        self.encoded: List[str] = []
+
+    def _vector(self, text: str) -> np.ndarray:
+        import zlib
+
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for token in text.lower().split():
+            vec += np.random.default_rng(zlib.crc32(token.encode("utf-8"))).standard_normal(self.dim)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def encode(self, texts, normalize_embeddings=True, convert_to_numpy=True, **kwargs) -> np.ndarray:
+        self.encoded.extend(texts)
+        return np.stack([self._vector(text) for text in texts])
+
+
+def test_vector_store():
+    """float16 memmap 往返 / top-k 与暴力余弦排序一致 / persona 过滤 / 重新加载 / embedding 复用 自测"""
+    import shutil
+    import tempfile
+
+    model_name = "test/stub-encoder"
+    encoder = _StubEncoder()
+    _MODELS[model_name] = encoder
+    queries = ["What research labs work on robotics?", "I feel stressed about my exams", "graduate advising"]
+
+    def brute_force(store: "VectorStore", query: str, top_k: int, persona: Optional[str]) -> List[str]:
+        query_vec = encoder._vector(query)
+        scores = np.asarray(store.embeddings, dtype=np.float32) @ query_vec
+        order = sorted(range(len(scores)), key=lambda row: -scores[row])
+        texts, seen = [], set()
+        for row in order:
+            row_persona = store.personas[row]
+            if persona and row_persona is not None and row_persona != persona:
+                continue
+            if store.texts[row] not in seen:
+                seen.add(store.texts[row])
+                texts.append(store.texts[row])
+        return texts[:top_k]
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            kb_dir = Path(tmp) / "kb"
+            kb_dir.mkdir()
+            for path in _resolve_knowledge_base_dir(None).glob("*.json"):
+                shutil.copy2(path, kb_dir / path.name)
+
+            store = VectorStore(str(kb_dir), model_name=model_name, top_k=5)
+            assert isinstance(store.embeddings, np.memmap) and store.embeddings.dtype == np.float16
+            assert len(encoder.encoded) == len(set(store.texts))
+            for row in (0, len(store.texts) - 1):  # float16 磁盘往返
+                expected = encoder._vector(store.texts[row]).astype(np.float16)
+                assert np.array_equal(store.embeddings[row], expected), row
+            assert any(store.personas) and None in store.personas
+
+            # 用另一个 persona 的场景原文查询：不过滤时排第一，persona 过滤后必须消失
+            alpha_text = next(text for text, p in zip(store.texts, store.personas) if p == "alpha")
+            assert store.search(alpha_text, top_k=1)[0][1] == alpha_text
+            assert store.search(alpha_text, top_k=1, persona="alpha")[0][1] == alpha_text
+            assert alpha_text not in [text for _, text in store.search(alpha_text, top_k=50, persona="beta")]
+            queries.append(alpha_text)
+
+            results = {}
+            for query in queries:
+                for persona in (None, "beta"):
+                    hits = store.search(query, persona=persona)
+                    texts = [text for _, text in hits]
+                    assert texts == brute_force(store, query, 5, persona), (query, persona)
+                    assert [score for score, _ in hits] == sorted((score for score, _ in hits), reverse=True)
+                    if persona:
+                        allowed = {text for text, p in zip(store.texts, store.personas) if p in (None, persona)}
+                        assert set(texts) <= allowed, (query, texts)
+                    results[query, persona] = hits
+
+            encoder.encoded.clear()
+            reloaded = VectorStore(str(kb_dir), model_name=model_name, top_k=5)
+            assert encoder.encoded == [] and isinstance(reloaded.embeddings, np.memmap)
+            for (query, persona), hits in results.items():
+                assert reloaded.search(query, persona=persona) == hits, (query, persona)
+
+            # 新增一条 FAQ：只编码新文本，其余 embedding 复用
+            faq_path = kb_dir / "faq_knowledge.json"
+            faq = json.loads(faq_path.read_text(encoding="utf-8"))
+            faq.append({"question": "Where is the MAE wind tunnel?", "answer": "In the MAE-B building.",
+                        "category": "facilities"})
+            faq_path.write_text(json.dumps(faq), encoding="utf-8")
+            old_texts = set(reloaded.texts)
+            encoder.encoded.clear()
+            updated = VectorStore(str(kb_dir), model_name=model_name, top_k=5)
+            new_texts = set(updated.texts) - old_texts
+            assert new_texts and set(encoder.encoded) == new_texts, (encoder.encoded, new_texts)
+            new_text = next(iter(new_texts))
+            assert updated.search(new_text, top_k=1)[0][1] == new_text
+            del store, reloaded, updated
+    finally:
+        _MODELS.pop(model_name, None)
+    print("✅ Vector store test passed")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "selftest":
+        test_vector_store()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        store = VectorStore(sys.argv[2] if len(sys.argv) > 2 else None, rebuild=True)
+        # rebuild=True 仍会复用未变化条目的 embedding；全量重算请删除 .vector_index
+        print(f"✅ Vector index written to {store.embeddings_path} ({len(store.texts)} entries)")
+    else:
+        store = VectorStore()
+        print(f"Vector index: {len(store.texts)} entries, dim={store.embeddings.shape[1]}")
+        for query in ["What research labs work on robotics?", "I feel stressed about my exams"]:
+            print(f"\n{query}")
+            for score, text in store.search(query, persona="beta"):
+                print(f"  {score:.3f}  {text[:100]}...")
@@ -0,0 +1,268 @@
+"""
+Response cache for (near-)deterministic LLM calls, e.g. the session summary.
+
+Entries are keyed by a SHA-256 of (model, normalized messages, sampling params).
+There is an in-memory LRU and, optionally, a SQLite file so cached responses
+survive Streamlit restarts. Both layers use TTL and size-based eviction.
+
+    cache = get_response_cache()
+    key = cache.make_key(model, messages, max_tokens=200, temperature=0.2)
+    text = cache.get(key)
+    if text is None:
+        text = call_model(...)
+        cache.set(key, text)
+
+Config (Streamlit secrets or env):
+  UF_RESPONSE_CACHE_SIZE   in-memory entries (default 256)
+  UF_RESPONSE_CACHE_TTL    seconds (default 86400)
+  UF_RESPONSE_CACHE_PATH   SQLite file; unset = memory only
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_DISK_ENTRIES = 5000
+DEFAULT_TTL_SEC = 24 * 3600.0
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize_messages(messages: Iterable[Dict[str, str]]) -> List[Tuple[str, str]]:
+    """Role + whitespace-collapsed content; formatting-only prompt differences share an entry."""
+    return [
+        (str(m.get("role", "")), _WHITESPACE.sub(" ", str(m.get("content", ""))).strip())
+        for m in messages
+    ]
+
+
+class ResponseCache:
+    """Thread-safe LRU response cache with an optional SQLite second level."""
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_sec: float = DEFAULT_TTL_SEC,
+        sqlite_path: Optional[str] = None,
+        max_disk_entries: int = DEFAULT_MAX_DISK_ENTRIES,
+    ):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.max_disk_entries = max_disk_entries
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # key -> (value, created_at)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "memory_hits": 0, "disk_hits": 0,
+                       "sets": 0, "evictions": 0, "expired": 0}
+
+        self._db: Optional[sqlite3.Connection] = None
+        self.sqlite_path = sqlite_path
+        if sqlite_path:
+            try:
+                Path(sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Warning: Response cache SQLite disabled ({sqlite_path}): {e}")
+                self._db = None
+
+    @staticmethod
+    def make_key(model: Optional[str], messages: Iterable[Dict[str, str]], **params) -> str:
+        payload = {
+            "model": model,
+            "messages": _normalize_messages(messages),
+            "params": {k: v for k, v in sorted(params.items()) if v is not None},
+        }
+        blob = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str, now: float) -> Optional[str]:
+        """Memory first, then SQLite (promoted into memory). Caller holds the lock; no stats."""
+        entry = self._memory.get(key)
+        if entry is not None:
+            value, created_at = entry
+            if now - created_at <= self.ttl_sec:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return value
+            del self._memory[key]
+            self._stats["expired"] += 1
+
+        if self._db is not None:
+            try:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if now - created_at <= self.ttl_sec:
+                        self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                        self._put_memory(key, value, created_at)
+                        self._stats["disk_hits"] += 1
+                        return value
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                    self._stats["expired"] += 1
+            except sqlite3.Error as e:
+                print(f"⚠️ Warning: Response cache read failed: {e}")
+        return None
+
+    def _put_memory(self, key: str, value: str, created_at: float):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_any([key])
+
+    def get_any(self, keys: Iterable[str]) -> Optional[str]:
+        """
+        First cached value among `keys` (e.g. one key per fallback model), counted
+        as a single hit or miss.
+        """
+        with self._lock:
+            now = time.time()
+            for key in keys:
+                value = self._lookup(key, now)
+                if value is not None:
+                    self._stats["hits"] += 1
+                    return value
+            self._stats["misses"] += 1
+            return None
+
+    def set(self, key: str, value: str):
+        if not value:
+            return
+        with self._lock:
+            now = time.time()
+            self._put_memory(key, value, now)
+            self._stats["sets"] += 1
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now),
+                )
+                self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_sec,))
+                self._db.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Warning: Response cache write failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss counters plus current sizes."""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            stats["memory_entries"] = len(self._memory)
+            if self._db is not None:
+                try:
+                    stats["disk_entries"] = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                except sqlite3.Error:
+                    pass
+            return stats
+
+
+_RESPONSE_CACHE: Optional[ResponseCache] = None
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Process-wide cache shared by all Streamlit sessions."""
+    global _RESPONSE_CACHE
+    with _RESPONSE_CACHE_LOCK:
+        if _RESPONSE_CACHE is None:
+            # 延迟导入，避免循环依赖（uf_navigator_api 导入本模块）
+            from uf_navigator_api import _get_secret, _int_setting
+
+            try:
+                ttl_sec = float(_get_secret("UF_RESPONSE_CACHE_TTL", str(DEFAULT_TTL_SEC)))
+            except ValueError:
+                print(f"⚠️ Invalid UF_RESPONSE_CACHE_TTL, using {DEFAULT_TTL_SEC}")
+                ttl_sec = DEFAULT_TTL_SEC
+            _RESPONSE_CACHE = ResponseCache(
+                max_entries=_int_setting("UF_RESPONSE_CACHE_SIZE", DEFAULT_MAX_ENTRIES),
+                ttl_sec=ttl_sec,
+                sqlite_path=_get_secret("UF_RESPONSE_CACHE_PATH", "") or None,
+            )
+        return _RESPONSE_CACHE
+
+
+def test_response_cache():
+    """LRU / TTL / SQLite 自测"""
+    import tempfile
+
+    messages = [{"role": "user", "content": "Summarize   this\nsession."}]
+    cache = ResponseCache(max_entries=2, ttl_sec=60)
+    key = cache.make_key("m1", messages, temperature=0.2, max_tokens=200)
+    assert key == cache.make_key("m1", [{"role": "user", "content": "Summarize this session."}],
+                                 max_tokens=200, temperature=0.2)
+    assert key != cache.make_key("m2", messages, temperature=0.2, max_tokens=200)
+
+    assert cache.get(key) is None
+    cache.set(key, "summary")
+    assert cache.get(key) == "summary"
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get(key) is None  # evicted (LRU, max 2)
+    assert cache.stats()["evictions"] == 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "responses.sqlite")
+        ResponseCache(sqlite_path=path).set(key, "persisted")
+        reopened = ResponseCache(sqlite_path=path)
+        assert reopened.get_any(["missing", key]) == "persisted"
+        assert reopened.stats()["disk_hits"] == 1
+        expired = ResponseCache(sqlite_path=path, ttl_sec=0)
+        time.sleep(0.01)
+        assert expired.get(key) is None
+    print("✅ Response cache test passed")
+    print(cache.stats())
+
+
+def test_response_cache_config():
+    """配置写错时回退默认值，不抛异常"""
+    global _RESPONSE_CACHE
+    saved = _RESPONSE_CACHE
+    os.environ["UF_RESPONSE_CACHE_SIZE"], os.environ["UF_RESPONSE_CACHE_TTL"] = "lots", "1h"
+    try:
+        _RESPONSE_CACHE = None
+        cache = get_response_cache()
+        assert cache.max_entries == DEFAULT_MAX_ENTRIES and cache.ttl_sec == DEFAULT_TTL_SEC
+    finally:
+        del os.environ["UF_RESPONSE_CACHE_SIZE"], os.environ["UF_RESPONSE_CACHE_TTL"]
+        _RESPONSE_CACHE = saved
+    print("✅ Response cache config test passed")
+
+
+if __name__ == "__main__":
+    test_response_cache()
+    test_response_cache_config()
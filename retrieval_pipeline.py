@@ -0,0 +1,163 @@
+"""
+Concurrent fan-out for the independent retrieval stages of a student reply
+(knowledge-base search, live UF MAE website search, few-shot selection).
+
+Each stage name gets its own small, process-wide thread pool, so a slow stage
+(e.g. web requests piling up under load) can only exhaust its own workers and
+never delays the kb / few-shot stages. Each stage has its own deadline measured
+from the fan-out start. A stage that misses it is dropped (its default value is
+used) instead of stalling the reply. The late work keeps running in its stage's
+pool and its result is discarded. Per-stage timings are
+returned and also kept in a small rolling history for the debug panel.
+
+    results, timings = run_stages({
+        "kb": (lambda: kb.search(msg), 1.0, []),
+        "web": (lambda: get_realtime_uf_mae_info(msg), 3.0, ""),
+    })
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Deque, Dict, Tuple
+
+# 每个阶段各自的线程数
+DEFAULT_WORKERS = 4
+# 默认各阶段截止时间（秒），可用环境变量覆盖：UF_STAGE_DEADLINE_<NAME>，如 UF_STAGE_DEADLINE_WEB=2
+DEFAULT_DEADLINES = {
+    "kb": 1.0,
+    "web": 3.0,
+    "few_shot": 1.5,
+}
+
+_POOLS: Dict[str, ThreadPoolExecutor] = {}
+_POOL_LOCK = threading.Lock()
+_TIMING_HISTORY: Deque[Dict[str, Dict[str, Any]]] = deque(maxlen=100)
+
+
+def _get_pool(name: str) -> ThreadPoolExecutor:
+    """Thread pool of one stage (UF_RETRIEVAL_WORKERS threads each, default 4)."""
+    with _POOL_LOCK:
+        pool = _POOLS.get(name)
+        if pool is None:
+            try:
+                workers = max(1, int(os.getenv("UF_RETRIEVAL_WORKERS", DEFAULT_WORKERS)))
+            except ValueError:
+                workers = DEFAULT_WORKERS
+            pool = _POOLS[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"retrieval-{name}")
+        return pool
+
+
+def stage_deadline(name: str) -> float:
+    """Deadline for a named stage (env UF_STAGE_DEADLINE_<NAME> overrides the default)."""
+    value = os.getenv(f"UF_STAGE_DEADLINE_{name.upper()}")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return DEFAULT_DEADLINES.get(name, 2.0)
+
+
+def _timed_call(fn: Callable[[], Any]) -> Tuple[Any, float, float]:
+    started = time.monotonic()
+    value = fn()
+    return value, started, time.monotonic()
+
+
+def run_stages(
+    stages: Dict[str, Tuple[Callable[[], Any], float, Any]],
+) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """
+    Run independent stages concurrently.
+
+    Args:
+        stages: name -> (zero-arg callable, deadline in seconds, default value)
+
+    Returns:
+        (results, timings). results[name] is the stage's value, or its default if
+        it timed out or raised. timings[name] = {"status": "ok"|"timeout"|"error",
+        "seconds": time from fan-out until the stage finished (or was dropped),
+        "run_seconds": time spent running, excluding pool queueing (ok only), "deadline": deadline}.
+    """
+    start = time.monotonic()
+    futures = {name: (_get_pool(name).submit(_timed_call, fn), deadline, default)
+               for name, (fn, deadline, default) in stages.items()}
+
+    results: Dict[str, Any] = {}
+    timings: Dict[str, Dict[str, Any]] = {}
+    for name, (future, deadline, default) in futures.items():
+        remaining = max(0.0, start + deadline - time.monotonic())
+        timing = {"deadline": deadline}
+        try:
+            value, started, finished = future.result(timeout=remaining)
+            results[name] = value
+            timing.update(status="ok", seconds=round(finished - start, 4),
+                          run_seconds=round(finished - started, 4))
+        except FutureTimeout:
+            future.cancel()  # 还没开始就直接取消；已在运行的让它在后台结束，结果丢弃
+            results[name] = default
+            timing["status"] = "timeout"
+            print(f"⚠️ Retrieval stage '{name}' missed its {deadline:.1f}s deadline, dropped from prompt")
+        except Exception as e:
+            results[name] = default
+            timing.update(status="error", error=str(e)[:200])
+            print(f"⚠️ Retrieval stage '{name}' failed: {e}")
+        timing.setdefault("seconds", round(time.monotonic() - start, 4))
+        timings[name] = timing
+
+    _TIMING_HISTORY.append(timings)
+    return results, timings
+
+
+def get_stage_timing_summary() -> Dict[str, Dict[str, Any]]:
+    """Per-stage count / timeouts / errors / p50 / max over the recent fan-outs."""
+    summary: Dict[str, Dict[str, Any]] = {}
+    for timings in list(_TIMING_HISTORY):
+        for name, timing in timings.items():
+            entry = summary.setdefault(name, {"runs": 0, "timeouts": 0, "errors": 0, "_seconds": []})
+            entry["runs"] += 1
+            if timing["status"] == "timeout":
+                entry["timeouts"] += 1
+            elif timing["status"] == "error":
+                entry["errors"] += 1
+            else:
+                entry["_seconds"].append(timing["seconds"])
+    for entry in summary.values():
+        seconds = sorted(entry.pop("_seconds"))
+        entry["p50_seconds"] = seconds[len(seconds) // 2] if seconds else None
+        entry["max_seconds"] = seconds[-1] if seconds else None
+    return summary
+
+
+def test_run_stages():
+    """并发 / 截止时间 / 异常 自测"""
+    start = time.monotonic()
+    results, timings = run_stages({
+        "fast": (lambda: "a", 1.0, None),
+        "slow": (lambda: time.sleep(0.5) or "late", 0.1, "dropped"),
+        "other": (lambda: time.sleep(0.05) or "b", 1.0, None),
+        "broken": (lambda: 1 / 0, 1.0, "default"),
+    })
+    elapsed = time.monotonic() - start
+    assert results == {"fast": "a", "slow": "dropped", "other": "b", "broken": "default"}, results
+    assert timings["slow"]["status"] == "timeout" and timings["broken"]["status"] == "error"
+    assert elapsed < 0.4, elapsed  # 不等慢阶段
+
+    # 慢阶段占满自己的线程池时，其他阶段不受影响
+    blocker = threading.Event()
+    for _ in range(DEFAULT_WORKERS + 2):
+        _get_pool("stuck").submit(blocker.wait, 2.0)
+    results, timings = run_stages({
+        "stuck": (lambda: "never", 0.1, None),
+        "fast": (lambda: "a", 0.3, None),
+    })
+    blocker.set()
+    assert results == {"stuck": None, "fast": "a"}, (results, timings)
+    print(f"✅ Retrieval fan-out test passed in {elapsed:.2f}s")
+    print(get_stage_timing_summary())
+
+
+if __name__ == "__main__":
+    test_run_stages()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for SimpleKnowledgeBase retrieval on the shipped knowledge_base JSON.
+Compares the original per-query linear scan with the indexed keyword mode, BM25 mode
+and budgeted passage mode, and reports how many prompt tokens each mode returns.
+
+Usage: python scripts/benchmark_knowledge_base.py [iterations]
+"""
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from simple_knowledge_base import SimpleKnowledgeBase
+from passage_chunker import estimate_tokens
+
+QUERIES = [
+    "MAE advising student opening prompt",
+    "What courses are you taking next semester?",
+    "I want to find a research lab in robotics or aerospace",
+    "I'm stressed about my thermodynamics exam and not sure if I belong here",
+    "How do I get an internship and join a club?",
+    "Can you tell me about graduate school funding and scholarships?",
+]
+
+
+def linear_scan_search(kb: SimpleKnowledgeBase, query: str, max_results: int = 5) -> List[str]:
+    """The original search(): lowercase and scan every item of every corpus per query."""
+    query_lower = query.lower()
+    keywords = [k for k in query_lower.split() if len(k) > 2]
+    results, seen = [], set()
+
+    def add(text: str) -> bool:
+        if text and text not in seen:
+            results.append(text)
+            seen.add(text)
+        return len(results) >= max_results
+
+    for item in kb.training_knowledge:
+        title, content = item.get("title", "").lower(), item.get("content", "")
+        if any(k in title or k in content.lower() for k in keywords) and add(content):
+            return results
+    for items in (kb.mae_full_site_knowledge, kb.uf_mae_knowledge, kb.faq_knowledge):
+        for item in items:
+            question, answer = item.get("question", "").lower(), item.get("answer", "")
+            if any(k in question or k in answer.lower() for k in keywords):
+                if add(f"{item.get('question', '')}: {answer}"):
+                    return results
+    for scenarios in kb.scenario_knowledge.values():
+        for item in scenarios:
+            if any(k in item.get("scenario", "").lower() for k in keywords):
+                if add(f"{item.get('scenario', '')}: " + "; ".join(item.get("responses", [])[:2])):
+                    return results
+    return results
+
+
+def _time_per_query(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for q in QUERIES:
+            fn(q)
+    return (time.perf_counter() - start) / (iterations * len(QUERIES)) * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    start = time.perf_counter()
+    kb = SimpleKnowledgeBase()
+    load_ms = (time.perf_counter() - start) * 1e3
+    print(f"Loaded {len(kb._documents)} documents in {load_ms:.1f} ms (JSON + index build)")
+
+    for max_results in (3, 5):
+        print(f"\nmax_results={max_results}, {iterations} x {len(QUERIES)} queries")
+        timings = {
+            "linear scan": _time_per_query(lambda q: linear_scan_search(kb, q, max_results), iterations),
+            "keyword (index)": _time_per_query(lambda q: kb.search(q, max_results), iterations),
+            "bm25": _time_per_query(lambda q: kb.search(q, max_results, mode="bm25"), iterations),
+            "passages": _time_per_query(lambda q: kb.search(q, max_results, mode="passages"), iterations),
+        }
+        for name, us in timings.items():
+            print(f"  {name:<16} {us:9.1f} µs/query")
+
+    # Prompt size: average estimated tokens of the returned context per query
+    print("\nAvg context tokens per query (max_results=3):")
+    for mode in ("keyword", "bm25", "passages"):
+        tokens = sum(estimate_tokens("\n".join(kb.search(q, 3, mode=mode))) for q in QUERIES) / len(QUERIES)
+        print(f"  {mode:<16} {tokens:9.0f}")
+
+    # Worst case for the scan: no early exit because few documents match
+    rare = "zyxw quantum cryogenics"
+    print(f"\nNo-early-exit query {rare!r}:")
+    print(f"  {'linear scan':<16} {_time_per_query(lambda q: linear_scan_search(kb, rare), iterations):9.1f} µs/query")
+    print(f"  {'keyword (index)':<16} {_time_per_query(lambda q: kb.search(rare), iterations):9.1f} µs/query")
+    print(f"  {'bm25':<16} {_time_per_query(lambda q: kb.search(rare, mode='bm25'), iterations):9.1f} µs/query")
+
+
+if __name__ == "__main__":
+    main()
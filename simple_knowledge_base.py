@@ -1,13 +1,226 @@
 # simple_knowledge_base.py
 """
 Simple knowledge base for RAG (Retrieval-Augmented Generation).
-Loads knowledge from JSON files and provides simple keyword-based search.
+Loads knowledge from JSON files and provides simple keyword-based search
+backed by an inverted index built once at load time.
 """
 import os
+import re
 import json
-from typing import List, Dict, Any
+import math
+import mmap
+import heapq
+import struct
+import threading
+from collections import Counter
+from collections.abc import Mapping, Sequence
+from typing import List, Dict, Any, Iterator, Tuple, Optional
 from pathlib import Path
 
+import numpy as np
+
+from passage_chunker import chunk_text, estimate_tokens
+
+# Memoized keyword -> postings expansions kept before the cache is reset
+_KEYWORD_CACHE_SIZE = 4096
+
+# BM25 parameters (standard Okapi defaults)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TERM_RE = re.compile(r"[a-z0-9]+")
+
+# Passage retrieval: default prompt-token budget and per-page cap
+DEFAULT_PASSAGE_TOKEN_BUDGET = 500
+MAX_PASSAGES_PER_SOURCE = 2
+
+# Precompiled snapshot of the whole knowledge base (build: python simple_knowledge_base.py build-snapshot)
+# Layout: magic + JSON header length, JSON header, then 8-byte aligned sections
+# (numpy arrays and UTF-8 text blobs) located by the header. Nothing is unpickled.
+SNAPSHOT_FILENAME = ".kb_snapshot.bin"
+_SNAPSHOT_MAGIC = b"SKBSNAP3"
+_SNAPSHOT_VERSION = 3
+_SNAPSHOT_PREFIX = struct.Struct("<8sQ")  # magic, header length
+_SNAPSHOT_ALIGN = 8
+
+# Raw corpora (public attributes) -> (JSON file, empty value). A snapshot does not
+# contain them; after a snapshot load they are read from the JSON files on first access.
+_CORPUS_FILES = {
+    "training_knowledge": ("training_knowledge.json", list),
+    "faq_knowledge": ("faq_knowledge.json", list),
+    "uf_mae_knowledge": ("uf_mae_website_knowledge.json", list),
+    "mae_full_site_knowledge": ("mae_full_site_knowledge.json", list),
+    "mae_full_site_passages": ("mae_full_site_passages.json", list),
+    "scenario_knowledge": ("scenario_knowledge.json", dict),
+}
+
+
+# Process-wide shared instances: resolved dir -> (file signature, knowledge base)
+_SHARED_KNOWLEDGE_BASES: Dict[Path, Tuple[Tuple, "SimpleKnowledgeBase"]] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def _resolve_knowledge_base_dir(knowledge_base_dir=None) -> Path:
+    """Default to 'knowledge_base' next to this file."""
+    if knowledge_base_dir is None:
+        return Path(__file__).parent / "knowledge_base"
+    return Path(knowledge_base_dir)
+
+
+def _knowledge_files_signature(knowledge_base_dir: Path) -> Tuple:
+    """(name, mtime, size) of every JSON file in the directory; changes when any file does."""
+    signature = []
+    for path in sorted(knowledge_base_dir.glob("*.json")):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        signature.append((path.name, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _terms(text: str) -> List[str]:
+    """Lowercase word terms used by BM25 ranking (same >2 char rule as keyword search)."""
+    return [t for t in _TERM_RE.findall(text.lower()) if len(t) > 2]
+
+
+class _MappedDocuments(Sequence):
+    """Read-only document list whose texts are decoded lazily from a memory-mapped snapshot."""
+
+    def __init__(self, buffer: mmap.mmap, base: int, offsets: np.ndarray):
+        self._buffer = buffer
+        self._base = base
+        self._offsets = offsets  # len(documents) + 1 boundaries into the text blob
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, doc_id):
+        if isinstance(doc_id, slice):
+            return [self[i] for i in range(*doc_id.indices(len(self)))]
+        start = self._base + int(self._offsets[doc_id])
+        end = self._base + int(self._offsets[doc_id + 1])
+        return self._buffer[start:end].decode("utf-8")
+
+
+class _MappedPassages(Sequence):
+    """(source, label, text) per passage; labels and texts are decoded lazily from the snapshot."""
+
+    def __init__(self, sources: List[str], labels: _MappedDocuments, texts: _MappedDocuments):
+        self._sources = sources
+        self._labels = labels
+        self._texts = texts
+
+    def __len__(self) -> int:
+        return len(self._sources)
+
+    def __getitem__(self, passage_id):
+        if isinstance(passage_id, slice):
+            return [self[i] for i in range(*passage_id.indices(len(self)))]
+        return self._sources[passage_id], self._labels[passage_id], self._texts[passage_id]
+
+
+class _MappedPostings(Mapping):
+    """
+    term -> postings over CSR arrays from the snapshot: [doc_id, ...], or
+    [(doc_id, tf), ...] when term frequencies are stored.
+    """
+
+    def __init__(self, rows: Dict[str, int], indptr: np.ndarray, ids: np.ndarray, tfs: Optional[np.ndarray] = None):
+        self._rows = rows  # term -> row, shared with the IDF tables over the same vocabulary
+        self._indptr = indptr
+        self._ids = ids
+        self._tfs = tfs
+
+    def __getitem__(self, term):
+        row = self._rows[term]
+        start, end = int(self._indptr[row]), int(self._indptr[row + 1])
+        ids = self._ids[start:end].tolist()
+        if self._tfs is None:
+            return ids
+        return list(zip(ids, self._tfs[start:end].tolist()))
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, term) -> bool:
+        return term in self._rows
+
+
+class _MappedTermValues(Mapping):
+    """term -> float over an array aligned with a postings vocabulary (NaN = term absent)."""
+
+    def __init__(self, rows: Dict[str, int], values: np.ndarray):
+        self._rows = rows
+        self._values = values
+
+    def __getitem__(self, term):
+        value = self._values[self._rows[term]]
+        if value != value:
+            raise KeyError(term)
+        return float(value)
+
+    def __iter__(self):
+        return (term for term in self._rows if term in self)
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(~np.isnan(self._values)))
+
+    def __contains__(self, term) -> bool:
+        row = self._rows.get(term)
+        return row is not None and self._values[row] == self._values[row]
+
+
+def _term_values(values: Dict[str, float], vocabulary: List[str]) -> np.ndarray:
+    """IDF dict -> f8 array aligned with ``vocabulary`` (NaN for missing terms)."""
+    return np.asarray([values.get(term, math.nan) for term in vocabulary], dtype="<f8")
+
+
+def _best_first(scores: Dict[int, float], batch: int) -> Iterator[int]:
+    """
+    Ids by descending score (ties: lower id first), taken from a bounded heap:
+    the top ``batch`` first, and a doubled batch only if the caller keeps going
+    (duplicates / skipped candidates). O(n log k) when the first batch suffices.
+    """
+    def key(item_id):
+        return -scores[item_id], item_id
+
+    taken = 0
+    while taken < len(scores):
+        top = heapq.nsmallest(batch, scores, key=key)
+        yield from top[taken:]
+        taken = len(top)
+        batch *= 2
+
+
+def _postings_to_csr(postings: Dict[str, List], with_tf: bool):
+    """Postings dict -> (vocabulary, indptr, ids, tfs or None) for the snapshot."""
+    vocabulary = list(postings)
+    indptr = np.zeros(len(vocabulary) + 1, dtype="<i8")
+    ids, tfs = [], []
+    for row, term in enumerate(vocabulary):
+        entries = postings[term]
+        if with_tf:
+            ids.extend(doc_id for doc_id, _ in entries)
+            tfs.extend(tf for _, tf in entries)
+        else:
+            ids.extend(entries)
+        indptr[row + 1] = len(ids)
+    return (vocabulary, indptr, np.asarray(ids, dtype="<i4"),
+            np.asarray(tfs, dtype="<i4") if with_tf else None)
+
+
+def _text_blob(texts) -> Tuple[np.ndarray, bytes]:
+    """Texts -> (len + 1 byte offsets, concatenated UTF-8 blob)."""
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+    if encoded:
+        offsets[1:] = np.cumsum([len(data) for data in encoded])
+    return offsets, b"".join(encoded)
+
 
 class SimpleKnowledgeBase:
     """
@@ -15,31 +228,58 @@ class SimpleKnowledgeBase:
     and provides keyword-based search functionality.
     """
     
-    def __init__(self, knowledge_base_dir: str = None):
+    def __init__(self, knowledge_base_dir: str = None, use_snapshot: bool = True):
         """
         Initialize the knowledge base.
         
         Args:
             knowledge_base_dir: Directory containing knowledge JSON files.
                                Defaults to 'knowledge_base' in the same directory.
+            use_snapshot: Load from the precompiled snapshot when it is up to date,
+                          and (re)write it after parsing the JSON files otherwise.
         """
-        if knowledge_base_dir is None:
-            # Get the directory of this file
-            current_dir = Path(__file__).parent
-            knowledge_base_dir = current_dir / "knowledge_base"
-        else:
-            knowledge_base_dir = Path(knowledge_base_dir)
+        self.knowledge_base_dir = _resolve_knowledge_base_dir(knowledge_base_dir)
+        self._snapshot_buffer: Optional[mmap.mmap] = None
         
-        self.knowledge_base_dir = knowledge_base_dir
+        # The snapshot only holds the search indexes; the raw corpora below are then
+        # read from their JSON files on first access (see __getattr__)
+        if use_snapshot and self._load_snapshot():
+            return
+
         self.training_knowledge = []
         self.faq_knowledge = []
         self.uf_mae_knowledge = []  # UF MAE website knowledge
         self.mae_full_site_knowledge = []  # Crawled full MAE site (catalog, handbook, etc.)
+        self.mae_full_site_passages = []  # Overlapping passages of the crawled pages
         self.scenario_knowledge = {}
-        
+
         # Load knowledge files
         self._load_knowledge()
+        self._build_index()
+
+        if use_snapshot:
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                # Read-only deployments simply keep the in-memory index
+                print(f"⚠️ Warning: Could not write knowledge base snapshot: {e}")
     
+    def __getattr__(self, name):
+        # Only reached for missing attributes: a raw corpus after a snapshot load
+        if name not in _CORPUS_FILES or "knowledge_base_dir" not in self.__dict__:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        file_name, empty = _CORPUS_FILES[name]
+        value = empty()
+        path = self.knowledge_base_dir / file_name
+        try:
+            if path.exists():
+                with open(path, 'r', encoding='utf-8') as f:
+                    value = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Warning: Failed to load {file_name}: {e}")
+        setattr(self, name, value)
+        return value
+
     def _load_knowledge(self):
         """Load all knowledge files from the knowledge base directory."""
         try:
@@ -66,6 +306,10 @@ class SimpleKnowledgeBase:
             if mae_full_file.exists():
                 with open(mae_full_file, 'r', encoding='utf-8') as f:
                     self.mae_full_site_knowledge = json.load(f)
+            mae_passages_file = self.knowledge_base_dir / "mae_full_site_passages.json"
+            if mae_passages_file.exists():
+                with open(mae_passages_file, 'r', encoding='utf-8') as f:
+                    self.mae_full_site_passages = json.load(f)
             
             # Load scenario knowledge
             scenario_file = self.knowledge_base_dir / "scenario_knowledge.json"
@@ -77,103 +321,450 @@ class SimpleKnowledgeBase:
             print(f"⚠️ Warning: Failed to load some knowledge files: {e}")
             # Continue with empty knowledge bases
     
-    def search(self, query: str, max_results: int = 5) -> List[str]:
+    def iter_documents(self) -> Iterator[Tuple[str, str, str, Optional[str]]]:
+        """
+        Yield (source, result_text, searchable_text, persona) for every knowledge
+        item, in the same per-source priority order that search() reports results.
+        persona is only set for scenario items.
+        """
+        for item in self.training_knowledge:
+            content = item.get("content", "")
+            if content:
+                yield "training", content, f"{item.get('title', '')}\n{content}", None
+
+        for source, items in (
+            ("mae_full_site", self.mae_full_site_knowledge),
+            ("uf_mae", self.uf_mae_knowledge),
+            ("faq", self.faq_knowledge),
+        ):
+            for item in items:
+                question = item.get("question", "")
+                answer = item.get("answer", "")
+                yield source, f"{question}: {answer}", f"{question}\n{answer}", None
+
+        for persona, scenarios in self.scenario_knowledge.items():
+            for scenario_item in scenarios:
+                scenario = scenario_item.get("scenario", "")
+                responses = scenario_item.get("responses", [])
+                # Combine scenario and first 2 responses; only the scenario is searchable
+                combined = f"{scenario}: " + "; ".join(responses[:2])
+                yield "scenario", combined, scenario, persona
+
+    def iter_passages(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        Yield (source, label, passage_text) for passage retrieval. Crawled pages use
+        the crawl-time passages (label "title (url)"); pages without them and the
+        training / UF MAE / FAQ items are chunked here. Scenario items are
+        persona-specific and are left out.
+        """
+        passages_by_url: Dict[str, List[Dict[str, Any]]] = {}
+        for passage in self.mae_full_site_passages:
+            passages_by_url.setdefault(passage.get("source", ""), []).append(passage)
+
+        for item in self.training_knowledge:
+            for text in chunk_text(item.get("content", "")):
+                yield "training", item.get("title", ""), text
+
+        for item in self.mae_full_site_knowledge:
+            url = item.get("source", "")
+            if url in passages_by_url:
+                for passage in sorted(passages_by_url[url], key=lambda p: p.get("chunk", 0)):
+                    yield "mae_full_site", f"{passage.get('title', '')} ({url})", passage.get("text", "")
+            else:
+                for text in chunk_text(item.get("answer", "")):
+                    yield "mae_full_site", item.get("question", ""), text
+
+        for source, items in (("uf_mae", self.uf_mae_knowledge), ("faq", self.faq_knowledge)):
+            for item in items:
+                for text in chunk_text(item.get("answer", "")):
+                    yield source, item.get("question", ""), text
+
+    def _build_passage_index(self):
+        """BM25 statistics over all passages (one corpus), plus each rendered passage's token count."""
+        self._passages: List[Tuple[str, str, str]] = []
+        self._passage_postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._passage_tokens: List[int] = []
+        lengths = []
+        for source, label, text in self.iter_passages():
+            if not text:
+                continue
+            passage_id = len(self._passages)
+            self._passages.append((source, label, text))
+            self._passage_tokens.append(estimate_tokens(self._render_passage(label, text)))
+            term_freqs = Counter(_terms(f"{label}\n{text}"))
+            lengths.append(sum(term_freqs.values()))
+            for term, tf in term_freqs.items():
+                self._passage_postings.setdefault(term, []).append((passage_id, tf))
+
+        avg_length = (sum(lengths) / len(lengths)) if lengths else 1.0
+        avg_length = avg_length or 1.0
+        self._passage_norms = [BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length) for length in lengths]
+        n_passages = len(self._passages)
+        self._passage_idf = {
+            term: math.log(1 + (n_passages - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._passage_postings.items()
+        }
+
+    @staticmethod
+    def _render_passage(label: str, text: str) -> str:
+        return f"{label}: {text}" if label else text
+
+    def _build_index(self):
+        """
+        Flatten all corpora into one priority-ordered document list and build
+        an inverted index mapping each whitespace token to the ids of the
+        documents containing it. Built once at load time.
+        """
+        self._documents: List[str] = []
+        self._doc_sources: List[str] = []
+        self._index: Dict[str, List[int]] = {}
+        self._keyword_postings: Dict[str, List[int]] = {}
+
+        # BM25 statistics: term -> [(doc_id, tf)], per-doc length, per-corpus IDF
+        self._term_postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._doc_lengths: List[int] = []
+        self._corpus_idf: Dict[str, Dict[str, float]] = {}
+        self._length_norms: List[float] = []
+
+        for source, text, searchable, _ in self.iter_documents():
+            doc_id = len(self._documents)
+            self._documents.append(text)
+            self._doc_sources.append(source)
+            for token in set(searchable.lower().split()):
+                self._index.setdefault(token, []).append(doc_id)
+
+            term_freqs = Counter(_terms(searchable))
+            self._doc_lengths.append(sum(term_freqs.values()))
+            for term, tf in term_freqs.items():
+                self._term_postings.setdefault(term, []).append((doc_id, tf))
+
+        self._build_bm25_stats()
+        self._build_passage_index()
+
+    def _build_bm25_stats(self):
+        """Precompute per-corpus IDF and per-document BM25 length normalization."""
+        corpus_docs: Dict[str, List[int]] = {}
+        for doc_id, source in enumerate(self._doc_sources):
+            corpus_docs.setdefault(source, []).append(doc_id)
+
+        avg_lengths = {
+            source: (sum(self._doc_lengths[d] for d in doc_ids) / len(doc_ids)) or 1.0
+            for source, doc_ids in corpus_docs.items()
+        }
+        self._length_norms = [
+            BM25_K1 * (1 - BM25_B + BM25_B * length / avg_lengths[source])
+            for length, source in zip(self._doc_lengths, self._doc_sources)
+        ]
+
+        doc_freqs: Dict[str, Counter] = {source: Counter() for source in corpus_docs}
+        for term, postings in self._term_postings.items():
+            for doc_id, _ in postings:
+                doc_freqs[self._doc_sources[doc_id]][term] += 1
+
+        self._corpus_idf = {}
+        for source, freqs in doc_freqs.items():
+            n_docs = len(corpus_docs[source])
+            self._corpus_idf[source] = {
+                term: math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for term, df in freqs.items()
+            }
+
+    @property
+    def snapshot_path(self) -> Path:
+        return self.knowledge_base_dir / SNAPSHOT_FILENAME
+
+    def write_snapshot(self, path: Optional[Path] = None) -> Path:
+        """
+        Compile the document texts and search indexes into one snapshot file: a JSON
+        header (source-file signature, small tables such as IDF values, and the
+        offset / dtype of every section) followed by numpy arrays (CSR postings,
+        BM25 lengths, text offsets) and UTF-8 blobs of the document and passage
+        texts. The raw corpora are not stored; they stay in the JSON files.
+        The source-file signature is stored so stale snapshots are detected.
+        """
+        path = Path(path or self.snapshot_path)
+        sections: List[Tuple[str, bytes, str]] = []
+
+        def add(name: str, data, dtype: str = "utf8"):
+            sections.append((name, data.tobytes() if isinstance(data, np.ndarray) else data, dtype))
+
+        doc_offsets, doc_blob = _text_blob(self._documents)
+        add("doc_offsets", doc_offsets, "<i8")
+        add("doc_text", doc_blob)
+        label_offsets, label_blob = _text_blob(label for _, label, _ in self._passages)
+        add("passage_label_offsets", label_offsets, "<i8")
+        add("passage_labels", label_blob)
+        passage_offsets, passage_blob = _text_blob(text for _, _, text in self._passages)
+        add("passage_text_offsets", passage_offsets, "<i8")
+        add("passage_text", passage_blob)
+
+        vocabularies = {}
+        for name, postings, with_tf in (("index", self._index, False),
+                                        ("term_postings", self._term_postings, True),
+                                        ("passage_postings", self._passage_postings, True)):
+            vocabulary, indptr, ids, tfs = _postings_to_csr(postings, with_tf)
+            vocabularies[name] = vocabulary
+            add(f"{name}_indptr", indptr, "<i8")
+            add(f"{name}_ids", ids, "<i4")
+            if tfs is not None:
+                add(f"{name}_tfs", tfs, "<i4")
+        sources = list(self._corpus_idf)
+        for i, source in enumerate(sources):
+            add(f"corpus_idf_{i}", _term_values(self._corpus_idf[source], vocabularies["term_postings"]), "<f8")
+        add("passage_idf", _term_values(self._passage_idf, vocabularies["passage_postings"]), "<f8")
+        add("doc_lengths", np.asarray(self._doc_lengths, dtype="<i8"), "<i8")
+        add("length_norms", np.asarray(self._length_norms, dtype="<f8"), "<f8")
+        add("passage_tokens", np.asarray(self._passage_tokens, dtype="<i8"), "<i8")
+        add("passage_norms", np.asarray(self._passage_norms, dtype="<f8"), "<f8")
+
+        layout, offset = {}, 0
+        for name, data, dtype in sections:
+            offset += -offset % _SNAPSHOT_ALIGN
+            layout[name] = [offset, len(data), dtype]
+            offset += len(data)
+        header = json.dumps({
+            "version": _SNAPSHOT_VERSION,
+            "signature": _knowledge_files_signature(self.knowledge_base_dir),
+            "sections": layout,
+            "vocabularies": vocabularies,
+            "doc_sources": self._doc_sources,
+            "corpus_idf_sources": sources,
+            "passage_sources": [source for source, _, _ in self._passages],
+        }, ensure_ascii=False).encode("utf-8")
+
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(_SNAPSHOT_PREFIX.pack(_SNAPSHOT_MAGIC, len(header)))
+            f.write(header)
+            base = _SNAPSHOT_PREFIX.size + len(header)
+            f.write(b"\0" * (-base % _SNAPSHOT_ALIGN))
+            written = 0
+            for name, data, _ in sections:
+                f.write(b"\0" * (layout[name][0] - written))
+                f.write(data)
+                written = layout[name][0] + len(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def _load_snapshot(self) -> bool:
+        """
+        Memory-map the snapshot if it matches the current JSON files.
+        Returns False (so the caller rebuilds from JSON) when it is missing or stale.
+        The header is JSON and the sections are plain arrays / UTF-8, so a tampered
+        snapshot can at worst fail to load; it cannot run code.
+        """
+        path = self.snapshot_path
+        if not path.exists():
+            return False
+        try:
+            with open(path, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, header_len = _SNAPSHOT_PREFIX.unpack_from(buffer, 0)
+            if magic != _SNAPSHOT_MAGIC:
+                buffer.close()
+                return False
+            header_start = _SNAPSHOT_PREFIX.size
+            header = json.loads(buffer[header_start:header_start + header_len].decode("utf-8"))
+            signature = [list(entry) for entry in _knowledge_files_signature(self.knowledge_base_dir)]
+            if header.get("version") != _SNAPSHOT_VERSION or header.get("signature") != signature:
+                buffer.close()
+                return False
+
+            base = header_start + header_len
+            base += -base % _SNAPSHOT_ALIGN
+            layout = header["sections"]
+
+            def array(name: str) -> np.ndarray:
+                offset, length, dtype = layout[name]
+                itemsize = np.dtype(dtype).itemsize
+                return np.frombuffer(buffer, dtype=dtype, count=length // itemsize, offset=base + offset)
+
+            def texts(name: str, offsets_name: str) -> _MappedDocuments:
+                return _MappedDocuments(buffer, base + layout[name][0], array(offsets_name))
+
+            rows = {name: {term: row for row, term in enumerate(vocabulary)}
+                    for name, vocabulary in header["vocabularies"].items()}
+
+            def postings(name: str, with_tf: bool) -> _MappedPostings:
+                return _MappedPostings(rows[name], array(f"{name}_indptr"), array(f"{name}_ids"),
+                                       array(f"{name}_tfs") if with_tf else None)
+
+            documents = texts("doc_text", "doc_offsets")
+            passages = _MappedPassages(header["passage_sources"],
+                                       texts("passage_labels", "passage_label_offsets"),
+                                       texts("passage_text", "passage_text_offsets"))
+            index = postings("index", False)
+            term_postings = postings("term_postings", True)
+            passage_postings = postings("passage_postings", True)
+            corpus_idf = {source: _MappedTermValues(rows["term_postings"], array(f"corpus_idf_{i}"))
+                          for i, source in enumerate(header["corpus_idf_sources"])}
+            passage_idf = _MappedTermValues(rows["passage_postings"], array("passage_idf"))
+            # Per-document / per-passage values are read once per posting while scoring
+            # (and token counts end up in search_passages() results): keep them as plain lists
+            doc_lengths, length_norms = array("doc_lengths").tolist(), array("length_norms").tolist()
+            passage_tokens, passage_norms = array("passage_tokens").tolist(), array("passage_norms").tolist()
+        except Exception as e:
+            print(f"⚠️ Warning: Ignoring unreadable knowledge base snapshot: {e}")
+            return False
+
+        self._snapshot_buffer = buffer
+        self._documents = documents
+        self._doc_sources = header["doc_sources"]
+        self._index = index
+        self._keyword_postings = {}
+        self._term_postings = term_postings
+        self._doc_lengths = doc_lengths
+        self._corpus_idf = corpus_idf
+        self._length_norms = length_norms
+        self._passages = passages
+        self._passage_postings = passage_postings
+        self._passage_tokens = passage_tokens
+        self._passage_norms = passage_norms
+        self._passage_idf = passage_idf
+        return True
+
+    def _postings_for_keyword(self, keyword: str) -> List[int]:
+        """
+        Return ids of documents whose text contains ``keyword`` as a substring.
+
+        A keyword has no whitespace, so it occurs in a document exactly when it
+        occurs inside one of the document's whitespace tokens. Exact tokens are
+        a dict lookup; partial matches ("advis" -> "advising") expand over the
+        vocabulary once and are memoized per keyword.
+        """
+        postings = self._keyword_postings.get(keyword)
+        if postings is not None:
+            return postings
+
+        doc_ids = set(self._index.get(keyword, ()))
+        for token in self._index:
+            if keyword in token:
+                doc_ids.update(self._index[token])
+        postings = sorted(doc_ids)
+
+        if len(self._keyword_postings) >= _KEYWORD_CACHE_SIZE:
+            self._keyword_postings.clear()
+        self._keyword_postings[keyword] = postings
+        return postings
+
+    def _search_bm25(self, query: str, max_results: int) -> List[str]:
+        """
+        Rank candidate documents from the postings by BM25 (IDF taken from each
+        document's own corpus) and keep the top ``max_results`` distinct texts with a bounded heap.
+        """
+        scores: Dict[int, float] = {}
+        for term in set(_terms(query)):
+            idf_by_source: Dict[str, float] = {}
+            for doc_id, tf in self._term_postings.get(term, ()):
+                source = self._doc_sources[doc_id]
+                idf = idf_by_source.get(source)
+                if idf is None:
+                    idf = idf_by_source[source] = self._corpus_idf[source][term]
+                weight = idf * tf * (BM25_K1 + 1) / (tf + self._length_norms[doc_id])
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight
+
+        # Best score per distinct text; ties keep source priority (lower doc id first).
+        # Texts are decoded best-first only until max_results distinct ones are found.
+        results: List[str] = []
+        seen = set()
+        for doc_id in _best_first(scores, max_results * 2):
+            text = self._documents[doc_id]
+            if text in seen:
+                continue
+            seen.add(text)
+            results.append(text)
+            if len(results) >= max_results:
+                break
+        return results
+
+    def search_passages(self, query: str, token_budget: int = DEFAULT_PASSAGE_TOKEN_BUDGET,
+                        max_passages: int = 8) -> List[Dict[str, Any]]:
+        """
+        Best BM25 passages that fit in ``token_budget`` (estimated prompt tokens).
+
+        Passages are taken greedily by score; one that would overflow the budget is
+        skipped in favour of smaller ones further down. At most
+        MAX_PASSAGES_PER_SOURCE passages come from the same page or item.
+
+        Returns:
+            [{"source", "label", "text", "rendered", "score", "tokens"}], best first
+        """
+        scores: Dict[int, float] = {}
+        for term in set(_terms(query)):
+            idf = self._passage_idf.get(term, 0.0)
+            for passage_id, tf in self._passage_postings.get(term, ()):
+                weight = idf * tf * (BM25_K1 + 1) / (tf + self._passage_norms[passage_id])
+                scores[passage_id] = scores.get(passage_id, 0.0) + weight
+
+        results, used, seen, per_source = [], 0, set(), Counter()
+        for passage_id in _best_first(scores, max_passages * 4):
+            score = scores[passage_id]
+            tokens = self._passage_tokens[passage_id]
+            if used + tokens > token_budget:
+                continue  # checked first: no need to decode the passage
+            source, label, text = self._passages[passage_id]
+            rendered = self._render_passage(label, text)
+            if rendered in seen or per_source[label] >= MAX_PASSAGES_PER_SOURCE:
+                continue
+            seen.add(rendered)
+            per_source[label] += 1
+            used += tokens
+            results.append({"source": source, "label": label, "text": text, "rendered": rendered,
+                            "score": score, "tokens": tokens})
+            if len(results) >= max_passages or token_budget - used < 10:
+                break
+        return results
+
+    def search(self, query: str, max_results: int = 5, mode: str = "keyword",
+               token_budget: Optional[int] = None) -> List[str]:
         """
         Search the knowledge base for relevant content.
         
         Args:
             query: Search query string
             max_results: Maximum number of results to return
+            mode: "keyword" returns matches in source-priority order;
+                  "bm25" returns matches in relevance order;
+                  "passages" returns the best passages (not whole pages) in relevance order
+            token_budget: "passages" mode only: total estimated tokens of the results
+                          (default DEFAULT_PASSAGE_TOKEN_BUDGET)
             
         Returns:
             List of relevant content strings
         """
         if not query:
             return []
-        
-        query_lower = query.lower()
+
+        if mode == "passages":
+            budget = DEFAULT_PASSAGE_TOKEN_BUDGET if token_budget is None else token_budget
+            return [p["rendered"] for p in self.search_passages(query, budget, max_passages=max_results)]
+
+        if mode == "bm25":
+            results = self._search_bm25(query, max_results)
+            if not results:
+                results = [item.get("content", "") for item in self.training_knowledge[:max_results]]
+                results = [content for content in results if content]
+            return results[:max_results]
+        if mode != "keyword":
+            raise ValueError(f"Unknown search mode: {mode}")
+
+        keywords = {keyword for keyword in query.lower().split() if len(keyword) > 2}
+        doc_ids = set()
+        for keyword in keywords:
+            doc_ids.update(self._postings_for_keyword(keyword))
+
         results = []
         seen_content = set()  # Avoid duplicates
-        
-        # Search in training knowledge
-        for item in self.training_knowledge:
-            title = item.get("title", "").lower()
-            content = item.get("content", "")
-            
-            # Simple keyword matching
-            if any(keyword in title or keyword in content.lower() 
-                   for keyword in query_lower.split() if len(keyword) > 2):
-                if content and content not in seen_content:
-                    results.append(content)
-                    seen_content.add(content)
-                    if len(results) >= max_results:
-                        break
-        
-        # Search in full MAE site crawl (catalog, handbook, etc.)
-        if len(results) < max_results:
-            for item in self.mae_full_site_knowledge:
-                question = item.get("question", "").lower()
-                answer = item.get("answer", "")
-                if any(keyword in question or keyword in answer.lower()
-                       for keyword in query_lower.split() if len(keyword) > 2):
-                    combined = f"{item.get('question', '')}: {answer}"
-                    if combined not in seen_content:
-                        results.append(combined)
-                        seen_content.add(combined)
-                        if len(results) >= max_results:
-                            break
-
-        # Search in UF MAE website knowledge
-        if len(results) < max_results:
-            for item in self.uf_mae_knowledge:
-                question = item.get("question", "").lower()
-                answer = item.get("answer", "")
-                if any(keyword in question or keyword in answer.lower()
-                       for keyword in query_lower.split() if len(keyword) > 2):
-                    combined = f"{item.get('question', '')}: {answer}"
-                    if combined not in seen_content:
-                        results.append(combined)
-                        seen_content.add(combined)
-                        if len(results) >= max_results:
-                            break
-
-        # Search in FAQ knowledge
-        if len(results) < max_results:
-            for item in self.faq_knowledge:
-                question = item.get("question", "").lower()
-                answer = item.get("answer", "")
-                
-                # Match question or answer
-                if any(keyword in question or keyword in answer.lower() 
-                       for keyword in query_lower.split() if len(keyword) > 2):
-                    # Combine question and answer for context
-                    combined = f"{item.get('question', '')}: {answer}"
-                    if combined not in seen_content:
-                        results.append(combined)
-                        seen_content.add(combined)
-                        if len(results) >= max_results:
-                            break
-        
-        # Search in scenario knowledge (flatten all scenarios)
-        if len(results) < max_results:
-            for persona, scenarios in self.scenario_knowledge.items():
-                for scenario_item in scenarios:
-                    scenario_text = scenario_item.get("scenario", "").lower()
-                    responses = scenario_item.get("responses", [])
-                    
-                    if any(keyword in scenario_text 
-                           for keyword in query_lower.split() if len(keyword) > 2):
-                        # Combine scenario and responses
-                        combined = f"{scenario_item.get('scenario', '')}: " + \
-                                  "; ".join(responses[:2])  # Take first 2 responses
-                        if combined not in seen_content:
-                            results.append(combined)
-                            seen_content.add(combined)
-                            if len(results) >= max_results:
-                                break
+
+        # Document ids follow source priority: training, full site, UF MAE, FAQ, scenarios
+        for doc_id in sorted(doc_ids):
+            text = self._documents[doc_id]
+            if text not in seen_content:
+                results.append(text)
+                seen_content.add(text)
                 if len(results) >= max_results:
                     break
-        
+
         # If no results found, return some general knowledge
         if not results:
             # Return first few training knowledge items as fallback
@@ -181,12 +772,104 @@ class SimpleKnowledgeBase:
                 content = item.get("content", "")
                 if content:
                     results.append(content)
-        
+
         return results[:max_results]
 
 
+def get_shared_knowledge_base(knowledge_base_dir: str = None) -> SimpleKnowledgeBase:
+    """
+    Return the process-wide SimpleKnowledgeBase for a directory.
+
+    All Streamlit sessions share one instance, which must be treated as
+    read-only. It is rebuilt only when a JSON file in the directory is added,
+    removed or modified; otherwise this costs one stat() per file.
+    """
+    kb_dir = _resolve_knowledge_base_dir(knowledge_base_dir).resolve()
+    signature = _knowledge_files_signature(kb_dir)
+
+    cached = _SHARED_KNOWLEDGE_BASES.get(kb_dir)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with _SHARED_LOCK:
+        cached = _SHARED_KNOWLEDGE_BASES.get(kb_dir)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        kb = SimpleKnowledgeBase(kb_dir)
+        _SHARED_KNOWLEDGE_BASES[kb_dir] = (signature, kb)
+        return kb
+
+
 # For testing
+def test_snapshot():
+    """快照自测：与直接从 JSON 构建的结果一致；头部是 JSON，旧的 pickle 快照不会被反序列化"""
+    import pickle
+    import shutil
+    import tempfile
+
+    source_dir = _resolve_knowledge_base_dir(None)
+    queries = ["MAE advising student opening prompt", "thesis defense", "advis", "financial aid deadline", "zzzqqq"]
+    with tempfile.TemporaryDirectory() as tmp:
+        kb_dir = Path(tmp)
+        for path in source_dir.glob("*.json"):
+            shutil.copy2(path, kb_dir / path.name)
+
+        fresh = SimpleKnowledgeBase(tmp, use_snapshot=False)
+        snapshot_path = fresh.write_snapshot()
+        snap = SimpleKnowledgeBase(tmp)
+        assert snap._snapshot_buffer is not None
+        assert not set(_CORPUS_FILES) & set(snap.__dict__)
+        for query in queries:
+            for mode in ("keyword", "bm25", "passages"):
+                assert snap.search(query, mode=mode) == fresh.search(query, mode=mode), (query, mode)
+            assert snap.search_passages(query) == fresh.search_passages(query), query
+            json.dumps(snap.search_passages(query))
+
+        # 原始语料不在快照里，首次访问时才从 JSON 读取（关键词检索无结果时会回退到 training_knowledge）
+        data = snapshot_path.read_bytes()
+        magic, header_len = _SNAPSHOT_PREFIX.unpack_from(data, 0)
+        header = json.loads(data[_SNAPSHOT_PREFIX.size:_SNAPSHOT_PREFIX.size + header_len])
+        assert magic == _SNAPSHOT_MAGIC and "corpora" not in header
+        for name in _CORPUS_FILES:
+            assert getattr(snap, name) == getattr(fresh, name), name
+
+        # 旧格式 (pickle 头部) 与被篡改的快照：直接忽略并重建，绝不 unpickle
+        marker = kb_dir / "unpickled"
+
+        class _Payload:
+            def __reduce__(self):
+                return os.makedirs, (str(marker),)
+
+        payload = pickle.dumps({"version": _SNAPSHOT_VERSION, "exploit": _Payload()})
+        for magic in (b"SKBSNAP1", _SNAPSHOT_MAGIC):
+            snapshot_path.write_bytes(_SNAPSHOT_PREFIX.pack(magic, len(payload)) + payload)
+            kb = SimpleKnowledgeBase(tmp)
+            assert kb._snapshot_buffer is None and not marker.exists()
+            assert kb.search(queries[0]) == fresh.search(queries[0])
+
+        # JSON 文件变了：快照过期，重建
+        fresh.write_snapshot()
+        faq_path = kb_dir / "faq_knowledge.json"
+        faq = json.loads(faq_path.read_text(encoding="utf-8"))
+        faq_path.write_text(json.dumps(faq[:-1]), encoding="utf-8")
+        kb = SimpleKnowledgeBase(tmp)
+        assert kb._snapshot_buffer is None and len(kb.faq_knowledge) == len(faq) - 1
+        del snap, kb
+    print("✅ Knowledge base snapshot test passed")
+
+
 if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "selftest":
+        test_snapshot()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "build-snapshot":
+        kb = SimpleKnowledgeBase(sys.argv[2] if len(sys.argv) > 2 else None, use_snapshot=False)
+        print(f"✅ Snapshot written to {kb.write_snapshot()} ({len(kb._documents)} documents)")
+        sys.exit(0)
+
     kb = SimpleKnowledgeBase()
     print("Knowledge base loaded:")
     print(f"  Training knowledge: {len(kb.training_knowledge)} items")
@@ -194,10 +877,13 @@ if __name__ == "__main__":
     print(f"  UF MAE website knowledge: {len(kb.uf_mae_knowledge)} items")
     print(f"  MAE full site crawl: {len(kb.mae_full_site_knowledge)} items")
     print(f"  Scenario knowledge: {len(kb.scenario_knowledge)} personas")
+    print(f"  Loaded from snapshot: {kb._snapshot_buffer is not None}")
     
     # Test search
     test_query = "MAE advising student opening prompt"
-    results = kb.search(test_query)
-    print(f"\nSearch results for '{test_query}':")
-    for i, result in enumerate(results, 1):
-        print(f"  {i}. {result[:100]}...")
+    for mode in ("keyword", "bm25", "passages"):
+        results = kb.search(test_query, mode=mode)
+        total_tokens = sum(estimate_tokens(result) for result in results)
+        print(f"\nSearch results for '{test_query}' ({mode}, ~{total_tokens} tokens):")
+        for i, result in enumerate(results, 1):
+            print(f"  {i}. {result[:100]}...")
@@ -2,15 +2,77 @@
 UF MAE Website Real-time Scraper
 实时搜索 UF MAE 网站获取最新信息（特别是课程信息）
 """
+import hashlib
 import requests
 from bs4 import BeautifulSoup
-from typing import List, Dict, Optional, Set
+from typing import Any, Callable, List, Dict, Optional, Set, Tuple
 import re
+import os
 import time
 import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from urllib.parse import urljoin, urlparse, unquote
 
+from http_cache import CachingSession
+from crawl_throttle import HostRateLimiter, RobotsCache, parse_retry_after
+from crawl_dedup import BoilerplateFilter, NearDuplicateIndex, line_shingles, simhash
+from passage_chunker import chunk_lines
+
+DEFAULT_CRAWL_WORKERS = 4
+DEFAULT_FULL_SITE_KNOWLEDGE_PATH = Path(__file__).parent / "knowledge_base" / "mae_full_site_knowledge.json"
+DEFAULT_FULL_SITE_PASSAGES_PATH = Path(__file__).parent / "knowledge_base" / "mae_full_site_passages.json"
+# 增量爬取的 manifest 不能放 knowledge_base/（那里的 *.json 会参与知识库签名）
+DEFAULT_CRAWL_MANIFEST_PATH = Path(__file__).parent / "data" / "mae_crawl_manifest.json"
+# 每页保存的行数 / 字符上限（去除样板之后再截断）
+MAX_PAGE_LINES = 80
+MAX_PAGE_CHARS = 2000
+MAX_RAW_PAGE_LINES = 400
+# 429 / 5xx 时同一 URL 最多重试次数
+MAX_CRAWL_RETRIES = 2
+
+# 课程代码，如 EML2023 / EML2023L
+COURSE_CODE_PATTERN = re.compile(r"\b([A-Z]{3}\d{4})([A-Z]?)\b")
+
+
+def _read_json(path: Path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Warning: Could not read {path}, starting fresh: {e}")
+        return default
+
+
+def _passages_path_for(knowledge_path: Path) -> Path:
+    """mae_full_site_knowledge.json -> mae_full_site_passages.json (same directory)."""
+    stem = knowledge_path.stem
+    stem = stem[:-len("_knowledge")] if stem.endswith("_knowledge") else stem
+    return knowledge_path.with_name(f"{stem}_passages.json")
+
+
+def _crawl_workers(workers: Optional[int] = None) -> int:
+    """Explicit worker count, else env UF_CRAWL_WORKERS (malformed -> DEFAULT_CRAWL_WORKERS)."""
+    if not workers:
+        try:
+            workers = int(os.getenv("UF_CRAWL_WORKERS", DEFAULT_CRAWL_WORKERS))
+        except ValueError:
+            print(f"⚠️ Invalid UF_CRAWL_WORKERS, using {DEFAULT_CRAWL_WORKERS}")
+            workers = DEFAULT_CRAWL_WORKERS
+    return max(1, workers)
+
+
+def _write_json_atomic(path: Path, data, indent: Optional[int] = None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
 
 class UFMAEWebScraper:
     """实时搜索 UF MAE 网站的工具类"""
@@ -22,11 +84,112 @@ class UFMAEWebScraper:
         "fall": "https://mae.ufl.edu/undergraduate/course-schedules/fall-2025/"
     }
     
-    def __init__(self):
-        self.session = requests.Session()
+    def __init__(
+        self,
+        use_cache: bool = True,
+        cache_dir: Optional[str] = None,
+        allowed_domains: Optional[List[str]] = None,
+    ):
+        """
+        Args:
+            use_cache: 交互查询（课程表、search_website）通过磁盘 HTTP 缓存取页面
+                （ETag / Last-Modified 条件请求，过期后后台刷新）；全站爬取始终直接请求
+            cache_dir: 缓存目录（默认 data/.http_cache，或环境变量 UF_SCRAPER_CACHE_DIR）
+            allowed_domains: 爬虫允许的域名（含子域名），默认 mae.ufl.edu
+        """
+        self.allowed_domains = [d.lower() for d in (allowed_domains or [urlparse(self.BASE_URL).hostname])]
+        self.session = CachingSession(cache_dir) if use_cache else requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         })
+        # url -> (页面内容 sha1, 解析结果)；页面字节不变就不再跑 BeautifulSoup
+        self._parsed: Dict[str, Tuple[str, Any]] = {}
+        self._parsed_lock = threading.Lock()
+        self.parse_stats = {"parse_hits": 0, "parses": 0}
+
+    def _crawl_session(self) -> requests.Session:
+        """Plain session for crawls (same headers), so crawled pages are always fetched live, never from the HTTP cache."""
+        session = requests.Session()
+        session.headers.update(self.session.headers)
+        return session
+
+    def _get_parsed(self, url: str, parse_fn: Callable[[bytes], Any]) -> Any:
+        """
+        Fetch `url` (through the HTTP cache) and return parse_fn(content), reusing
+        the previous result while the page content hash is unchanged.
+        """
+        response = self.session.get(url, timeout=10)
+        response.raise_for_status()
+        digest = hashlib.sha1(response.content).hexdigest()
+        with self._parsed_lock:
+            cached = self._parsed.get(url)
+            if cached and cached[0] == digest:
+                self.parse_stats["parse_hits"] += 1
+                return cached[1]
+        artifact = parse_fn(response.content)
+        with self._parsed_lock:
+            self._parsed[url] = (digest, artifact)
+            self.parse_stats["parses"] += 1
+        return artifact
+
+    @staticmethod
+    def _parse_course_schedule(content: bytes) -> Dict[str, Any]:
+        """
+        Course rows of a schedule page, plus a course code -> row positions index.
+        Returns {"rows", "row_texts" (upper-cased joined values), "code_index", "page_text"}.
+        """
+        soup = BeautifulSoup(content, 'html.parser')
+        rows_out: List[Dict[str, str]] = []
+        
+        # 尝试不同的表格结构
+        for table in soup.find_all('table'):
+            rows = table.find_all('tr')
+            headers = []
+            
+            # 获取表头
+            if rows:
+                header_row = rows[0]
+                headers = [th.get_text(strip=True) for th in header_row.find_all(['th', 'td'])]
+            
+            # 解析数据行
+            for row in rows[1:]:
+                cells = row.find_all(['td', 'th'])
+                if len(cells) < 2:
+                    continue
+                
+                course_data = {}
+                for i, cell in enumerate(cells):
+                    header = headers[i] if i < len(headers) else f"col_{i}"
+                    course_data[header] = cell.get_text(strip=True)
+                if course_data:
+                    rows_out.append(course_data)
+        
+        row_texts = [' '.join(row.values()).upper() for row in rows_out]
+        code_index: Dict[str, List[int]] = {}
+        for idx, text in enumerate(row_texts):
+            for base, suffix in COURSE_CODE_PATTERN.findall(text):
+                # EML2023L 同时挂在 EML2023 下（与原来的子串匹配一致）
+                for key in {base, base + suffix}:
+                    positions = code_index.setdefault(key, [])
+                    if not positions or positions[-1] != idx:
+                        positions.append(idx)
+        return {
+            "rows": rows_out,
+            "row_texts": row_texts,
+            "code_index": code_index,
+            "page_text": soup.get_text(),
+        }
+
+    @staticmethod
+    def _parse_homepage(content: bytes) -> List[Tuple[str, str]]:
+        """Candidate paragraphs of the homepage as (text, lowercased text)."""
+        page_text = BeautifulSoup(content, 'html.parser').get_text()
+        paragraphs = []
+        for para in page_text.split('\n'):
+            para = para.strip()
+            if 20 < len(para) < 500:
+                paragraphs.append((para, para.lower()))
+        return paragraphs
     
     def search_course_schedule(self, semester: str = "spring", course_code: Optional[str] = None) -> List[Dict]:
         """
@@ -41,46 +204,23 @@ class UFMAEWebScraper:
         """
         try:
             url = self.COURSE_SCHEDULE_URLS.get(semester.lower(), self.COURSE_SCHEDULE_URLS["spring"])
-            response = self.session.get(url, timeout=10)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.content, 'html.parser')
-            courses = []
+            schedule = self._get_parsed(url, self._parse_course_schedule)
+            rows = schedule["rows"]
             
-            # 尝试不同的表格结构
-            tables = soup.find_all('table')
-            for table in tables:
-                rows = table.find_all('tr')
-                headers = []
-                
-                # 获取表头
-                if rows:
-                    header_row = rows[0]
-                    headers = [th.get_text(strip=True) for th in header_row.find_all(['th', 'td'])]
-                
-                # 解析数据行
-                for row in rows[1:]:
-                    cells = row.find_all(['td', 'th'])
-                    if len(cells) < 2:
-                        continue
-                    
-                    course_data = {}
-                    for i, cell in enumerate(cells):
-                        header = headers[i] if i < len(headers) else f"col_{i}"
-                        course_data[header] = cell.get_text(strip=True)
-                    
-                    # 如果指定了课程代码，进行过滤
-                    if course_code:
-                        course_text = ' '.join(course_data.values()).upper()
-                        if course_code.upper() not in course_text:
-                            continue
-                    
-                    if course_data:
-                        courses.append(course_data)
+            # 如果指定了课程代码，进行过滤：完整课程代码直接查索引，其余（如 "EML"）按子串扫描
+            if course_code:
+                code = course_code.upper()
+                if COURSE_CODE_PATTERN.fullmatch(code):
+                    positions = schedule["code_index"].get(code, [])
+                else:
+                    positions = [i for i, text in enumerate(schedule["row_texts"]) if code in text]
+                courses = [dict(rows[i]) for i in positions[:10]]
+            else:
+                courses = [dict(row) for row in rows[:10]]
             
             # 如果没有找到表格，尝试搜索文本内容
             if not courses:
-                page_text = soup.get_text()
+                page_text = schedule["page_text"]
                 if course_code:
                     # 搜索包含课程代码的段落
                     pattern = rf'\b{re.escape(course_code.upper())}\b[^\n]*'
@@ -131,23 +271,15 @@ class UFMAEWebScraper:
             
             # 搜索主页面
             try:
-                response = self.session.get(self.BASE_URL, timeout=10)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.content, 'html.parser')
-                
-                # 搜索包含关键词的文本
-                page_text = soup.get_text()
-                query_words = query.lower().split()
+                paragraphs = self._get_parsed(self.BASE_URL, self._parse_homepage)
+                query_words = [word for word in query.lower().split() if len(word) > 2]
                 
                 # 查找包含关键词的段落
-                paragraphs = page_text.split('\n')
-                for para in paragraphs:
-                    para_lower = para.lower()
-                    if any(word in para_lower for word in query_words if len(word) > 2):
-                        if len(para.strip()) > 20 and len(para.strip()) < 500:
-                            results.append(para.strip())
-                            if len(results) >= max_results:
-                                break
+                for para, para_lower in paragraphs:
+                    if any(word in para_lower for word in query_words):
+                        results.append(para)
+                        if len(results) >= max_results:
+                            break
             except Exception as e:
                 print(f"⚠️ Error searching main page: {e}")
             
@@ -158,10 +290,9 @@ class UFMAEWebScraper:
             return []
     
     def _is_same_domain(self, url: str) -> bool:
-        """Check if URL belongs to mae.ufl.edu."""
-        parsed = urlparse(url)
-        netloc = parsed.netloc.lower()
-        return "mae.ufl.edu" in netloc or netloc == "mae.ufl.edu"
+        """Check if URL belongs to one of the allowed domains (mae.ufl.edu by default)."""
+        host = (urlparse(url).hostname or "").lower()
+        return any(host == d or host.endswith("." + d) for d in self.allowed_domains)
 
     def _normalize_url(self, base: str, href: str) -> Optional[str]:
         """Resolve relative URL and return absolute URL if same domain."""
@@ -173,13 +304,161 @@ class UFMAEWebScraper:
             return None
         return full if self._is_same_domain(full) else None
 
-    def _extract_text(self, soup: BeautifulSoup) -> str:
-        """Extract main text, skip nav/footer/script."""
+    def _extract_lines(self, soup: BeautifulSoup, limit: int = MAX_RAW_PAGE_LINES) -> List[str]:
+        """Main text lines (> 15 chars), skipping nav/footer/script."""
         for tag in soup.find_all(["script", "style", "nav", "footer", "header"]):
             tag.decompose()
         text = soup.get_text(separator="\n")
         lines = [ln.strip() for ln in text.splitlines() if ln.strip() and len(ln.strip()) > 15]
-        return "\n".join(lines[:80])  # cap length per page
+        return lines[:limit]
+
+    def _extract_text(self, soup: BeautifulSoup) -> str:
+        """Extract main text, skip nav/footer/script."""
+        return "\n".join(self._extract_lines(soup, MAX_PAGE_LINES))  # cap length per page
+
+    def _crawl_page(
+        self,
+        url: str,
+        limiter: HostRateLimiter,
+        robots: Optional[RobotsCache],
+        session: Optional[requests.Session] = None,
+        previous: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[str, Optional[Dict[str, str]], List[str], Dict[str, Any]]:
+        """
+        Fetch and parse one page (runs on a crawler worker).
+
+        With `previous` (the page's manifest entry) the request is conditional, and
+        a 304 or byte-identical body is reported as "unchanged" without re-parsing
+        (outlinks come from the manifest).
+
+        Returns (status, record, outlinks, meta); record is {url, title, lines} and
+        status is "ok", "unchanged",
+        "retry", "gone" (404/410), "skip" or "robots"; meta holds the validators
+        and body hash.
+        """
+        session = session or self.session
+        host = urlparse(url).netloc.lower()
+        if robots is not None and not robots.can_fetch(url):
+            return "robots", None, [], {}
+        headers = {}
+        if previous:
+            if previous.get("etag"):
+                headers["If-None-Match"] = previous["etag"]
+            if previous.get("last_modified"):
+                headers["If-Modified-Since"] = previous["last_modified"]
+        limiter.acquire(host)
+        started = time.monotonic()
+        try:
+            resp = session.get(url, timeout=15, headers=headers or None)
+        except requests.RequestException as e:
+            limiter.observe(host, time.monotonic() - started, ok=False)
+            print(f"⚠️ Skip {url}: {e}")
+            return "retry", None, [], {}
+        latency = time.monotonic() - started
+        if resp.status_code == 429 or resp.status_code >= 500:
+            limiter.observe(host, latency, ok=False, retry_after=parse_retry_after(resp.headers.get("Retry-After")))
+            return "retry", None, [], {}
+        limiter.observe(host, latency, ok=True)
+        meta = {
+            "etag": resp.headers.get("ETag") or (previous or {}).get("etag"),
+            "last_modified": resp.headers.get("Last-Modified") or (previous or {}).get("last_modified"),
+        }
+        if resp.status_code == 304 and previous:
+            meta["body_hash"] = previous.get("body_hash")
+            return "unchanged", None, list(previous.get("outlinks", [])), meta
+        if resp.status_code in (404, 410):
+            return "gone", None, [], {}
+        if resp.status_code >= 400:
+            print(f"⚠️ Skip {url}: HTTP {resp.status_code}")
+            return "skip", None, [], {}
+
+        meta["body_hash"] = hashlib.sha1(resp.content).hexdigest()
+        if previous and previous.get("body_hash") == meta["body_hash"]:
+            return "unchanged", None, list(previous.get("outlinks", [])), meta
+
+        soup = BeautifulSoup(resp.content, "html.parser")
+        title = (soup.find("title") or soup.find("h1"))
+        title_text = title.get_text(strip=True) if title else ""
+        lines = self._extract_lines(soup)
+        record = None
+        if lines:
+            # 样板去除、截断在整站统计之后做（见 _finalize_page）
+            record = {
+                "url": url,
+                "title": title_text or url,
+                "lines": lines,
+            }
+        outlinks = []
+        for a in soup.find_all("a", href=True):
+            next_url = self._normalize_url(url, a["href"])
+            if next_url:
+                outlinks.append(next_url)
+        return "ok", record, outlinks, meta
+
+    def _run_crawl(
+        self,
+        start_url: str,
+        max_pages: int,
+        max_depth: int,
+        delay_sec: float,
+        workers: Optional[int],
+        respect_robots: bool,
+        session: Optional[requests.Session] = None,
+        manifest: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> Tuple[List[Tuple[int, str, str, Optional[Dict[str, str]], List[str], Dict[str, Any]]], bool]:
+        """
+        Breadth-first crawl on a worker pool. Returns (pages, complete): pages are
+        (discovery order, url, status, record, outlinks, meta) per finished URL, and
+        complete is False when max_pages cut the crawl short.
+        """
+        session = session or self.session
+        workers = _crawl_workers(workers)
+        manifest = manifest or {}
+        limiter = HostRateLimiter(delay_sec=delay_sec)
+        # robots.txt 也按 host 限速；每个 host 的 Crawl-delay 在首次读取时写入它自己的令牌桶
+        robots = (RobotsCache(session, user_agent=session.headers.get("User-Agent", "*"), limiter=limiter)
+                  if respect_robots else None)
+
+        # frontier: (发现顺序, url, depth, 已重试次数)
+        frontier = deque([(0, start_url, 0, 0)])
+        queued: Set[str] = {start_url}
+        dispatched = 0
+        pages = []
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mae-crawl") as pool:
+            while frontier or in_flight:
+                while frontier and len(in_flight) < workers and dispatched < max_pages:
+                    order, url, depth, attempts = frontier.popleft()
+                    if depth > max_depth:
+                        continue
+                    if attempts == 0:
+                        dispatched += 1
+                    future = pool.submit(self._crawl_page, url, limiter, robots, session, manifest.get(url))
+                    in_flight[future] = (order, url, depth, attempts)
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    order, url, depth, attempts = in_flight.pop(future)
+                    try:
+                        status, record, outlinks, meta = future.result()
+                    except Exception as e:
+                        print(f"⚠️ Skip {url}: {e}")
+                        status, record, outlinks, meta = "skip", None, [], {}
+                    if status == "retry" and attempts < MAX_CRAWL_RETRIES:
+                        frontier.append((order, url, depth, attempts + 1))
+                        continue
+                    pages.append((order, url, status, record, outlinks, meta))
+                    if depth < max_depth:
+                        for next_url in outlinks:
+                            if next_url not in queued:
+                                queued.add(next_url)
+                                frontier.append((len(queued) - 1, next_url, depth + 1, 0))
+
+        pages.sort(key=lambda page: page[0])
+        return pages, not frontier
 
     def crawl_full_site(
         self,
@@ -187,57 +466,232 @@ class UFMAEWebScraper:
         max_pages: int = 150,
         max_depth: int = 5,
         delay_sec: float = 0.6,
+        workers: Optional[int] = None,
+        respect_robots: bool = True,
+        dedup: bool = True,
     ) -> List[Dict[str, str]]:
         """
-        Recursively crawl MAE site (About, People, Undergraduate, Graduate, Research, etc.).
-        Returns list of {url, title, content} for knowledge base.
+        Crawl MAE site (About, People, Undergraduate, Graduate, Research, etc.) breadth-first.
+        Returns list of {url, title, content, passages} for knowledge base, in discovery order.
+
+        Pages are fetched by `workers` threads (default env UF_CRAWL_WORKERS or 4).
+        A per-host token bucket spaces requests `delay_sec` apart. The spacing backs
+        off on slow responses, 429/5xx and Retry-After, and honours robots.txt
+        (Disallow, Crawl-delay). workers=1 crawls one page at a time.
+
+        With dedup, line blocks repeated across many pages (sidebars, footers) are
+        stripped before each page is truncated, and pages whose remaining text is
+        near-identical (SimHash) to an earlier page are skipped.
         """
         start_url = start_url or self.BASE_URL
         if not self._is_same_domain(start_url):
             return []
-        visited: Set[str] = set()
-        queued: Set[str] = {start_url}
-        results: List[Dict[str, str]] = []
-        queue: List[tuple] = [(start_url, 0)]
+        session = self._crawl_session()
+        try:
+            pages, _ = self._run_crawl(start_url, max_pages, max_depth, delay_sec, workers, respect_robots,
+                                       session=session)
+        finally:
+            session.close()
+        records = [record for _, _, status, record, _, _ in pages if status == "ok" and record]
 
-        while queue and len(visited) < max_pages:
-            url, depth = queue.pop(0)
-            if url in visited or depth > max_depth:
+        boilerplate = BoilerplateFilter() if dedup else None
+        if boilerplate is not None:
+            for record in records:
+                boilerplate.add_page(record["url"], line_shingles(record["lines"]))
+        near_dups = NearDuplicateIndex()
+        results = []
+        for record in records:
+            page = self._finalize_page(record, boilerplate)
+            if page is None:
                 continue
-            visited.add(url)
-            try:
-                resp = self.session.get(url, timeout=15)
-                resp.raise_for_status()
-                soup = BeautifulSoup(resp.content, "html.parser")
-                title = (soup.find("title") or soup.find("h1"))
-                title_text = title.get_text(strip=True) if title else ""
-                content = self._extract_text(soup)
-                if content and len(content) > 30:
-                    results.append({
-                        "url": url,
-                        "title": title_text or url,
-                        "content": content[:2000],
-                    })
-                for a in soup.find_all("a", href=True):
-                    next_url = self._normalize_url(url, a["href"])
-                    if next_url and next_url not in queued:
-                        queued.add(next_url)
-                        queue.append((next_url, depth + 1))
-                time.sleep(delay_sec)
-            except Exception as e:
-                print(f"⚠️ Skip {url}: {e}")
+            if dedup:
+                fingerprint = simhash(page["content"])
+                duplicate_of = near_dups.find(fingerprint)
+                if duplicate_of:
+                    print(f"⚠️ Skip {page['url']}: near-duplicate of {duplicate_of}")
+                    continue
+                near_dups.add(page["url"], fingerprint)
+            results.append(page)
         return results
 
+    @staticmethod
+    def _finalize_page(record: Dict[str, Any], boilerplate: Optional[BoilerplateFilter]) -> Optional[Dict[str, Any]]:
+        """
+        {url, title, lines} -> {url, title, content, passages}: boilerplate removed,
+        content capped as before, and overlapping passages over all remaining lines.
+        """
+        lines = boilerplate.strip(record["lines"]) if boilerplate is not None else record["lines"]
+        content = "\n".join(lines[:MAX_PAGE_LINES])
+        if not content or len(content) <= 30:
+            return None
+        return {"url": record["url"], "title": record["title"], "content": content[:MAX_PAGE_CHARS],
+                "passages": chunk_lines(lines)}
+
+    @staticmethod
+    def _passage_items(page: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Crawled page -> mae_full_site_passages.json entries."""
+        return [{"source": page["url"], "title": page["title"], "chunk": i, "text": text}
+                for i, text in enumerate(page.get("passages", []))]
+
+    @staticmethod
+    def _knowledge_item(record: Dict[str, str]) -> Dict[str, str]:
+        """Crawled page -> mae_full_site_knowledge.json entry."""
+        return {"question": f"{record['title']} ({record['url']})", "answer": record["content"], "source": record["url"]}
+
     def crawl_and_save_to_json(self, output_path: str = None, **kwargs) -> str:
-        """Crawl full site and save to JSON. Returns path to saved file."""
-        output_path = output_path or str(Path(__file__).parent / "knowledge_base" / "mae_full_site_knowledge.json")
+        """
+        Crawl full site and save to JSON. Returns path to saved file.
+        Passages are written next to it (mae_full_site_passages.json).
+        """
+        output_path = output_path or str(DEFAULT_FULL_SITE_KNOWLEDGE_PATH)
         Path(output_path).parent.mkdir(parents=True, exist_ok=True)
         data = self.crawl_full_site(**kwargs)
-        out = [{"question": f"{d['title']} ({d['url']})", "answer": d["content"], "source": d["url"]} for d in data]
+        out = [self._knowledge_item(d) for d in data]
         with open(output_path, "w", encoding="utf-8") as f:
             json.dump(out, f, ensure_ascii=False, indent=2)
+        passages = [p for d in data for p in self._passage_items(d)]
+        _write_json_atomic(_passages_path_for(Path(output_path)), passages, indent=2)
         return output_path
 
+    def crawl_incremental(
+        self,
+        output_path: str = None,
+        manifest_path: str = None,
+        start_url: str = None,
+        max_pages: int = 150,
+        max_depth: int = 5,
+        delay_sec: float = 0.6,
+        workers: Optional[int] = None,
+        respect_robots: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Re-crawl the site and patch the knowledge JSON in place instead of rewriting it.
+
+        A manifest (url -> ETag, Last-Modified, body/content hash, last_seen, outlinks)
+        makes every request conditional. 304s and byte-identical pages are not
+        re-parsed, and their links come from the manifest. Changed pages update their
+        entry; new pages are appended; pages that return 404/410, are now disallowed
+        by robots.txt, or are no longer linked (only when the crawl was not cut short
+        by max_pages) are deleted. The knowledge file is only rewritten when something
+        changed, so the KB snapshot / vector index are only rebuilt then. The
+        passages file is patched the same way (changed pages are re-chunked).
+
+        Boilerplate statistics cover every page in the manifest (line shingles are
+        stored per page), and a changed page that is now a near-duplicate of a
+        kept page is dropped like in crawl_full_site.
+
+        Returns {"added": [...urls], "updated": [...], "deleted": [...], "unchanged": n,
+        "fetched": n, "complete": bool, "output_path": str}.
+        """
+        output_path = Path(output_path or DEFAULT_FULL_SITE_KNOWLEDGE_PATH)
+        manifest_path = Path(manifest_path or DEFAULT_CRAWL_MANIFEST_PATH)
+        start_url = start_url or self.BASE_URL
+        summary: Dict[str, Any] = {"added": [], "updated": [], "deleted": [], "unchanged": 0,
+                                   "fetched": 0, "complete": False, "output_path": str(output_path)}
+        if not self._is_same_domain(start_url):
+            return summary
+
+        knowledge = _read_json(output_path, [])
+        passages_path = _passages_path_for(output_path)
+        passages: Dict[str, List[Dict[str, Any]]] = {}
+        for passage in _read_json(passages_path, []):
+            passages.setdefault(passage.get("source"), []).append(passage)
+        passages_changed = False
+        manifest_doc = _read_json(manifest_path, {})
+        manifest: Dict[str, Dict[str, Any]] = manifest_doc.get("pages", {})
+
+        # 条件请求要用 manifest 里的校验值，不走 CachingSession（否则会直接拿磁盘缓存）
+        session = self._crawl_session()
+        try:
+            pages, complete = self._run_crawl(start_url, max_pages, max_depth, delay_sec, workers,
+                                              respect_robots, session=session, manifest=manifest)
+        finally:
+            session.close()
+        summary["complete"] = complete
+
+        entries = {item.get("source"): item for item in knowledge}
+        order = [item.get("source") for item in knowledge]
+        now = time.time()
+        seen: Set[str] = set()
+
+        def delete(url: str):
+            nonlocal passages_changed
+            manifest.pop(url, None)
+            passages_changed |= passages.pop(url, None) is not None
+            if entries.pop(url, None) is not None:
+                summary["deleted"].append(url)
+
+        changed = []
+        for _, url, status, record, outlinks, meta in pages:
+            seen.add(url)
+            if status == "ok":
+                summary["fetched"] += 1
+                shingles = line_shingles(record["lines"]) if record else []
+                manifest[url] = dict(meta, shingles=shingles, last_seen=now, outlinks=outlinks)
+                changed.append((url, record))
+            elif status == "unchanged":
+                manifest[url].update(meta, last_seen=now)
+                summary["unchanged"] += 1
+            elif status in ("gone", "robots"):
+                delete(url)
+            # retry / skip：暂时失败，保留原有条目
+
+        if complete:
+            for url in [u for u in list(manifest) + list(entries) if u not in seen]:
+                delete(url)
+
+        # 样板统计基于 manifest 中所有页面；近重复只和已保留且本轮未变化的页面比较
+        boilerplate = BoilerplateFilter()
+        for url, entry in manifest.items():
+            boilerplate.add_page(url, entry.get("shingles", []))
+        changed_urls = {url for url, _ in changed}
+        near_dups = NearDuplicateIndex()
+        for url, entry in manifest.items():
+            if entry.get("simhash") and url not in changed_urls:
+                near_dups.add(url, int(entry["simhash"], 16))
+
+        for url, record in changed:
+            page = self._finalize_page(record, boilerplate) if record else None
+            item = self._knowledge_item(page) if page else None
+            fingerprint = simhash(page["content"]) if page else None
+            duplicate_of = near_dups.find(fingerprint, exclude=url) if page else None
+            if duplicate_of:
+                item = None
+            elif page:
+                near_dups.add(url, fingerprint)
+            manifest[url].update(
+                content_hash=hashlib.sha1(json.dumps(item, sort_keys=True).encode("utf-8")).hexdigest() if item else None,
+                simhash=f"{fingerprint:016x}" if item else None,
+                duplicate_of=duplicate_of,
+            )
+            new_passages = self._passage_items(page) if item else None
+            if new_passages != passages.get(url):
+                passages_changed = True
+                if new_passages:
+                    passages[url] = new_passages
+                else:
+                    passages.pop(url, None)
+            if item is None:
+                if entries.pop(url, None) is not None:
+                    summary["deleted"].append(url)
+            elif url not in entries:
+                entries[url] = item
+                order.append(url)
+                summary["added"].append(url)
+            elif entries[url] != item:
+                entries[url] = item
+                summary["updated"].append(url)
+            else:
+                summary["unchanged"] += 1
+
+        if summary["added"] or summary["updated"] or summary["deleted"]:
+            _write_json_atomic(output_path, [entries[url] for url in order if url in entries], indent=2)
+        if passages_changed:
+            _write_json_atomic(passages_path, [p for url in order if url in entries for p in passages.get(url, [])],
+                               indent=2)
+        _write_json_atomic(manifest_path, {"start_url": start_url, "updated_at": now, "pages": manifest})
+        return summary
+
     def get_course_info(self, course_code: str, semester: str = "spring") -> Optional[Dict]:
         """
         获取特定课程的详细信息
@@ -255,14 +709,234 @@ class UFMAEWebScraper:
         return None
 
 
+_SHARED_SCRAPER: Optional[UFMAEWebScraper] = None
+_SHARED_SCRAPER_LOCK = threading.Lock()
+
+
+def get_shared_scraper() -> UFMAEWebScraper:
+    """进程内共享的 scraper（共用一个带磁盘缓存的 Session），供每轮对话的实时搜索使用"""
+    global _SHARED_SCRAPER
+    with _SHARED_SCRAPER_LOCK:
+        if _SHARED_SCRAPER is None:
+            _SHARED_SCRAPER = UFMAEWebScraper()
+        return _SHARED_SCRAPER
+
+
+def test_parsed_cache():
+    """解析结果缓存 / 课程代码索引 自测（不访问网络）"""
+    pages = {
+        UFMAEWebScraper.COURSE_SCHEDULE_URLS["spring"]: (
+            b"<table><tr><th>Course</th><th>Title</th></tr>"
+            b"<tr><td>EML2023</td><td>Computer Aided Graphics</td></tr>"
+            b"<tr><td>EML2023L</td><td>Graphics Lab</td></tr>"
+            b"<tr><td>EAS4700</td><td>Aerospace Design</td></tr></table>"
+        ),
+        UFMAEWebScraper.BASE_URL: b"<p>Welcome to the Department of Mechanical and Aerospace Engineering</p>",
+    }
+
+    class _FakeResponse:
+        def __init__(self, content):
+            self.content = content
+
+        def raise_for_status(self):
+            pass
+
+    class _FakeSession:
+        headers = {}
+
+        def get(self, url, timeout=None):
+            return _FakeResponse(pages[url])
+
+    scraper = UFMAEWebScraper(use_cache=False)
+    scraper.session = _FakeSession()
+
+    assert [c["Course"] for c in scraper.search_course_schedule("spring", "EML2023")] == ["EML2023", "EML2023L"]
+    assert [c["Course"] for c in scraper.search_course_schedule("spring", "eas4700")] == ["EAS4700"]
+    assert len(scraper.search_course_schedule("spring", "EML")) == 2  # prefix -> substring scan
+    assert len(scraper.search_course_schedule("spring")) == 3
+    assert scraper.parse_stats == {"parse_hits": 3, "parses": 1}, scraper.parse_stats
+
+    pages[UFMAEWebScraper.COURSE_SCHEDULE_URLS["spring"]] += b"<table><tr><th>Course</th><th>T</th></tr><tr><td>EML3100</td><td>Thermo</td></tr></table>"
+    assert scraper.search_course_schedule("spring", "EML3100")[0]["Course"] == "EML3100"  # page changed -> re-parsed
+    assert scraper.parse_stats["parses"] == 2
+
+    assert scraper.search_website("aerospace engineering") == ["Welcome to the Department of Mechanical and Aerospace Engineering"]
+    scraper.search_website("mechanical")
+    assert scraper.parse_stats == {"parse_hits": 4, "parses": 3}, scraper.parse_stats
+    print("✅ Parsed-page cache test passed", scraper.parse_stats)
+
+
+def test_concurrent_crawl():
+    """并发爬虫自测：本地 fixture HTTP 服务器（robots.txt / 503 重试 / 站外链接 / 限速）"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import tempfile
+
+    n_pages = 16
+    hits: List[Tuple[float, str]] = []
+    flaky = {"/page3": 1}  # 第一次返回 503
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            hits.append((time.monotonic(), self.path))
+            if self.path == "/robots.txt":
+                body = b"User-agent: *\nDisallow: /private\n"
+                ctype = "text/plain"
+            elif flaky.get(self.path):
+                flaky[self.path] -= 1
+                self.send_response(503)
+                self.send_header("Retry-After", "0")
+                self.end_headers()
+                return
+            else:
+                time.sleep(0.08)  # 模拟服务器延迟
+                links = "".join(f'<a href="/page{(i * 3) % n_pages}">p</a>' for i in range(n_pages))
+                body = (f"<html><title>{self.path}</title><body><p>Fixture page {self.path} with enough text "
+                        f"to be kept.</p>{links}<a href='/private/x'>x</a>"
+                        f"<a href='https://example.com/'>off</a></body></html>").encode()
+                ctype = "text/html"
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    cache_dir = tempfile.TemporaryDirectory()
+    try:
+        timings, crawled = {}, {}
+        for workers in (1, 4):
+            hits.clear()
+            flaky["/page3"] = 1
+            # 开着 HTTP 缓存：第二次爬取仍须每页都真正请求服务器
+            scraper = UFMAEWebScraper(cache_dir=cache_dir.name, allowed_domains=["127.0.0.1"])
+            start = time.monotonic()
+            pages = scraper.crawl_full_site(base + "/", max_pages=50, delay_sec=0.02, workers=workers)
+            timings[workers] = time.monotonic() - start
+            crawled[workers] = {p["url"] for p in pages}
+
+            page_hits = sorted(t for t, path in hits if path != "/robots.txt")
+            gaps = [b - a for a, b in zip(page_hits, page_hits[1:])]
+            assert min(gaps) >= 0.015, min(gaps)  # 同一 host 的请求间隔不低于 delay_sec
+            assert not any(path.startswith("/private") for _, path in hits)
+            assert len(page_hits) >= n_pages + 1, len(page_hits)
+        expected = {base + "/"} | {f"{base}/page{i}" for i in range(n_pages)}
+        assert crawled[1] == crawled[4] == expected, crawled
+        assert timings[4] < timings[1] * 0.75, timings
+
+        os.environ["UF_CRAWL_WORKERS"] = "four"  # 写错的配置回退默认值，不让爬虫崩掉
+        try:
+            assert _crawl_workers() == DEFAULT_CRAWL_WORKERS and _crawl_workers(2) == 2
+        finally:
+            del os.environ["UF_CRAWL_WORKERS"]
+        print(f"✅ Concurrent crawl test passed: workers=1 {timings[1]:.2f}s, workers=4 {timings[4]:.2f}s")
+    finally:
+        server.shutdown()
+        cache_dir.cleanup()
+
+
+def test_incremental_crawl():
+    """增量爬取自测：ETag/304、更新、新增、删除（本地 fixture 服务器）"""
+    import hashlib as _hashlib
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    def page(text, links):
+        anchors = "".join(f'<a href="{link}">go</a>' for link in links)
+        return f"<html><title>{text[:12]}</title><body><p>{text}</p>{anchors}</body></html>".encode()
+
+    site = {
+        "/": page("Mechanical and Aerospace Engineering home page", ["/a", "/b"]),
+        "/a": page("Undergraduate advising information, version one", []),
+        "/b": page("Graduate admissions deadlines and requirements", []),
+    }
+    requests_seen: List[Tuple[str, int]] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = site.get(self.path)
+            if body is None:
+                status = 404
+            else:
+                etag = '"' + _hashlib.md5(body).hexdigest() + '"'
+                status = 304 if self.headers.get("If-None-Match") == etag else 200
+            requests_seen.append((self.path, status))
+            self.send_response(status)
+            if body is not None:
+                self.send_header("ETag", etag)
+            if status == 200:
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if status == 200:
+                self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    scraper = UFMAEWebScraper(use_cache=False, allowed_domains=["127.0.0.1"])
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            out, manifest = Path(tmp) / "kb.json", Path(tmp) / "manifest.json"
+
+            def recrawl():
+                requests_seen.clear()
+                return scraper.crawl_incremental(out, manifest, start_url=base, delay_sec=0.001, workers=2,
+                                                 respect_robots=False)
+
+            delta = recrawl()
+            assert sorted(delta["added"]) == [base, base + "/a", base + "/b"], delta
+
+            mtime = out.stat().st_mtime_ns
+            delta = recrawl()
+            assert delta["unchanged"] == 3 and not (delta["added"] or delta["updated"] or delta["deleted"]), delta
+            assert all(status == 304 for _, status in requests_seen), requests_seen
+            assert out.stat().st_mtime_ns == mtime  # 没有变化就不重写知识文件
+
+            site["/"] = page("Mechanical and Aerospace Engineering home page", ["/a", "/c"])
+            site["/a"] = page("Undergraduate advising information, version two", [])
+            site["/c"] = page("Research labs: robotics, combustion and fluids", [])
+            delta = recrawl()
+            assert delta["updated"] == [base + "/a"], delta
+            assert delta["added"] == [base + "/c"], delta
+            assert delta["deleted"] == [base + "/b"], delta  # 不再被链接
+            with open(out, encoding="utf-8") as f:
+                sources = [item["source"] for item in json.load(f)]
+            assert sources == [base, base + "/a", base + "/c"], sources
+            with open(Path(tmp) / "kb_passages.json", encoding="utf-8") as f:
+                passages = json.load(f)
+            assert [p["source"] for p in passages] == sources
+            assert "version two" in passages[1]["text"]
+        print("✅ Incremental crawl test passed")
+    finally:
+        server.shutdown()
+
+
 # 测试代码 / 全站爬取
 if __name__ == "__main__":
     import sys
     scraper = UFMAEWebScraper()
 
-    if len(sys.argv) > 1 and sys.argv[1] == "crawl":
+    if len(sys.argv) > 1 and sys.argv[1] == "recrawl":
+        print("🔄 Incremental re-crawl of the MAE site (only changed pages are re-extracted)...")
+        delta = scraper.crawl_incremental(max_pages=150, max_depth=5, delay_sec=0.6, workers=4)
+        print(f"✅ {len(delta['added'])} added, {len(delta['updated'])} updated, "
+              f"{len(delta['deleted'])} deleted, {delta['unchanged']} unchanged -> {delta['output_path']}")
+    elif len(sys.argv) > 1 and sys.argv[1] == "selftest":
+        test_parsed_cache()
+        test_concurrent_crawl()
+        test_incremental_crawl()
+    elif len(sys.argv) > 1 and sys.argv[1] == "crawl":
         print("🕷️ Crawling full MAE site (About, Undergraduate, Graduate, Research, etc.)...")
-        out_path = scraper.crawl_and_save_to_json(max_pages=150, max_depth=5, delay_sec=0.6)
+        out_path = scraper.crawl_and_save_to_json(max_pages=150, max_depth=5, delay_sec=0.6, workers=4)
         print(f"✅ Saved to {out_path}")
     else:
         print("🔍 测试 UF MAE 网站实时搜索:")
@@ -279,3 +953,4 @@ if __name__ == "__main__":
         for i, result in enumerate(results, 1):
             print(f"   {i}. {result[:100]}...")
         print("\n💡 Run with 'crawl' to crawl full site: python uf_mae_web_scraper.py crawl")
+        print("💡 Run with 'recrawl' to refresh it incrementally: python uf_mae_web_scraper.py recrawl")
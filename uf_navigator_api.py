@@ -1,13 +1,27 @@
 # uf_navigator_api.py
 import os
-from typing import Optional, Tuple, Dict, Any
+import re
+import asyncio
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional, Tuple, Dict, Any, List, Iterator, Union
 
 try:
     import streamlit as st
 except Exception:
     st = None
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+
+try:
+    import httpx  # openai 的依赖，用于进程级共享连接池
+except ImportError:
+    httpx = None
+
+from model_health import get_model_health_registry
+from response_cache import ResponseCache
+from prompt_budget import DEFAULT_PROMPT_TOKEN_BUDGET, PromptAssembler, PromptSection
 
 # 延迟导入，避免循环依赖
 try:
@@ -44,6 +58,10 @@ UF_MODEL_FALLBACKS = [
 ]
 
 
+# 学生回复的采样参数（同步 / 流式 / 异步 / 缓存 key 共用）
+STUDENT_REPLY_PARAMS = dict(max_tokens=250, temperature=0.8, presence_penalty=0.15)
+
+
 def _is_retryable_model_error(e: Exception) -> bool:
     """判断是否是"可以尝试下一个模型"的错误（服务器端模型加载失败、模型不存在等）"""
     msg = str(e).lower()
@@ -57,12 +75,87 @@ def _is_retryable_model_error(e: Exception) -> bool:
     )
 
 
+def _normalize_base_url(base_url: str) -> str:
+    """Normalize base_url - 确保有 /v1 后缀"""
+    base_url = base_url.rstrip("/")
+    if not base_url.endswith("/v1"):
+        base_url = base_url + "/v1"
+    return base_url
+
+
+def _connection_error_message(msg: str) -> str:
+    if "meta tensor" in msg.lower() or "torch" in msg.lower() or "cannot copy out of meta tensor" in msg.lower():
+        return (
+            "⚠️ Server-side model loading error detected. "
+            "The UF LiteLLM API server is having trouble loading models. "
+            "This is a server-side issue, not a client-side problem. "
+            "Please try again later or contact UF IT support."
+        )
+    return msg
+
+
+def _wrap_model_error(e: Exception) -> Exception:
+    """可重试的服务器端模型错误 -> 带 is_retryable 标记的 RuntimeError；其他错误原样返回"""
+    if _is_retryable_model_error(e):
+        retryable_error = RuntimeError(f"Model loading error (retryable): {e}")
+        retryable_error.is_retryable = True
+        return retryable_error
+    return e
+
+
+def _clean_reply(reply: str) -> str:
+    """去掉模型输出里的 HTML 标签"""
+    return re.sub(r"<[^>]+>", "", reply or "").strip()
+
+
+def _prompt_token_budget(value: Optional[int] = None) -> int:
+    """Prompt token budget: explicit value, else UF_PROMPT_TOKEN_BUDGET (0 = unlimited)."""
+    if value is not None:
+        return value
+    try:
+        return int(_get_secret("UF_PROMPT_TOKEN_BUDGET", str(DEFAULT_PROMPT_TOKEN_BUDGET)))
+    except ValueError:
+        return DEFAULT_PROMPT_TOKEN_BUDGET
+
+
+def _split_history(advisor_message: str) -> Tuple[List[str], str]:
+    """"Previous conversation: ... Now the advisor says: X" -> (history lines, X)."""
+    if "Previous conversation:" not in advisor_message or "Now the advisor says:" not in advisor_message:
+        return [], advisor_message
+    head, current = advisor_message.split("Now the advisor says:", 1)
+    context = head.replace("Previous conversation:", "", 1).strip()
+    return [line for line in context.split("\n") if line.strip()], current.strip()
+
+
+def _join_history(history_lines: List[str], current: str) -> str:
+    if not history_lines:
+        return current
+    context = "\n".join(history_lines)
+    return f"""Previous conversation:
+{context}
+
+Now the advisor says: {current}"""
+
+
+def _format_example_for_budget(example: Dict, persona: str) -> str:
+    """Approximate text of one example block in format_few_shot_prompt (for token costing)."""
+    text = f"Example:\nAdvisor: {example.get('advisor', '')}\nStudent ({persona.upper()}): {example.get('student', '')}\n"
+    if example.get("intent"):
+        text += f"Intent: {example.get('intent')}\n"
+    return text
+
+
 class UFNavigatorAPI:
     """
     Wrapper for UF LiteLLM (OpenAI-compatible) endpoint.
     Required secrets (Streamlit Cloud -> App settings -> Secrets):
       - UF_LITELLM_BASE_URL
       - UF_LITELLM_API_KEY
+    Optional:
+      - UF_MODEL_RACING=true      -> hedged model racing in generate_student_reply and,
+                                     up to the first token, in generate_student_reply_stream
+      - UF_MODEL_HEDGE_DELAY=2.0  -> seconds to wait before also asking the next model
+      - UF_PROMPT_TOKEN_BUDGET=2500 -> max student-reply prompt tokens (0 = no trimming)
     """
 
     def __init__(
@@ -70,10 +163,33 @@ class UFNavigatorAPI:
         base_url: Optional[str] = None,
         api_key: Optional[str] = None,
         timeout: float = 30.0,
+        race_models: Optional[bool] = None,
+        hedge_delay: Optional[float] = None,
+        prompt_token_budget: Optional[int] = None,
     ):
         self.base_url = (base_url or _get_secret("UF_LITELLM_BASE_URL") or "https://api.ai.it.ufl.edu").strip()
         self.api_key = (api_key or _get_secret("UF_LITELLM_API_KEY")).strip()  # ✅ 不允许硬编码默认 key
 
+        # 模型竞速（opt-in）：首选模型 hedge_delay 秒内没回复就同时请求下一个模型
+        if race_models is None:
+            race_models = _get_secret("UF_MODEL_RACING", "false").strip().lower() in ("1", "true", "yes")
+        if hedge_delay is None:
+            try:
+                hedge_delay = float(_get_secret("UF_MODEL_HEDGE_DELAY", "2.0"))
+            except ValueError:
+                hedge_delay = 2.0
+        self.race_models: bool = race_models
+        self.hedge_delay: float = max(0.0, hedge_delay)
+
+        # 每个模型的调用次数 / 成功失败次数 / 延迟（秒）
+        self._stats_lock = threading.Lock()
+        self.model_stats: Dict[str, Dict[str, float]] = {}
+        self.last_time_to_first_token: Optional[float] = None
+        self.last_model: Optional[str] = None  # 最近一次成功回复所用的模型
+        # 学生回复 prompt 的 token 预算，及最近一次组装的各部分 token 明细
+        self.prompt_token_budget: int = _prompt_token_budget(prompt_token_budget)
+        self.last_prompt_breakdown: Optional[Dict[str, Any]] = None
+
         self.last_error: str = ""
         self.client: Optional[OpenAI] = None
 
@@ -88,10 +204,7 @@ class UFNavigatorAPI:
             )
             return
 
-        # Normalize base_url - 确保有 /v1 后缀
-        self.base_url = self.base_url.rstrip("/")
-        if not self.base_url.endswith("/v1"):
-            self.base_url = self.base_url + "/v1"
+        self.base_url = _normalize_base_url(self.base_url)
 
         try:
             self.client = OpenAI(
@@ -117,14 +230,7 @@ class UFNavigatorAPI:
         except Exception as e:
             msg = str(e)
             self.last_error = msg
-            if "meta tensor" in msg.lower() or "torch" in msg.lower() or "cannot copy out of meta tensor" in msg.lower():
-                return False, (
-                    "⚠️ Server-side model loading error detected. "
-                    "The UF LiteLLM API server is having trouble loading models. "
-                    "This is a server-side issue, not a client-side problem. "
-                    "Please try again later or contact UF IT support."
-                )
-            return False, msg
+            return False, _connection_error_message(msg)
     
     def is_usable(self) -> bool:
         """
@@ -133,6 +239,31 @@ class UFNavigatorAPI:
         """
         return self.client is not None and bool(self.api_key) and bool(self.base_url)
 
+    def _record_model_call(self, model: str, latency: float, ok: bool, error: Optional[Exception] = None):
+        # 进程级健康记录（熔断 + 排序），所有 client / session 共享
+        registry = get_model_health_registry()
+        if ok:
+            registry.record_success(model, latency)
+        else:
+            registry.record_failure(model, latency, retryable=error is not None and _is_retryable_model_error(error))
+
+        with self._stats_lock:
+            stats = self.model_stats.setdefault(
+                model, {"calls": 0, "successes": 0, "failures": 0, "total_latency": 0.0, "last_latency": 0.0}
+            )
+            stats["calls"] += 1
+            stats["successes" if ok else "failures"] += 1
+            stats["total_latency"] += latency
+            stats["last_latency"] = latency
+
+    def get_model_latency_stats(self) -> Dict[str, Dict[str, float]]:
+        """Per-model call counts and latency (seconds) observed by this client."""
+        with self._stats_lock:
+            return {
+                model: dict(stats, avg_latency=stats["total_latency"] / stats["calls"] if stats["calls"] else 0.0)
+                for model, stats in self.model_stats.items()
+            }
+
     def generate_chat(
         self,
         messages,
@@ -141,10 +272,33 @@ class UFNavigatorAPI:
         temperature: float = 0.8,
         top_p: float = 0.95,
         presence_penalty: float = 0.0,
+        cache: Optional[ResponseCache] = None,
     ) -> str:
+        """
+        One chat completion. With `cache`, an identical earlier request
+        (model + normalized messages + sampling params) is answered from the cache.
+        """
         if not self.client:
             raise RuntimeError(self.last_error or "Client not initialized.")
 
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.make_key(model, messages, max_tokens=max_tokens, temperature=temperature,
+                                       top_p=top_p, presence_penalty=presence_penalty)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        content = self._create_chat(messages, model, max_tokens, temperature, top_p, presence_penalty)
+        if cache is not None and content:
+            cache.set(cache_key, content)
+        return content
+
+    def _create_chat(self, messages, model: str, max_tokens: int, temperature: float,
+                     top_p: float, presence_penalty: float) -> str:
+        start = time.monotonic()
+        ok = False
+        error = None
         try:
             kwargs = dict(
                 model=model,
@@ -156,76 +310,183 @@ class UFNavigatorAPI:
             if presence_penalty and presence_penalty > 0:
                 kwargs["presence_penalty"] = presence_penalty
             resp = self.client.chat.completions.create(**kwargs)
-            return (resp.choices[0].message.content or "").strip()
+            content = (resp.choices[0].message.content or "").strip()
+            ok = bool(content)
+            return content
         except Exception as e:
+            error = e
             # 捕获并重新抛出，让上层可以判断是否是可重试的错误
-            error_msg = str(e)
-            # 如果是 meta tensor 错误，这是一个可重试的服务器端错误
-            if _is_retryable_model_error(e):
-                # 创建一个带有特殊标记的异常，方便上层识别
-                retryable_error = RuntimeError(f"Model loading error (retryable): {error_msg}")
-                retryable_error.is_retryable = True
-                raise retryable_error
-            # 其他错误直接抛出
-            raise
+            # meta tensor 等可重试错误会被包装成带 is_retryable 标记的异常；其他错误直接抛出
+            wrapped = _wrap_model_error(e)
+            if wrapped is e:
+                raise
+            raise wrapped
+        finally:
+            self._record_model_call(model, time.monotonic() - start, ok, error)
 
-    def generate_student_reply(
+    def generate_chat_stream(
+        self,
+        messages,
+        model: str,
+        max_tokens: int = 180,
+        temperature: float = 0.8,
+        top_p: float = 0.95,
+        presence_penalty: float = 0.0,
+    ) -> Iterator[str]:
+        """
+        Streaming version of generate_chat: yields content deltas as they arrive.
+        Errors are raised (and classified) exactly like generate_chat; an error
+        raised before the first delta means nothing has been shown yet, so the
+        caller can still fall back to another model.
+        """
+        if not self.client:
+            raise RuntimeError(self.last_error or "Client not initialized.")
+
+        start = time.monotonic()
+        ok = False
+        error = None
+        try:
+            kwargs = dict(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                stream=True,
+            )
+            if presence_penalty and presence_penalty > 0:
+                kwargs["presence_penalty"] = presence_penalty
+            stream = self.client.chat.completions.create(**kwargs)
+            try:
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not ok:
+                            ok = True
+                            with self._stats_lock:
+                                self.last_time_to_first_token = time.monotonic() - start
+                        yield delta
+            finally:
+                close = getattr(stream, "close", None)
+                if close:
+                    close()
+        except Exception as e:
+            error = e
+            wrapped = _wrap_model_error(e)
+            if wrapped is e:
+                raise
+            raise wrapped
+        finally:
+            self._record_model_call(model, time.monotonic() - start, ok, error)
+
+    def build_student_reply_messages(
         self,
         advisor_message: str,
         persona: str,
-        knowledge_context: str = "",
+        knowledge_context: Union[str, List[str]] = "",
         use_few_shot: bool = True,
         intent: Optional[str] = None,
         persona_info: Optional[Dict[str, Any]] = None,
-        preferred_model: Optional[str] = None,
-    ) -> Optional[str]:
-        """
-        Robust student reply generation with model fallback:
-        - No hard-coded model
-        - Try a few candidates; on "meta tensor"/torch error -> fall back to next model
+        prompt_context: Optional[Dict[str, Any]] = None,
+        examples: Optional[List[Dict]] = None,
+    ) -> Optional[List[Dict[str, str]]]:
         """
-        if not self.client:
-            self.last_error = self.last_error or "Client not initialized."
-            return None
-
-        import re
+        Chat messages (system + user prompt) for a student reply; None if the prompt could not be built.
+        knowledge_context: one string, or knowledge items best-first (e.g. KB passages, then web context).
+        prompt_context: history-derived prompt pieces precomputed by precompute_prompt_context (optional).
+        examples: few-shot examples already selected by the caller ([] = none, e.g. the selection
+            stage timed out); None only when the caller never ran a selection, which then happens here.
 
-        # 1) Build prompt
+        The prompt is kept within self.prompt_token_budget: the oldest history lines go
+        first (the latest exchange stays), then the lowest-ranked knowledge items, then
+        extra few-shot examples. The token breakdown is left in self.last_prompt_breakdown.
+        """
         try:
-            if use_few_shot:
+            if use_few_shot and examples is None:
                 examples = get_few_shot_examples(
                     persona=persona,
                     advisor_message=advisor_message,
                     intent=intent,
                     num_examples=2,
                 )
+            examples = list(examples or []) if use_few_shot else []
 
-                persona_info = persona_info or {}
+            history_lines, current_message = _split_history(advisor_message)
+            if isinstance(knowledge_context, str):
+                knowledge_items = [knowledge_context] if knowledge_context else []
+            else:
+                knowledge_items = [item for item in knowledge_context or [] if item]
 
-                conversation_context = None
-                if "Previous conversation:" in advisor_message and "Now the advisor says:" in advisor_message:
-                    conversation_context = (
-                        advisor_message.split("Now the advisor says:")[0]
-                        .replace("Previous conversation:", "")
-                        .strip()
-                    )
+            def render(kept: Dict[str, List[str]]) -> List[Dict[str, str]]:
+                # 历史没被裁剪时保持原消息不变
+                if len(kept["history"]) == len(history_lines):
+                    message = advisor_message
+                else:
+                    message = _join_history(kept["history"], current_message)
+                return self._render_student_reply_messages(
+                    message, persona, "\n".join(kept["knowledge"]), use_few_shot,
+                    examples[:len(kept["examples"])], intent, persona_info, prompt_context,
+                )
 
-                prompt = format_few_shot_prompt(
-                    examples=examples,
-                    advisor_message=advisor_message,
-                    persona=persona,
-                    persona_info=persona_info,
-                    conversation_context=conversation_context,
-                    advisor_intent=intent,
+            sections = [
+                PromptSection("history", history_lines, drop_from="start", min_keep=2),
+                PromptSection("knowledge", knowledge_items),
+                PromptSection("examples", [_format_example_for_budget(e, persona) for e in examples], min_keep=1),
+            ]
+            messages, breakdown = PromptAssembler(render, sections, budget=self.prompt_token_budget).assemble()
+        except Exception as e:
+            self.last_error = f"Prompt build failed: {e}"
+            return None
+
+        self.last_prompt_breakdown = breakdown
+        if breakdown["over_budget"]:
+            print(f"⚠️ Student reply prompt is {breakdown['total']} tokens, over the {breakdown['budget']} budget "
+                  f"even after trimming")
+        return messages
+
+    def _render_student_reply_messages(
+        self,
+        advisor_message: str,
+        persona: str,
+        knowledge_context: str,
+        use_few_shot: bool,
+        examples: List[Dict],
+        intent: Optional[str],
+        persona_info: Optional[Dict[str, Any]],
+        prompt_context: Optional[Dict[str, Any]],
+    ) -> List[Dict[str, str]]:
+        """Format the prompt from already-selected parts (raises on failure)."""
+        # 1) Build prompt
+        if use_few_shot:
+            persona_info = persona_info or {}
+
+            conversation_context = None
+            if "Previous conversation:" in advisor_message and "Now the advisor says:" in advisor_message:
+                conversation_context = (
+                    advisor_message.split("Now the advisor says:")[0]
+                    .replace("Previous conversation:", "")
+                    .strip()
                 )
 
-                if knowledge_context:
-                    prompt = f"""Based on the following MAE professional knowledge:
+            prompt = format_few_shot_prompt(
+                examples=examples,
+                advisor_message=advisor_message,
+                persona=persona,
+                persona_info=persona_info,
+                conversation_context=conversation_context,
+                advisor_intent=intent,
+                prompt_context=prompt_context,
+            )
+
+            if knowledge_context:
+                prompt = f"""Based on the following MAE professional knowledge:
 {knowledge_context}
 
 {prompt}"""
-            else:
-                prompt = f"""
+        else:
+            prompt = f"""
 You are a {persona} type student having a conversation with a peer advisor.
 
 Peer Advisor said: {advisor_message}
@@ -235,14 +496,11 @@ Your response should be 1–3 sentences and conversational.
 
 Response:
 """
-                if knowledge_context:
-                    prompt = f"""Based on the following MAE professional knowledge:
+            if knowledge_context:
+                prompt = f"""Based on the following MAE professional knowledge:
 {knowledge_context}
 
 {prompt}"""
-        except Exception as e:
-            self.last_error = f"Prompt build failed: {e}"
-            return None
 
         # 2) Build messages
         sys_msg = {
@@ -255,27 +513,157 @@ Response:
             ),
         }
         user_msg = {"role": "user", "content": prompt}
+        return [sys_msg, user_msg]
+
+    def generate_student_reply(
+        self,
+        advisor_message: str,
+        persona: str,
+        knowledge_context: Union[str, List[str]] = "",
+        use_few_shot: bool = True,
+        intent: Optional[str] = None,
+        persona_info: Optional[Dict[str, Any]] = None,
+        preferred_model: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        prompt_context: Optional[Dict[str, Any]] = None,
+        examples: Optional[List[Dict]] = None,
+    ) -> Optional[str]:
+        """
+        Robust student reply generation with model fallback:
+        - No hard-coded model
+        - Try a few candidates; on "meta tensor"/torch error -> fall back to next model
+        - With race_models=True the candidates are hedged instead of strictly sequential
+        - With `cache`, a reply cached for the same prompt from any candidate model is reused
+        """
+        if not self.client:
+            self.last_error = self.last_error or "Client not initialized."
+            return None
+
+        messages = self.build_student_reply_messages(
+            advisor_message, persona, knowledge_context, use_few_shot, intent, persona_info, prompt_context, examples
+        )
+        if messages is None:
+            return None
 
         # 3) ✅ 不要硬编码单一模型，改为"逐个尝试模型"
-        # 如果指定了 preferred_model，优先尝试
-        model_list = [preferred_model] if preferred_model else []
-        model_list.extend([m for m in UF_MODEL_FALLBACKS if m != preferred_model])
+        # 如果指定了 preferred_model，优先尝试；其余按健康度排序，熔断中的模型跳过
+        model_list = get_model_health_registry().ordered_models(UF_MODEL_FALLBACKS, preferred=preferred_model)
+
+        if cache is not None:
+            cached = cache.get_any(cache.make_key(m, messages, **STUDENT_REPLY_PARAMS) for m in model_list)
+            if cached is not None:
+                return cached
         
-        last_err = None
+        if self.race_models and len(model_list) > 1:
+            reply, last_err, aborted = self._race_models(messages, model_list)
+        else:
+            reply, last_err, aborted = self._try_models_sequentially(messages, model_list)
+        if reply and cache is not None:
+            cache.set(cache.make_key(self.last_model, messages, **STUDENT_REPLY_PARAMS), reply)
+        if reply or aborted:
+            return reply
+
+        self._set_all_failed_error(last_err, len(model_list))
+        return None
+
+    def _set_all_failed_error(self, last_err: Optional[Exception], num_models: int):
+        # 所有模型都失败
+        if last_err:
+            error_msg = str(last_err)
+            # 如果是 meta tensor 错误，提供更友好的错误信息
+            if _is_retryable_model_error(last_err):
+                # 简化错误消息，避免过长
+                self.last_error = f"Server-side model loading error (meta tensor): {error_msg[:200]}"
+            else:
+                self.last_error = f"All models failed. Last error: {error_msg[:200]}"
+        else:
+            self.last_error = "All models failed (no specific error, or all circuit breakers open)."
+        
+        # 只在调试模式下打印详细错误
+        if os.getenv("DEBUG_UF_API", "").lower() == "true":
+            print(f"❌ generate_student_reply failed after trying all {num_models} models: {self.last_error}")
+
+    def generate_student_reply_stream(
+        self,
+        advisor_message: str,
+        persona: str,
+        knowledge_context: Union[str, List[str]] = "",
+        use_few_shot: bool = True,
+        intent: Optional[str] = None,
+        persona_info: Optional[Dict[str, Any]] = None,
+        preferred_model: Optional[str] = None,
+        prompt_context: Optional[Dict[str, Any]] = None,
+        examples: Optional[List[Dict]] = None,
+    ) -> Iterator[str]:
+        """
+        Streaming student reply: yields text deltas from the first model that starts answering.
+        Model fallback happens only before the first token (same retryable-error rules as
+        generate_student_reply). With race_models=True the candidates are hedged on the first
+        token: a model that has not started answering within hedge_delay seconds gets company
+        from the next one, and the streams that lose are closed. If nothing is yielded,
+        last_error says why and the caller should use its local fallback. HTML tags are not
+        stripped per delta; clean the joined text.
+        """
+        if not self.client:
+            self.last_error = self.last_error or "Client not initialized."
+            return
 
+        messages = self.build_student_reply_messages(
+            advisor_message, persona, knowledge_context, use_few_shot, intent, persona_info, prompt_context, examples
+        )
+        if messages is None:
+            return
+
+        model_list = get_model_health_registry().ordered_models(UF_MODEL_FALLBACKS, preferred=preferred_model)
+        # 等第一个 token；在此之前的错误都可以换模型
+        if self.race_models and len(model_list) > 1:
+            opened, last_err, aborted = self._race_models(
+                messages, model_list, call=self._open_reply_stream, discard=_close_opened_stream
+            )
+        else:
+            opened, last_err, aborted = self._try_models_sequentially(messages, model_list, call=self._open_reply_stream)
+        if aborted:
+            return
+        if not opened:
+            self._set_all_failed_error(last_err, len(model_list))
+            return
+
+        first, stream = opened
+        model_name = self.last_model
+        yield first
+        try:
+            yield from stream
+        except Exception as e:
+            # 已经输出了一部分：保留已有内容，不再切换模型
+            self.last_error = f"Stream interrupted ({model_name}): {e}"
+            print(f"⚠️ {self.last_error}")
+
+    def _open_reply_stream(self, messages, model_name: str) -> Optional[Tuple[str, Iterator[str]]]:
+        """Start streaming a reply and wait for its first delta: (first delta, rest of stream), or None if empty."""
+        stream = self.generate_chat_stream(messages=messages, model=model_name, **STUDENT_REPLY_PARAMS)
+        first = next(stream, None)
+        return (first, stream) if first is not None else None
+
+    def _student_reply_call(self, messages, model_name: str) -> str:
+        return _clean_reply(self.generate_chat(messages=messages, model=model_name, **STUDENT_REPLY_PARAMS))
+
+    def _try_models_sequentially(self, messages, model_list: List[str], call=None):
+        """
+        逐个尝试模型，返回 (reply, last_err, aborted)。
+        aborted=True 表示遇到不可重试错误（last_error 已设置），上层应直接返回 None。
+        call: (messages, model) -> 结果（默认 _student_reply_call；空结果换下一个模型）
+        """
+        call = call or self._student_reply_call
+        last_err = None
+        registry = get_model_health_registry()
         for model_name in model_list:
+            if not registry.allow_request(model_name):
+                continue
             try:
-                reply = self.generate_chat(
-                    messages=[sys_msg, user_msg],
-                    model=model_name,
-                    max_tokens=250,
-                    temperature=0.8,
-                    presence_penalty=0.15,
-                )
-
-                reply = re.sub(r"<[^>]+>", "", reply).strip()
+                reply = call(messages, model_name)
                 if reply:
-                    return reply
+                    self.last_model = model_name
+                    return reply, None, False
 
             except Exception as e:
                 last_err = e
@@ -291,22 +679,470 @@ Response:
                 self.last_error = error_msg
                 # 对于非重试错误，立即返回，不继续尝试其他模型
                 print(f"❌ Non-retryable error with model {model_name}: {error_msg}")
+                return None, e, True
+        return None, last_err, False
+
+    def _race_models(self, messages, model_list: List[str], call=None, discard=None):
+        """
+        Hedged racing: ask the first model; if it has not answered within hedge_delay
+        seconds (or fails / returns nothing) also ask the next one. The first non-empty
+        reply wins. Not-yet-started requests are cancelled; requests already in flight
+        finish in the background and their results are discarded (passed to `discard`,
+        e.g. to close a losing stream).
+        Returns the same (reply, last_err, aborted) tuple as _try_models_sequentially.
+        """
+        call = call or self._student_reply_call
+        executor = ThreadPoolExecutor(max_workers=len(model_list), thread_name_prefix="uf-model-race")
+        pending: Dict[Any, str] = {}
+        remaining = list(model_list)
+        last_err = None
+
+        registry = get_model_health_registry()
+
+        def launch_next():
+            while remaining:
+                model_name = remaining.pop(0)
+                if registry.allow_request(model_name):
+                    pending[executor.submit(call, messages, model_name)] = model_name
+                    return
+
+        try:
+            launch_next()
+            while pending:
+                done, _ = wait(
+                    list(pending),
+                    timeout=self.hedge_delay if remaining else None,
+                    return_when=FIRST_COMPLETED,
+                )
+                if not done:
+                    # 首选模型太慢 → 同时请求下一个模型
+                    launch_next()
+                    continue
+
+                for future in done:
+                    model_name = pending.pop(future)
+                    try:
+                        reply = future.result()
+                    except Exception as e:
+                        last_err = e
+                        if not _is_retryable_model_error(e):
+                            # 与顺序模式一致：401/403/网络错误不再尝试其他模型
+                            self.last_error = str(e)
+                            print(f"❌ Non-retryable error with model {model_name}: {e}")
+                            return None, e, True
+                        print(f"⚠️ Model {model_name} failed with retryable error, racing next model...")
+                        launch_next()
+                        continue
+                    if reply:
+                        self.last_model = model_name
+                        return reply, None, False
+                    launch_next()
+            return None, last_err, False
+        finally:
+            if discard is not None:
+                for future in pending:
+                    future.add_done_callback(lambda f: _discard_result(f, discard))
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _discard_result(future, discard):
+    """Hand a losing racer's result to `discard` (ignores cancelled / failed futures)."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    if result:
+        discard(result)
+
+
+def _close_opened_stream(opened: Tuple[str, Iterator[str]]):
+    close = getattr(opened[1], "close", None)
+    if close:
+        close()
+
+
+def _int_setting(name: str, default: int) -> int:
+    try:
+        return int(_get_secret(name, str(default)))
+    except ValueError:
+        print(f"⚠️ Invalid {name}, using {default}")
+        return default
+
+
+# ---- Async client: one event loop thread + one httpx pool per process ----
+_ASYNC_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_ASYNC_HTTP_CLIENT = None
+_ASYNC_LOCK = threading.Lock()
+
+
+def get_shared_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Process-wide event loop running in a daemon thread. Streamlit scripts are
+    synchronous, so every session submits its coroutines here (see run_async)
+    and they all share the same connection pool.
+    """
+    global _ASYNC_LOOP
+    with _ASYNC_LOCK:
+        if _ASYNC_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="uf-async-loop", daemon=True).start()
+            _ASYNC_LOOP = loop
+        return _ASYNC_LOOP
+
+
+def run_async(coro, timeout: Optional[float] = None):
+    """Run a coroutine on the shared event loop from synchronous code and wait for the result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_shared_event_loop()).result(timeout)
+
+
+def get_shared_async_http_client(max_connections: Optional[int] = None,
+                                 max_keepalive_connections: Optional[int] = None):
+    """
+    Process-wide httpx.AsyncClient (keep-alive pool) used by every AsyncUFNavigatorAPI.
+    Limits come from the first caller, or UF_HTTP_MAX_CONNECTIONS /
+    UF_HTTP_MAX_KEEPALIVE (defaults 20 / 10). Returns None if httpx is unavailable,
+    in which case each AsyncOpenAI client falls back to its own pool.
+    """
+    global _ASYNC_HTTP_CLIENT
+    if httpx is None:
+        return None
+    with _ASYNC_LOCK:
+        if _ASYNC_HTTP_CLIENT is None:
+            if max_connections is None:
+                max_connections = max(1, _int_setting("UF_HTTP_MAX_CONNECTIONS", 20))
+            if max_keepalive_connections is None:
+                max_keepalive_connections = max(0, _int_setting("UF_HTTP_MAX_KEEPALIVE", 10))
+            _ASYNC_HTTP_CLIENT = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=min(max_keepalive_connections, max_connections),
+                    keepalive_expiry=30.0,
+                ),
+                follow_redirects=True,
+            )
+        return _ASYNC_HTTP_CLIENT
+
+
+class AsyncUFNavigatorAPI:
+    """
+    asyncio version of UFNavigatorAPI (same secrets, same fallback rules).
+    All instances share one httpx connection pool, so concurrent Streamlit
+    sessions multiplex over a few warm keep-alive connections instead of each
+    holding its own pool and TLS handshakes. The shared pool is bound to the
+    shared event loop: await these methods there, e.g.
+    run_async(api.generate_student_reply(...)) from synchronous code.
+    The Streamlit app itself streams replies through UFNavigatorAPI; this client is
+    for batch / scripted callers that fan out many requests at once.
+    """
+
+    # 与同步版共用的提示词构建 / 统计逻辑（只依赖 last_error 和统计字段）
+    build_student_reply_messages = UFNavigatorAPI.build_student_reply_messages
+    _render_student_reply_messages = UFNavigatorAPI._render_student_reply_messages
+    _record_model_call = UFNavigatorAPI._record_model_call
+    get_model_latency_stats = UFNavigatorAPI.get_model_latency_stats
+    _set_all_failed_error = UFNavigatorAPI._set_all_failed_error
+    is_usable = UFNavigatorAPI.is_usable
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        timeout: float = 30.0,
+        max_connections: Optional[int] = None,
+        prompt_token_budget: Optional[int] = None,
+    ):
+        self.base_url = (base_url or _get_secret("UF_LITELLM_BASE_URL") or "https://api.ai.it.ufl.edu").strip()
+        self.api_key = (api_key or _get_secret("UF_LITELLM_API_KEY")).strip()
+
+        self._stats_lock = threading.Lock()
+        self.model_stats: Dict[str, Dict[str, float]] = {}
+        self.prompt_token_budget: int = _prompt_token_budget(prompt_token_budget)
+        self.last_prompt_breakdown: Optional[Dict[str, Any]] = None
+
+        self.last_error: str = ""
+        self.client: Optional[AsyncOpenAI] = None
+
+        if not self.api_key:
+            self.last_error = (
+                "❌ API key not provided. Please set UF_LITELLM_API_KEY in Streamlit secrets or env."
+            )
+            return
+        if not self.base_url:
+            self.last_error = (
+                "❌ Base URL not provided. Please set UF_LITELLM_BASE_URL in Streamlit secrets or env."
+            )
+            return
+
+        self.base_url = _normalize_base_url(self.base_url)
+
+        try:
+            kwargs = dict(api_key=self.api_key, base_url=self.base_url, timeout=timeout)
+            http_client = get_shared_async_http_client(max_connections)
+            if http_client is not None:
+                kwargs["http_client"] = http_client
+            self.client = AsyncOpenAI(**kwargs)
+        except Exception as e:
+            self.last_error = f"Failed to create AsyncOpenAI client: {e}"
+            self.client = None
+
+    async def test_connection(self) -> Tuple[bool, str]:
+        """Connectivity + auth check via models.list() (does NOT load models)."""
+        if not self.client:
+            return False, self.last_error or "Client not initialized."
+
+        try:
+            _ = await self.client.models.list()
+            return True, "OK"
+        except Exception as e:
+            msg = str(e)
+            self.last_error = msg
+            return False, _connection_error_message(msg)
+
+    async def generate_chat(
+        self,
+        messages,
+        model: str,
+        max_tokens: int = 180,
+        temperature: float = 0.8,
+        top_p: float = 0.95,
+        presence_penalty: float = 0.0,
+    ) -> str:
+        if not self.client:
+            raise RuntimeError(self.last_error or "Client not initialized.")
+
+        start = time.monotonic()
+        ok = False
+        error = None
+        try:
+            kwargs = dict(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+            )
+            if presence_penalty and presence_penalty > 0:
+                kwargs["presence_penalty"] = presence_penalty
+            resp = await self.client.chat.completions.create(**kwargs)
+            content = (resp.choices[0].message.content or "").strip()
+            ok = bool(content)
+            return content
+        except Exception as e:
+            error = e
+            wrapped = _wrap_model_error(e)
+            if wrapped is e:
+                raise
+            raise wrapped
+        finally:
+            self._record_model_call(model, time.monotonic() - start, ok, error)
+
+    async def generate_student_reply(
+        self,
+        advisor_message: str,
+        persona: str,
+        knowledge_context: Union[str, List[str]] = "",
+        use_few_shot: bool = True,
+        intent: Optional[str] = None,
+        persona_info: Optional[Dict[str, Any]] = None,
+        preferred_model: Optional[str] = None,
+        prompt_context: Optional[Dict[str, Any]] = None,
+        examples: Optional[List[Dict]] = None,
+    ) -> Optional[str]:
+        """Same contract as UFNavigatorAPI.generate_student_reply (sequential health-ordered fallback)."""
+        if not self.client:
+            self.last_error = self.last_error or "Client not initialized."
+            return None
+
+        # few-shot 选择是 CPU 计算，放到线程里，不阻塞共享事件循环
+        messages = await asyncio.to_thread(
+            self.build_student_reply_messages,
+            advisor_message, persona, knowledge_context, use_few_shot, intent, persona_info, prompt_context, examples,
+        )
+        if messages is None:
+            return None
+
+        registry = get_model_health_registry()
+        model_list = registry.ordered_models(UF_MODEL_FALLBACKS, preferred=preferred_model)
+        last_err = None
+        for model_name in model_list:
+            if not registry.allow_request(model_name):
+                continue
+            try:
+                reply = _clean_reply(await self.generate_chat(
+                    messages=messages, model=model_name, **STUDENT_REPLY_PARAMS
+                ))
+                if reply:
+                    return reply
+            except Exception as e:
+                last_err = e
+                if _is_retryable_model_error(e):
+                    print(f"⚠️ Model {model_name} failed with retryable error, trying next model...")
+                    continue
+                self.last_error = str(e)
+                print(f"❌ Non-retryable error with model {model_name}: {e}")
                 return None
 
-        # 所有模型都失败
-        if last_err:
-            error_msg = str(last_err)
-            # 如果是 meta tensor 错误，提供更友好的错误信息
-            if _is_retryable_model_error(last_err):
-                # 简化错误消息，避免过长
-                self.last_error = f"Server-side model loading error (meta tensor): {error_msg[:200]}"
-            else:
-                self.last_error = f"All models failed. Last error: {error_msg[:200]}"
-        else:
-            self.last_error = "All models failed (no specific error)."
-        
-        # 只在调试模式下打印详细错误
-        import os
-        if os.getenv("DEBUG_UF_API", "").lower() == "true":
-            print(f"❌ generate_student_reply failed after trying all {len(model_list)} models: {self.last_error}")
+        self._set_all_failed_error(last_err, len(model_list))
         return None
+
+
+class _FakeChatClient:
+    """
+    Stand-in for OpenAI / AsyncOpenAI in the self-tests. behaviours: model ->
+    (delay seconds, reply text or exception); streamed replies arrive word by word.
+    """
+
+    def __init__(self, behaviours: Dict[str, Tuple[float, Any]], is_async: bool = False):
+        from types import SimpleNamespace
+
+        self._ns = SimpleNamespace
+        self.behaviours = behaviours
+        self.calls: List[str] = []
+        self.closed: List[str] = []
+        create = self._create_async if is_async else self._create
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+    def _outcome(self, model: str) -> Tuple[float, Any]:
+        self.calls.append(model)
+        delay, outcome = self.behaviours.get(model, (0.0, RuntimeError("model not found")))
+        return delay, outcome
+
+    def _response(self, model: str, outcome, stream: bool):
+        if isinstance(outcome, Exception):
+            raise outcome
+        if not stream:
+            return self._ns(choices=[self._ns(message=self._ns(content=outcome))])
+
+        def chunks():
+            try:
+                for i, word in enumerate(outcome.split(" ")):
+                    yield self._ns(choices=[self._ns(delta=self._ns(content=word if i == 0 else " " + word))])
+            finally:
+                self.closed.append(model)
+
+        return chunks()
+
+    def _create(self, model: str, stream: bool = False, **kwargs):
+        delay, outcome = self._outcome(model)
+        time.sleep(delay)
+        return self._response(model, outcome, stream)
+
+    async def _create_async(self, model: str, stream: bool = False, **kwargs):
+        delay, outcome = self._outcome(model)
+        await asyncio.sleep(delay)
+        return self._response(model, outcome, stream)
+
+
+def _fake_api(behaviours: Dict[str, Tuple[float, Any]], **kwargs) -> UFNavigatorAPI:
+    get_model_health_registry().reset()
+    api = UFNavigatorAPI(base_url="http://localhost:4000", api_key="test-key", prompt_token_budget=0, **kwargs)
+    api.client = _FakeChatClient(behaviours)
+    return api
+
+
+def test_model_racing():
+    """竞速 / 顺序 fallback 自测（假 client）"""
+    first, second, third = UF_MODEL_FALLBACKS[:3]
+    reply_args = dict(advisor_message="What classes are you taking?", persona="beta", use_few_shot=False)
+
+    api = _fake_api({first: (0.5, "slow reply"), second: (0.0, "fast <b>reply</b>")}, race_models=True, hedge_delay=0.05)
+    start = time.monotonic()
+    assert api.generate_student_reply(**reply_args) == "fast reply"
+    assert api.last_model == second and time.monotonic() - start < 0.4
+
+    api = _fake_api({first: (0.0, RuntimeError("meta tensor")), second: (0.0, ""), third: (0.0, "third")},
+                    race_models=True, hedge_delay=1.0)
+    assert api.generate_student_reply(**reply_args) == "third"  # 可重试错误 / 空回复 → 立刻换下一个
+
+    api = _fake_api({first: (0.0, RuntimeError("401 Unauthorized")), second: (0.0, "never")}, race_models=True)
+    assert api.generate_student_reply(**reply_args) is None
+    assert "401" in api.last_error and api.client.calls == [first]  # 不可重试错误不再试其他模型
+
+    api = _fake_api({first: (0.0, RuntimeError("model not found")), second: (0.0, "sequential")})
+    assert api.generate_student_reply(**reply_args) == "sequential" and api.client.calls == [first, second]
+    get_model_health_registry().reset()
+    print("✅ Model racing test passed")
+
+
+def test_reply_stream():
+    """流式回复：首 token 前换模型 / 竞速 / 失败不输出 自测（假 client）"""
+    first, second = UF_MODEL_FALLBACKS[:2]
+    reply_args = dict(advisor_message="What classes are you taking?", persona="beta", use_few_shot=False)
+
+    api = _fake_api({first: (0.0, RuntimeError("model not found")), second: (0.0, "I am taking EML3100")})
+    deltas = list(api.generate_student_reply_stream(**reply_args))
+    assert deltas == ["I", " am", " taking", " EML3100"] and api.last_model == second, deltas
+
+    api = _fake_api({first: (0.4, "slow stream"), second: (0.0, "fast stream")}, race_models=True, hedge_delay=0.05)
+    start = time.monotonic()
+    assert "".join(api.generate_student_reply_stream(**reply_args)) == "fast stream"
+    assert api.last_model == second and time.monotonic() - start < 0.35
+    deadline = time.monotonic() + 2
+    while first not in api.client.closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert first in api.client.closed  # 输掉的流被关闭
+
+    api = _fake_api({first: (0.0, RuntimeError("403 Forbidden")), second: (0.0, "never")})
+    assert list(api.generate_student_reply_stream(**reply_args)) == []
+    assert "403" in api.last_error
+    get_model_health_registry().reset()
+    print("✅ Reply stream test passed")
+
+
+def test_few_shot_stage_timeout():
+    """Few-Shot 选择阶段超时：不带示例回复，回复线程上不会再选一次"""
+    from retrieval_pipeline import run_stages
+
+    global get_few_shot_examples
+    selections = []
+    real_selector = get_few_shot_examples
+
+    def counting_selector(**kwargs):
+        selections.append(kwargs)
+        return [{"advisor": "How are classes?", "student": "Fine.", "intent": "courses"}]
+
+    results, timings = run_stages({
+        "few_shot": (lambda: time.sleep(0.3) or counting_selector(), 0.05, []),
+    })
+    assert results["few_shot"] == [] and timings["few_shot"]["status"] == "timeout"
+    selections.clear()  # 后台还在跑的那次不算
+
+    get_few_shot_examples = counting_selector
+    try:
+        api = _fake_api({})
+        reply_args = dict(advisor_message="What classes are you taking?", persona="beta")
+        messages = api.build_student_reply_messages(**reply_args, examples=results["few_shot"])
+        assert messages is not None and selections == [], (api.last_error, selections)
+        assert "Example 1:" not in messages[-1]["content"]
+
+        messages = api.build_student_reply_messages(**reply_args)  # 没跑选择阶段的调用方：这里自己选
+        assert len(selections) == 1 and "Example 1:" in messages[-1]["content"]
+    finally:
+        get_few_shot_examples = real_selector
+    get_model_health_registry().reset()
+    print("✅ Few-shot stage timeout test passed")
+
+
+def test_async_client():
+    """AsyncUFNavigatorAPI：共享事件循环 + 模型 fallback 自测（假 client）"""
+    first, second = UF_MODEL_FALLBACKS[:2]
+    get_model_health_registry().reset()
+    api = AsyncUFNavigatorAPI(base_url="http://localhost:4000", api_key="test-key", prompt_token_budget=0)
+    api.client = _FakeChatClient({first: (0.0, RuntimeError("meta tensor")), second: (0.01, "<i>Async</i> reply")},
+                                 is_async=True)
+    reply = run_async(api.generate_student_reply("Any questions?", "alpha", use_few_shot=False), timeout=5)
+    assert reply == "Async reply" and api.client.calls == [first, second], (reply, api.client.calls)
+    assert api.get_model_latency_stats()[second]["successes"] == 1
+
+    get_model_health_registry().reset()
+    api.client = _FakeChatClient({first: (0.0, RuntimeError("401 Unauthorized"))}, is_async=True)
+    assert run_async(api.generate_student_reply("Any questions?", "alpha", use_few_shot=False), timeout=5) is None
+    assert "401" in api.last_error and api.client.calls == [first]
+    get_model_health_registry().reset()
+    print("✅ Async client test passed")
+
+
+if __name__ == "__main__":
+    test_model_racing()
+    test_reply_stream()
+    test_few_shot_stage_timeout()
+    test_async_client()
@@ -1,19 +1,29 @@
 import streamlit as st
 import os
 import sys
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple, Iterator
 import json
 from datetime import datetime
 import random
 import requests
 import openai
 import uuid
+import time
 # (Disabled optional logging/export dependencies)
 # import pandas as pd
 # import io
 # import uuid
-from uf_navigator_api import UFNavigatorAPI, UF_MODEL_FALLBACKS, _is_retryable_model_error
-from simple_knowledge_base import SimpleKnowledgeBase
+from uf_navigator_api import UFNavigatorAPI, UF_MODEL_FALLBACKS, _is_retryable_model_error, _get_secret
+from model_health import get_model_health_registry
+from response_cache import get_response_cache
+from opening_pool import get_opening_pool
+from retrieval_pipeline import run_stages, stage_deadline, get_stage_timing_summary
+try:
+    from few_shot_examples import precompute_prompt_context, get_few_shot_examples
+except ImportError:
+    precompute_prompt_context = None
+    get_few_shot_examples = None
+from simple_knowledge_base import SimpleKnowledgeBase, get_shared_knowledge_base
 
 # Page configuration
 st.set_page_config(
@@ -795,6 +805,37 @@ def get_smart_conversation_history(conversation_history: List[Dict],
 
     return "\n".join(context_parts) if context_parts else ""
 
+
+def prefetch_turn_context(conversation_history: List[Dict], persona: str,
+                          max_messages: int = 12) -> Dict[str, Any]:
+    """
+    上一轮结束后预先计算只依赖对话历史的部分（不依赖下一条顾问消息）：
+    对话历史窗口（去掉下一条顾问消息占的那一条）、最近学生回复、persona 风格指导、各意图的策略指导。
+    提交时由 _prepare_rag_reply_inputs / format_few_shot_prompt 直接复用。
+    """
+    history_prefix = get_smart_conversation_history(conversation_history, "", max_messages=max_messages - 1)
+    return {
+        "message_count": len(conversation_history),
+        "persona": persona,
+        "max_messages": max_messages,
+        "history_prefix": history_prefix,
+        "prompt_context": precompute_prompt_context(persona, history_prefix) if precompute_prompt_context else None,
+    }
+
+
+def _usable_turn_context(turn_context: Optional[Dict[str, Any]], conversation_history: List[Dict],
+                         persona: str) -> Optional[Dict[str, Any]]:
+    """预取结果仍然有效：同一 persona，且之后只追加了当前这条顾问消息"""
+    if not turn_context or not conversation_history:
+        return None
+    if turn_context.get("persona") != persona:
+        return None
+    if turn_context.get("message_count") != len(conversation_history) - 1:
+        return None
+    if conversation_history[-1].get("role") != "advisor":
+        return None
+    return turn_context
+
 def get_realtime_uf_mae_info(query_text: str, max_results: int = 3) -> str:
     """
     通用函数：实时搜索 UF MAE 网站获取最新信息
@@ -808,7 +849,7 @@ def get_realtime_uf_mae_info(query_text: str, max_results: int = 3) -> str:
         搜索到的信息文本（如果没有结果则返回空字符串）
     """
     try:
-        from uf_mae_web_scraper import UFMAEWebScraper
+        from uf_mae_web_scraper import get_shared_scraper
         
         # 扩展搜索关键词：不仅限于课程，还包括研究、资源、联系方式等
         search_keywords = [
@@ -832,7 +873,7 @@ def get_realtime_uf_mae_info(query_text: str, max_results: int = 3) -> str:
         should_search = any(keyword in query_lower for keyword in search_keywords)
         
         if should_search:
-            scraper = UFMAEWebScraper()
+            scraper = get_shared_scraper()
             web_results = scraper.search_website(query_text, max_results=max_results)
             if web_results:
                 web_context = "\n".join([f"Real-time UF MAE website info: {r}" for r in web_results])
@@ -843,97 +884,145 @@ def get_realtime_uf_mae_info(query_text: str, max_results: int = 3) -> str:
         print(f"⚠️ Real-time website search failed: {e}")
         return ""
 
-def generate_student_reply_with_rag_uf(advisor_message: str, persona: str, uf_api: UFNavigatorAPI, 
-                                      knowledge_base: SimpleKnowledgeBase, advisor_intent: str = None,
-                                      conversation_history: List[Dict] = None,
-                                      persona_info: Optional[Dict[str, Any]] = None,
-                                      preferred_model: Optional[str] = None) -> str:
-    """使用RAG + UF LiteLLM API生成学生回复（支持多模型fallback）"""
-    try:
-        # 1. 检索相关知识
-        relevant_docs = knowledge_base.search(advisor_message)
-        knowledge_context = "\n".join(relevant_docs) if relevant_docs else ""
-        
-        # 1.5. 实时搜索 UF MAE 网站（通用搜索，适用于所有场景）
-        web_context = get_realtime_uf_mae_info(advisor_message, max_results=3)
-        if web_context:
-            knowledge_context = f"{knowledge_context}\n\n{web_context}" if knowledge_context else web_context
-        
-        # 2. 智能选择对话上下文（改进：选择最相关的消息，而不是固定3轮）
-        context_text = ""
-        if conversation_history:
-            context_text = get_smart_conversation_history(
-                conversation_history, 
-                advisor_message,
-                max_messages=12
-            )
-        
-        # 3. 如果有上下文，添加到 advisor_message 中
-        if context_text:
-            full_advisor_message = f"""Previous conversation:
+def search_knowledge_base(knowledge_base: SimpleKnowledgeBase, query: str, token_budget: Optional[int] = None) -> List[str]:
+    """
+    知识库检索。默认按段落（passages）检索，结果总长度受 token 预算限制，避免整页文本塞进 prompt。
+    配置：UF_KB_SEARCH_MODE（passages / bm25 / keyword，默认 passages）、UF_KB_TOKEN_BUDGET（默认 500）
+    """
+    mode = _get_secret("UF_KB_SEARCH_MODE", "passages").strip().lower() or "passages"
+    if mode != "passages":
+        return knowledge_base.search(query, mode=mode)
+    if token_budget is None:
+        try:
+            token_budget = int(_get_secret("UF_KB_TOKEN_BUDGET", "500"))
+        except ValueError:
+            token_budget = 500
+    return knowledge_base.search(query, mode="passages", token_budget=token_budget)
+
+
+def _prepare_rag_reply_inputs(advisor_message: str, knowledge_base: SimpleKnowledgeBase,
+                              conversation_history: List[Dict] = None,
+                              turn_context: Optional[Dict[str, Any]] = None,
+                              persona: Optional[str] = None,
+                              advisor_intent: Optional[str] = None) -> Tuple[str, List[str], Optional[List[Dict]]]:
+    """
+    RAG 检索 + 对话上下文，返回 (full_advisor_message, knowledge_context, few_shot_examples)
+    knowledge_context 是按相关度排好的知识条目列表（知识库段落在前，网站实时信息在后），
+    超出 prompt token 预算时由 build_student_reply_messages 从末尾裁剪
+    知识库检索、网站实时搜索、Few-Shot 选择互不依赖，并发执行；超过各自截止时间的阶段直接丢弃。
+    turn_context: prefetch_turn_context 的结果（已用 _usable_turn_context 校验），可省去历史拼接
+    persona: 提供时同时选择 Few-Shot 示例（选择超时 / 失败 → []，不带示例回复，不会在回复线程上重选）；
+             没跑这个阶段时 few_shot_examples 为 None（由 generate_student_reply 自己选）
+    """
+    # 1. 对话上下文（按时间顺序的最近若干条；Few-Shot 选择要用到完整消息，所以先做）
+    context_text = ""
+    if turn_context:
+        latest = conversation_history[-1]
+        latest_line = f"Advisor: {latest.get('content', '')}"
+        prefix = turn_context["history_prefix"]
+        context_text = f"{prefix}\n{latest_line}" if prefix else latest_line
+    elif conversation_history:
+        context_text = get_smart_conversation_history(
+            conversation_history, 
+            advisor_message,
+            max_messages=12
+        )
+    
+    # 如果有上下文，添加到 advisor_message 中
+    if context_text:
+        full_advisor_message = f"""Previous conversation:
 {context_text}
 
 Now the advisor says: {advisor_message}"""
-        else:
-            full_advisor_message = advisor_message
-        
-        # 4. 使用UF LiteLLM API生成回复（传递intent、persona_info、preferred_model用于Few-Shot和模型选择）
-        reply = uf_api.generate_student_reply(
-            advisor_message=full_advisor_message, 
-            persona=persona, 
+    else:
+        full_advisor_message = advisor_message
+
+    # 2. 并发：知识库检索 + 实时搜索 UF MAE 网站 + Few-Shot 示例选择
+    stages = {
+        "kb": (lambda: search_knowledge_base(knowledge_base, advisor_message), stage_deadline("kb"), []),
+        "web": (lambda: get_realtime_uf_mae_info(advisor_message, max_results=3), stage_deadline("web"), ""),
+    }
+    if persona and get_few_shot_examples is not None:
+        stages["few_shot"] = (
+            lambda: get_few_shot_examples(
+                persona=persona,
+                advisor_message=full_advisor_message,
+                intent=advisor_intent,
+                num_examples=2,
+            ),
+            stage_deadline("few_shot"),
+            [],  # 超时 → 不带示例（完整 persona prompt 不变）；不能回 None，否则回复线程会重新选一遍
+        )
+    results, timings = run_stages(stages)
+    st.session_state.retrieval_timings = timings
+
+    knowledge_context = list(results["kb"] or [])
+    web_context = results["web"]
+    if web_context:
+        knowledge_context.append(web_context)
+    return full_advisor_message, knowledge_context, results.get("few_shot")
+
+
+def _notify_meta_tensor_fallback_once(error_msg: str):
+    """服务器端 meta tensor 错误：只提示一次已切换到本地 fallback"""
+    if "meta tensor" not in (error_msg or "").lower():
+        return
+    if "uf_api_meta_tensor_warned" in st.session_state:
+        return
+    st.session_state.uf_api_meta_tensor_warned = True
+    is_local_env = (
+        os.getenv("STREAMLIT_SERVER_ENABLE_CORS") is None and
+        "streamlit" not in str(os.getenv("HOSTNAME", "")).lower()
+    )
+    st.info(
+        "⚠️ UF API 服务器端模型加载问题，已切换到本地 fallback 响应。系统将继续使用 fallback 直到 API 恢复。"
+        if is_local_env else
+        "⚠️ UF API server-side model loading issue. Switched to local fallback response. "
+        "System will continue using fallback until API recovers."
+    )
+
+
+def stream_student_reply_with_rag_uf(advisor_message: str, persona: str, uf_api: UFNavigatorAPI,
+                                     knowledge_base: SimpleKnowledgeBase, advisor_intent: str = None,
+                                     conversation_history: List[Dict] = None,
+                                     persona_info: Optional[Dict[str, Any]] = None,
+                                     preferred_model: Optional[str] = None,
+                                     turn_context: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """
+    RAG + UF LiteLLM student reply, streamed: yields reply text deltas.
+    Model fallback (and, with UF_MODEL_RACING, hedged racing) happens before the first
+    token; if the API produces nothing the local fallback reply is yielded as a single chunk.
+    turn_context: history-derived pieces from prefetch_turn_context (ignored when stale).
+    """
+    produced = False
+    try:
+        turn_context = _usable_turn_context(turn_context, conversation_history, persona)
+        full_advisor_message, knowledge_context, examples = _prepare_rag_reply_inputs(
+            advisor_message, knowledge_base, conversation_history, turn_context,
+            persona=persona, advisor_intent=advisor_intent,
+        )
+        for delta in uf_api.generate_student_reply_stream(
+            advisor_message=full_advisor_message,
+            persona=persona,
             knowledge_context=knowledge_context,
             use_few_shot=True,
-            intent=advisor_intent,  # 传递intent用于Few-Shot示例选择
-            persona_info=persona_info,  # ✅ 传递persona_info
-            preferred_model=preferred_model  # ✅ 传递preferred_model
-        )
-        
-        if reply:
-            return reply
-        else:
-            # Fallback到本地生成
-            error_msg = uf_api.last_error if uf_api else "Unknown error"
-            # 如果是 meta tensor 错误，提供更友好的提示（但不要每次都显示，避免刷屏）
-            if "meta tensor" in error_msg.lower() or "cannot copy out of meta tensor" in error_msg.lower():
-                # 只在第一次出现时显示，避免重复提示
-                if "uf_api_meta_tensor_warned" not in st.session_state:
-                    st.session_state.uf_api_meta_tensor_warned = True
-                    # 检测环境以显示正确语言
-                    is_local_env = (
-                        os.getenv("STREAMLIT_SERVER_ENABLE_CORS") is None and
-                        "streamlit" not in str(os.getenv("HOSTNAME", "")).lower()
-                    )
-                    fallback_msg = (
-                        "⚠️ UF API server-side model loading issue. Switched to local fallback response. "
-                        "System will continue using fallback until API recovers."
-                    ) if not is_local_env else (
-                        "⚠️ UF API 服务器端模型加载问题，已切换到本地 fallback 响应。系统将继续使用 fallback 直到 API 恢复。"
-                    )
-                    st.info(fallback_msg)
-            # 其他错误不显示，避免干扰用户体验
-            return generate_student_reply_fallback(advisor_message, persona)
-            
+            intent=advisor_intent,
+            persona_info=persona_info,
+            preferred_model=preferred_model,
+            prompt_context=turn_context["prompt_context"] if turn_context else None,
+            examples=examples,
+        ):
+            produced = True
+            yield delta
+        if not produced:
+            _notify_meta_tensor_fallback_once(uf_api.last_error if uf_api else "")
     except Exception as e:
-        error_msg = str(e)
-        # 检查是否是 meta tensor 错误
-        if "meta tensor" in error_msg.lower() or "cannot copy out of meta tensor" in error_msg.lower():
-            # 只在第一次出现时显示
-            if "uf_api_meta_tensor_warned" not in st.session_state:
-                st.session_state.uf_api_meta_tensor_warned = True
-                # 检测环境以显示正确语言
-                is_local_env = (
-                    os.getenv("STREAMLIT_SERVER_ENABLE_CORS") is None and
-                    "streamlit" not in str(os.getenv("HOSTNAME", "")).lower()
-                )
-                fallback_msg = (
-                    "⚠️ UF API server-side model loading error. Switched to local fallback response. "
-                    "System will continue using fallback until API recovers."
-                ) if not is_local_env else (
-                    "⚠️ UF API 服务器端模型加载错误，已切换到本地 fallback 响应。系统将继续使用 fallback 直到 API 恢复。"
-                )
-                st.info(fallback_msg)
-        # 其他错误静默处理，避免干扰
-        return generate_student_reply_fallback(advisor_message, persona)
+        _notify_meta_tensor_fallback_once(str(e))
+        if produced:
+            return  # 已经显示了部分回复，保留它
+    if not produced:
+        yield generate_student_reply_fallback(advisor_message, persona)
+
 
 # Google Sheets logging functionality
 def save_to_google_sheets(session_data: Dict[str, Any]) -> bool:
@@ -992,7 +1081,7 @@ def generate_student_opening_with_uf(
         help_seeking = persona_data.get("help_seeking_behavior", "")
         description = persona_data.get("description", "")
 
-        kb_texts = knowledge_base.search("MAE advising student opening prompt") if knowledge_base else []
+        kb_texts = search_knowledge_base(knowledge_base, "MAE advising student opening prompt") if knowledge_base else []
         knowledge_context = "\n".join(kb_texts or [])
         
         # 实时搜索 UF MAE 网站获取最新信息（用于生成更真实的开场问题）
@@ -1073,6 +1162,9 @@ IMPORTANT: The opening message MUST match the persona's characteristics precisel
 """
         }
 
+        # 开场白 temperature=0.8，缓存会让同一 persona 每次都得到同一句开场白，所以默认不缓存（UF_CACHE_OPENINGS=true 开启）
+        cache_openings = _get_secret("UF_CACHE_OPENINGS", "false").strip().lower() in ("1", "true", "yes")
+
         # ✅ 用 UFNavigatorAPI 的"多模型 fallback"机制：借用 generate_student_reply 的模型选择逻辑
         opening = uf_api.generate_student_reply(
             advisor_message=user_msg["content"],
@@ -1082,6 +1174,7 @@ IMPORTANT: The opening message MUST match the persona's characteristics precisel
             intent=None,
             persona_info=persona_data,
             preferred_model=preferred_model,
+            cache=get_response_cache() if cache_openings else None,
         )
         return opening
 
@@ -1089,6 +1182,21 @@ IMPORTANT: The opening message MUST match the persona's characteristics precisel
         # 出错就让上层走本地 fallback opening
         return None
 
+def _generate_pool_opening(persona: str) -> Optional[str]:
+    """开场白预生成池的生成函数（在后台线程运行，使用自己的 UFNavigatorAPI，不依赖 session_state）"""
+    api = _POOL_OPENING_CLIENT.get("api")
+    if api is None:
+        api = _POOL_OPENING_CLIENT["api"] = UFNavigatorAPI()
+    return generate_student_opening_with_uf(
+        persona=persona,
+        uf_api=api,
+        knowledge_base=get_shared_knowledge_base(),
+    )
+
+
+_POOL_OPENING_CLIENT: Dict[str, UFNavigatorAPI] = {}
+
+
 def generate_student_reply_fallback(advisor_message: str, persona: str) -> str:
     """Semantic-aware fallback reply generation based on advisor message content"""
     try:
@@ -1297,16 +1405,27 @@ Student persona: {persona.upper()} — {persona_desc}
 
 Respond in 3-5 concise, practical sentences."""
     messages = [{"role": "user", "content": prompt}]
+    params = dict(max_tokens=200, temperature=0.2)
+
+    # 同一份对话重复点击 "Complete Training" 不再请求远端模型（任一 fallback 模型的缓存都可用）
+    cache = get_response_cache()
+    cached = cache.get_any(cache.make_key(m, messages, **params) for m in UF_MODEL_FALLBACKS)
+    if cached:
+        return cached
+
     last_err = None
-    for model_name in UF_MODEL_FALLBACKS:
+    health = get_model_health_registry()
+    for model_name in health.ordered_models(UF_MODEL_FALLBACKS):
+        if not health.allow_request(model_name):
+            continue
         try:
             out = uf_api.generate_chat(
                 messages=messages,
                 model=model_name,
-                max_tokens=200,
-                temperature=0.2,
+                **params,
             )
             if out and out.strip():
+                cache.set(cache.make_key(model_name, messages, **params), out.strip())
                 return out.strip()
         except Exception as e:
             last_err = e
@@ -1529,12 +1648,17 @@ def main():
         # 初始化一次：不要在启动阶段 test_connection / chat
         if "uf_api" not in st.session_state or st.session_state.uf_api is None:
             st.session_state.uf_api = UFNavigatorAPI()
-        if "knowledge_base" not in st.session_state or st.session_state.knowledge_base is None:
-            st.session_state.knowledge_base = SimpleKnowledgeBase()
+        # 知识库进程内共享（只读），JSON 文件变化时才重新加载
+        st.session_state.knowledge_base = get_shared_knowledge_base()
 
         uf_api = st.session_state.uf_api
         knowledge_base = st.session_state.knowledge_base
 
+        # 开场白预生成池：后台线程为每个 persona 保持几条现成的开场白（进程内共享）
+        opening_pool = None
+        if uf_api and uf_api.is_usable():
+            opening_pool = get_opening_pool(_generate_pool_opening, personas=list(STUDENT_PERSONAS.keys()))
+
         # 检测是否为本地环境：更可靠的方法（必须在 get_error_message 之前定义）
         def is_local_environment():
             """检测是否在本地环境运行（不在 Streamlit Cloud）
@@ -2019,6 +2143,18 @@ def main():
                         st.info("💡 **提示**: 如果看到 'secrets' 相关的错误，说明 Streamlit Cloud 的 Secrets 没有正确配置。")
                         st.info("请按照 `CLOUD_SECRETS_TROUBLESHOOTING.md` 中的步骤配置 Secrets。")
         
+        # Debug: 响应缓存命中率 + 模型健康度（仅在本地显示）
+        if is_really_local is True:
+            with st.sidebar:
+                with st.expander("📊 LLM cache & model health (debug)", expanded=False):
+                    st.write("**Response cache:**", get_response_cache().stats())
+                    st.write("**Model health:**", get_model_health_registry().snapshot())
+                    st.write("**Retrieval stages (last turn):**", st.session_state.get("retrieval_timings", {}))
+                    st.write("**Retrieval stages (recent):**", get_stage_timing_summary())
+                    uf_api_debug = st.session_state.get("uf_api")
+                    if uf_api_debug is not None and getattr(uf_api_debug, "last_prompt_breakdown", None):
+                        st.write("**Prompt tokens (last reply):**", uf_api_debug.last_prompt_breakdown)
+
         # Debug: 添加手动测试 API 按钮（仅在本地显示，云端隐藏）
         # 额外安全：明确检查 is_really_local 是否为 True
         if is_really_local is True and uf_api and uf_api.client:
@@ -2232,9 +2368,11 @@ def main():
 
         # 1. 定义专门用于渲染的函数（解决乱码）
         # 消息列表中只存纯文本，标签只在渲染时动态生成
-        def render_chat_bubble(role, content, intent_info=None):
+        def render_chat_bubble(role, content, intent_info=None, container=None):
+            # container: 可传入 st.empty() 占位符，用于流式输出时原地刷新
             if not content:
                 return
+            target = container if container is not None else st
             
             from html import escape
             import re
@@ -2272,14 +2410,14 @@ def main():
             if role == "student":
                 # 从 session_state 读取 persona（修复作用域问题）
                 persona_display = st.session_state.selected_persona.upper()
-                st.markdown(f"""
+                target.markdown(f"""
                 <div class="chat-message student-message">
                     <strong>👨‍🎓 Student ({persona_display}):</strong> {escaped_content}
                     {badge_html}
                 </div>
                 """, unsafe_allow_html=True)
             else:
-                st.markdown(f"""
+                target.markdown(f"""
                 <div class="chat-message advisor-message">
                     <strong>👨‍🏫 You (Peer Advisor):</strong> {escaped_content}
                     {badge_html}
@@ -2302,17 +2440,11 @@ def main():
         if not st.session_state.messages:
             if st.button("🎯 Start Conversation"):
                 with st.spinner("Student is thinking..."):
-                    opening_text = None
-                    if uf_api and knowledge_base:
-                        opening_text = generate_student_opening_with_uf(
-                            persona=st.session_state.selected_persona,
-                            uf_api=uf_api,
-                            knowledge_base=knowledge_base,
-                            preferred_model=st.session_state.get("preferred_model", None)
-                        )
+                    # 直接从预生成池取（不阻塞）；池空时用 persona 自带的开场问题
+                    opening_text = opening_pool.pop(st.session_state.selected_persona) if opening_pool else None
                     if not opening_text:
-                        opening_pool = STUDENT_PERSONAS[st.session_state.selected_persona]["opening_questions"]
-                        opening_text = random.choice(opening_pool)
+                        opening_questions = STUDENT_PERSONAS[st.session_state.selected_persona]["opening_questions"]
+                        opening_text = random.choice(opening_questions)
 
                     # 存储数据（只存纯文本！）
                     st.session_state.messages.append({
@@ -2328,6 +2460,9 @@ def main():
                             st.session_state.student_intents
                         )
                     )
+                    st.session_state.turn_context = prefetch_turn_context(
+                        st.session_state.messages, st.session_state.selected_persona
+                    )
                     st.rerun()  # 仅在第一次启动对话时刷新
 
         # 4. Advisor input - 动态key强制重建输入框（最稳，100%清空）
@@ -2366,48 +2501,63 @@ def main():
                         })
                         st.session_state.advisor_intents.append(a_intent)
 
-                        with st.spinner("☁️ Student is typing..."):
-                            # ✅ 改动2：真正生成回复时才调用 API；失败只 fallback，不要 kill client
-                            uf_api = st.session_state.uf_api
-                            knowledge_base = st.session_state.knowledge_base
-                            
-                            def _is_server_loading_error(msg: str) -> bool:
-                                """判断是否是服务器端模型加载错误"""
-                                m = (msg or "").lower()
-                                return ("meta tensor" in m) or ("torch" in m)
-                            
-                            student_reply = None
-                            
-                            if uf_api and uf_api.client and knowledge_base:
-                                try:
-                                    # 这里才真正打 API
-                                    persona_info = STUDENT_PERSONAS.get(st.session_state.selected_persona, {})
-                                    preferred_model = st.session_state.get("preferred_model", None)
-                                    
-                                    student_reply = generate_student_reply_with_rag_uf(
-                                        advisor_message=clean_input,
-                                        persona=st.session_state.selected_persona,
-                                        uf_api=uf_api,
-                                        knowledge_base=knowledge_base,
-                                        advisor_intent=a_intent["intent"],
-                                        conversation_history=st.session_state.messages,
-                                        persona_info=persona_info,          # ✅ 加上
-                                        preferred_model=preferred_model     # ✅ 加上
-                                    )
-                                except Exception as e:
-                                    emsg = str(e)
-                                    if _is_server_loading_error(emsg):
-                                        st.info(get_error_message("server_loading"))
-                                    else:
-                                        st.warning(f"{get_error_message('api_call_failed')}: {emsg[:200]}")
-                                    # 不把 uf_api 设为 None，保留客户端以便后续重试
-                            
-                            # fallback（如果 API 返回 None 或调用失败）
-                            if not student_reply:
-                                student_reply = generate_student_reply_fallback(
-                                    clean_input,
-                                    st.session_state.selected_persona
-                                )
+                        # 流式显示学生回复：用户感知的是首个 token 的等待时间，而不是整段生成时间
+                        reply_placeholder = st.empty()
+                        reply_placeholder.caption("☁️ Student is typing...")
+
+                        # ✅ 改动2：真正生成回复时才调用 API；失败只 fallback，不要 kill client
+                        uf_api = st.session_state.uf_api
+                        knowledge_base = st.session_state.knowledge_base
+                        
+                        def _is_server_loading_error(msg: str) -> bool:
+                            """判断是否是服务器端模型加载错误"""
+                            m = (msg or "").lower()
+                            return ("meta tensor" in m) or ("torch" in m)
+                        
+                        student_reply = None
+                        
+                        if uf_api and uf_api.client and knowledge_base:
+                            streamed = ""
+                            try:
+                                # 这里才真正打 API
+                                persona_info = STUDENT_PERSONAS.get(st.session_state.selected_persona, {})
+                                preferred_model = st.session_state.get("preferred_model", None)
+                                
+                                last_render = 0.0
+                                for delta in stream_student_reply_with_rag_uf(
+                                    advisor_message=clean_input,
+                                    persona=st.session_state.selected_persona,
+                                    uf_api=uf_api,
+                                    knowledge_base=knowledge_base,
+                                    advisor_intent=a_intent["intent"],
+                                    conversation_history=st.session_state.messages,
+                                    persona_info=persona_info,          # ✅ 加上
+                                    preferred_model=preferred_model,    # ✅ 加上
+                                    turn_context=st.session_state.get("turn_context"),
+                                ):
+                                    streamed += delta
+                                    # 限制刷新频率，避免每个 token 都推一次前端
+                                    now = time.monotonic()
+                                    if now - last_render >= 0.05:
+                                        render_chat_bubble("student", streamed, container=reply_placeholder)
+                                        last_render = now
+                                student_reply = streamed
+                            except Exception as e:
+                                student_reply = streamed or None
+                                emsg = str(e)
+                                if _is_server_loading_error(emsg):
+                                    st.info(get_error_message("server_loading"))
+                                else:
+                                    st.warning(f"{get_error_message('api_call_failed')}: {emsg[:200]}")
+                                # 不把 uf_api 设为 None，保留客户端以便后续重试
+                        
+                        # fallback（如果 API 返回 None 或调用失败）
+                        if not student_reply:
+                            student_reply = generate_student_reply_fallback(
+                                clean_input,
+                                st.session_state.selected_persona
+                            )
+                        render_chat_bubble("student", student_reply, container=reply_placeholder)
 
                         student_reply_clean = re.sub(r"<[^>]+>", "", student_reply or "").strip()
                         s_intent = analyze_intent(
@@ -2424,6 +2574,11 @@ def main():
                         })
                         st.session_state.student_intents.append(s_intent)
 
+                        # 预取下一轮只依赖历史的上下文，下一次提交时只做和新消息相关的工作
+                        st.session_state.turn_context = prefetch_turn_context(
+                            st.session_state.messages, st.session_state.selected_persona
+                        )
+
                 except Exception as e:
                     st.error(f"Error: {e}")
 